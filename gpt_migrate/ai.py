@@ -1,34 +1,61 @@
+import asyncio
 import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
 
 import openai
-from litellm import completion
+from cache import ResponseCache
+from config import MAX_CONCURRENT_REQUESTS, MODEL_CONCURRENCY_LIMITS
+from litellm import acompletion, completion
 from utils import parse_code_string
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 
 class AI:
-    def __init__(self, model="gemini/gemini-1.5-flash", temperature=0.1, max_tokens=10000):
+    def __init__(
+        self, model="gemini/gemini-1.5-flash", temperature=0.1, max_tokens=10000, cache=None, rate_limiter=None
+    ):
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.model_name = model
+        self.cache = cache if cache is not None else ResponseCache(bypass=True)
+        self.rate_limiter = rate_limiter
+
+    def _cache_key(self, prompt):
+        return ResponseCache.key(self.model_name, self.temperature, self.max_tokens, prompt)
 
     def write_code(self, prompt):
-        message = [{"role": "user", "content": str(prompt)}]
-        response = completion(
-            messages=message,
-            stream=False,
-            model=self.model_name,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature,
-        )
-        if response["choices"][0]["message"]["content"].startswith("INSTRUCTIONS:"):
-            return ("INSTRUCTIONS:", "", response["choices"][0]["message"]["content"][14:])
+        key = self._cache_key(prompt)
+        content = self.cache.get(key)
+        if content is None:
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            message = [{"role": "user", "content": str(prompt)}]
+            response = completion(
+                messages=message,
+                stream=False,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+            )
+            content = response["choices"][0]["message"]["content"]
+            self.cache.set(key, content)
+        if content.startswith("INSTRUCTIONS:"):
+            return ("INSTRUCTIONS:", "", content[14:])
         else:
-            code_triples = parse_code_string(response["choices"][0]["message"]["content"])
+            code_triples = parse_code_string(content)
             return code_triples
 
     def run(self, prompt):
+        key = self._cache_key(prompt)
+        chat = self.cache.get(key)
+        if chat is not None:
+            return chat
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
         message = [{"role": "user", "content": str(prompt)}]
         response = completion(
             messages=message,
@@ -44,4 +71,110 @@ class AI:
             print("msg=", msg)
             if msg:
                 chat += msg
+        self.cache.set(key, chat)
         return chat
+
+
+class ConcurrencyLimiter:
+    """Caps the number of in-flight requests globally and per model.
+
+    Semaphores are created lazily for each running event loop, so the same limiter can be shared by
+    successive asyncio.run() calls.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENT_REQUESTS, per_model_limits=None):
+        self.max_concurrency = max_concurrency
+        self.per_model_limits = dict(MODEL_CONCURRENCY_LIMITS if per_model_limits is None else per_model_limits)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_semaphores(self, model):
+        loop = asyncio.get_running_loop()
+        semaphores = self._semaphores.setdefault(loop, {})
+        if None not in semaphores:
+            semaphores[None] = asyncio.Semaphore(self.max_concurrency)
+        if model in self.per_model_limits and model not in semaphores:
+            semaphores[model] = asyncio.Semaphore(self.per_model_limits[model])
+        return semaphores[None], semaphores.get(model)
+
+    @asynccontextmanager
+    async def slot(self, model):
+        global_semaphore, model_semaphore = self._get_semaphores(model)
+        if model_semaphore is None:
+            async with global_semaphore:
+                yield
+        else:
+            async with model_semaphore, global_semaphore:
+                yield
+
+
+class RateLimiter:
+    """Spaces requests evenly so that at most requests_per_minute are started, across threads and event loops.
+
+    Each caller reserves the next free start time under a lock and then sleeps until it, so concurrent
+    migrations sharing one limiter never burst past the provider's quota together.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+            return start - now
+
+    def wait(self):
+        time.sleep(self._reserve())
+
+    async def await_turn(self):
+        await asyncio.sleep(self._reserve())
+
+
+class AsyncAI(AI):
+    """AI backend that can also be awaited, built on litellm's async completion API."""
+
+    def __init__(
+        self,
+        model="gemini/gemini-1.5-flash",
+        temperature=0.1,
+        max_tokens=10000,
+        cache=None,
+        limiter=None,
+        rate_limiter=None,
+    ):
+        super().__init__(
+            model=model, temperature=temperature, max_tokens=max_tokens, cache=cache, rate_limiter=rate_limiter
+        )
+        self.limiter = limiter if limiter is not None else ConcurrencyLimiter()
+
+    async def _acomplete(self, prompt):
+        key = self._cache_key(prompt)
+        content = self.cache.get(key)
+        if content is not None:
+            return content
+        message = [{"role": "user", "content": str(prompt)}]
+        async with self.limiter.slot(self.model_name):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.await_turn()
+            response = await acompletion(
+                messages=message,
+                stream=False,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+            )
+        content = response["choices"][0]["message"]["content"]
+        self.cache.set(key, content)
+        return content
+
+    async def awrite_code(self, prompt):
+        content = await self._acomplete(prompt)
+        if content.startswith("INSTRUCTIONS:"):
+            return ("INSTRUCTIONS:", "", content[14:])
+        return parse_code_string(content)
+
+    async def arun(self, prompt):
+        return await self._acomplete(prompt)
@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import typer
+from ai import AsyncAI, ConcurrencyLimiter, RateLimiter
+from cache import ResponseCache
+from config import DEFAULT_CACHE_DIR, MAX_CONCURRENT_REQUESTS, MAX_REQUESTS_PER_MINUTE
+from main import Globals, run_steps
+from utils import build_directory_structure, detect_language
+
+app = typer.Typer()
+
+# Job fields that may be left out of the run-spec, with the same defaults as main.py
+JOB_DEFAULTS = {
+    "sourcelang": None,
+    "sourceentry": "app.py",
+    "targetlang": "nodejs",
+    "operating_system": "linux",
+    "testfiles": "app.py",
+    "sourceport": None,
+    "targetport": 8080,
+    "guidelines": "",
+    "step": "all",
+}
+
+
+def load_run_spec(path):
+    """Read the jobs of a YAML or JSON run-spec.
+
+    The spec is either a list of jobs or a mapping with a "jobs" list and optional "defaults" applied to
+    every job. Each job needs a sourcedir and a targetdir, relative to the spec file or absolute; all other
+    fields default to the main.py options of the same name.
+    """
+    with open(path) as file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise typer.BadParameter("Reading a YAML run-spec requires PyYAML: pip install pyyaml")
+            spec = yaml.safe_load(file)
+        else:
+            spec = json.load(file)
+
+    if isinstance(spec, list):
+        spec = {"jobs": spec}
+    defaults = {**JOB_DEFAULTS, **spec.get("defaults", {})}
+    spec_dir = os.path.dirname(os.path.abspath(path))
+
+    jobs = []
+    names = set()
+    targetdirs = set()
+    for index, entry in enumerate(spec.get("jobs", [])):
+        job = {**defaults, **entry}
+        for field in ["sourcedir", "targetdir"]:
+            if not job.get(field):
+                raise typer.BadParameter(f"Job {index + 1} of {path} has no {field}.")
+            job[field] = os.path.normpath(os.path.join(spec_dir, os.path.expanduser(job[field])))
+        if isinstance(job["testfiles"], list):
+            job["testfiles"] = ",".join(job["testfiles"])
+        if job["targetdir"] in targetdirs:
+            raise typer.BadParameter(f"Several jobs of {path} write to {job['targetdir']}.")
+        targetdirs.add(job["targetdir"])
+
+        name = job.get("name") or os.path.basename(job["sourcedir"])
+        if name in names:
+            name = f"{name}-{index + 1}"
+        job["name"] = name
+        names.add(name)
+        jobs.append(job)
+    return jobs
+
+
+class JobStatus:
+    def __init__(self, name):
+        self.name = name
+        self.state = "queued"
+        self.started = None
+        self.finished = None
+        self.files = 0
+        self.reused_files = 0
+        self.error = ""
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "seconds": round(self.elapsed, 1),
+            "files": self.files,
+            "reused_files": self.reused_files,
+            "error": self.error,
+        }
+
+
+def run_job(job, ai, incremental, signature_ai=None):
+    """Migrate one repository without prompting; missing information fails the job instead.
+
+    Returns the number of files migrated and the number of files reused from an earlier run.
+    """
+    sourcedir = job["sourcedir"]
+    targetdir = job["targetdir"]
+    os.makedirs(targetdir, exist_ok=True)
+
+    sourcelang = job["sourcelang"] or detect_language(sourcedir)
+    if not sourcelang:
+        raise ValueError(f"Unable to detect the language of {sourcedir}; set sourcelang for this job.")
+    if not os.path.exists(os.path.join(sourcedir, job["sourceentry"])):
+        raise FileNotFoundError(f"Entrypoint {job['sourceentry']} not found in {sourcedir}.")
+
+    globals = Globals(
+        sourcedir,
+        targetdir,
+        sourcelang,
+        job["targetlang"],
+        job["sourceentry"],
+        build_directory_structure(sourcedir),
+        job["operating_system"],
+        job["testfiles"],
+        job["sourceport"],
+        job["targetport"],
+        job["guidelines"],
+        ai,
+    )
+    globals.signature_ai = signature_ai
+    return run_steps(globals, job["step"], incremental)
+
+
+def format_status_table(statuses):
+    width = max([len("job")] + [len(status.name) for status in statuses])
+    lines = [f"{'job':<{width}}  {'state':<8}  {'time':>7}  {'files':>5}  {'reused':>6}  error"]
+    for status in statuses:
+        lines.append(
+            f"{status.name:<{width}}  {status.state:<8}  {status.elapsed:>6.0f}s  {status.files:>5}"
+            f"  {status.reused_files:>6}  {status.error[:60]}"
+        )
+    return "\n".join(lines)
+
+
+@app.command()
+def batch(
+    runspec: str = typer.Argument(..., help="YAML or JSON file listing the repositories to migrate."),
+    model: str = typer.Option("gemini/gemini-1.5-flash", help="Large Language Model used by every job."),
+    temperature: float = typer.Option(0, help="Temperature setting for the AI model."),
+    jobs: int = typer.Option(4, help="Number of repositories migrated at the same time."),
+    concurrency: int = typer.Option(
+        MAX_CONCURRENT_REQUESTS, help="Maximum number of LLM requests in flight at the same time, per job."
+    ),
+    rate_limit: int = typer.Option(
+        MAX_REQUESTS_PER_MINUTE, help="Maximum number of LLM requests started per minute, across all jobs."
+    ),
+    cache: bool = typer.Option(True, help="Reuse cached LLM responses for identical prompts, across all jobs."),
+    cachedir: str = typer.Option(DEFAULT_CACHE_DIR, help="Directory where LLM responses are cached."),
+    incremental: bool = typer.Option(True, help="Only re-migrate source files that changed since the last run."),
+    signature_model: str = typer.Option(
+        None, help="(Optional) cheaper model that describes function signatures without a doc comment."
+    ),
+    report: str = typer.Option(None, help="(Optional) path of a JSON file the summary report is written to."),
+):
+    job_specs = load_run_spec(runspec)
+    # one AI for every job: the response cache and the rate limit are shared, the in-flight cap is per job
+    ai = AsyncAI(
+        model=model,
+        temperature=temperature,
+        cache=ResponseCache(cache_dir=cachedir, bypass=not cache),
+        limiter=ConcurrencyLimiter(max_concurrency=concurrency),
+        rate_limiter=RateLimiter(rate_limit),
+    )
+    signature_ai = None
+    if signature_model:
+        signature_ai = AsyncAI(
+            model=signature_model,
+            temperature=0,
+            cache=ai.cache,
+            limiter=ai.limiter,
+            rate_limiter=ai.rate_limiter,
+        )
+    statuses = {job["name"]: JobStatus(job["name"]) for job in job_specs}
+    status_lock = threading.Lock()
+
+    def echo_statuses():
+        with status_lock:
+            typer.echo(typer.style(format_status_table(statuses.values()), fg=typer.colors.BLUE))
+
+    def run(job):
+        status = statuses[job["name"]]
+        status.state = "running"
+        status.started = time.monotonic()
+        echo_statuses()
+        try:
+            status.files, status.reused_files = run_job(job, ai, incremental, signature_ai)
+            status.state = "done"
+        except typer.Exit:
+            status.state = "failed"
+            status.error = "stopped for human intervention"
+        except Exception as e:
+            status.state = "failed"
+            status.error = f"{type(e).__name__}: {e}"
+        status.finished = time.monotonic()
+        echo_statuses()
+
+    typer.echo(typer.style(f"Migrating {len(job_specs)} repositories, {jobs} at a time.", fg=typer.colors.BLUE))
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in as_completed([executor.submit(run, job) for job in job_specs]):
+            future.result()
+    elapsed = time.monotonic() - started
+
+    done = [status for status in statuses.values() if status.state == "done"]
+    failed = [status for status in statuses.values() if status.state == "failed"]
+    # reused files cost no work, so they are reported apart from the throughput
+    files = sum(status.files for status in done)
+    reused_files = sum(status.reused_files for status in done)
+    cache_stats = ai.cache.stats()
+    summary = {
+        "jobs": len(statuses),
+        "done": len(done),
+        "failed": len(failed),
+        "seconds": round(elapsed, 1),
+        "files": files,
+        "reused_files": reused_files,
+        "files_per_minute": round(files * 60 / elapsed, 2) if elapsed else 0.0,
+        "cache": cache_stats,
+        "results": [status.as_dict() for status in statuses.values()],
+    }
+
+    typer.echo(
+        typer.style(
+            f"{len(done)} of {len(statuses)} repositories migrated in {elapsed:.0f}s: "
+            f"{files} files, {summary['files_per_minute']} files/minute, {reused_files} reused. "
+            f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.",
+            fg=typer.colors.GREEN if not failed else typer.colors.YELLOW,
+        )
+    )
+    for status in failed:
+        typer.echo(typer.style(f"✗ {status.name}: {status.error}", fg=typer.colors.RED))
+    if report:
+        with open(report, "w") as file:
+            json.dump(summary, file, indent=2)
+    if failed:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
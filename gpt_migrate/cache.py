@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from config import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of raw LLM responses.
+
+    Entries are keyed by the model, temperature, max_tokens and prompt, stored one file per key,
+    and evicted least-recently-used first once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES, bypass=False):
+        self.cache_dir = Path(os.path.expanduser(cache_dir))
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+        if not self.bypass:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(model, temperature, max_tokens, prompt):
+        prompt_hash = hashlib.sha256(str(prompt).encode("utf-8")).hexdigest()
+        material = json.dumps([model, temperature, max_tokens, prompt_hash])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / (key + ".json")
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as file:
+                content = json.load(file)["content"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        # mtime doubles as the LRU timestamp
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def set(self, key, content):
+        if self.bypass:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"content": content, "created": time.time()}, file)
+        with self._lock:
+            # an entry rewritten under the same key replaces the size of the old one
+            try:
+                replaced_size = path.stat().st_size
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += path.stat().st_size - replaced_size
+            over_budget = self.max_bytes and self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _scan(self):
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        return entries, total
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        if self.bypass or not self.max_bytes:
+            return
+        with self._lock:
+            entries, total = self._scan()
+            self._size = total
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                    total -= size
+                except OSError:
+                    pass
+            self._size = total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
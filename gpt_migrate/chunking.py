@@ -0,0 +1,163 @@
+"""Splitting source files that are too large for one prompt along their top-level syntax nodes."""
+
+from parser import get_parser, outline_file
+
+import typer
+from config import CHARS_PER_TOKEN, EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO
+
+# Top-level node types containing any of these start the body of a file; the nodes before the first one
+# (imports, constants, module setup) form the header that every part is migrated with
+DEFINITION_NODE_KEYWORDS = (
+    "function",
+    "class",
+    "method",
+    "decorated",
+    "impl",
+    "struct",
+    "interface",
+    "trait",
+    "enum",
+    "module",
+    "namespace",
+    "object",
+    "export",
+)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def is_definition(node_type):
+    return any(keyword in node_type for keyword in DEFINITION_NODE_KEYWORDS)
+
+
+def _members(root, source, start):
+    """Byte ranges of the members in the body of the top-level node at start, e.g. the methods of a class"""
+    node = next((child for child in root.children if child.start_byte == start), None)
+    while node is not None:
+        body = node.child_by_field_name("body")
+        if body is not None:
+            members = []
+            for member in body.named_children:
+                # a member alone on its line starts with the line, so that its part keeps the indentation
+                line_start = member.start_byte - member.start_point[1]
+                start = line_start if not source[line_start : member.start_byte].strip() else member.start_byte
+                members.append((start, member.end_byte))
+            return members
+        # decorated definitions and exports wrap the definition that has the body
+        node = node.child_by_field_name("definition") or node.child_by_field_name("declaration")
+    return []
+
+
+def _part_note(index, count, declaration):
+    if index == 0:
+        return (
+            f" This part opens `{declaration}`, which is too large for one part: write its opening and the"
+            " members in this part, but do not close it, as the following parts continue it."
+        )
+    if index < count - 1:
+        return (
+            f" This part continues `{declaration}` from the previous part: write only the members in this part,"
+            " without opening or closing it again."
+        )
+    return (
+        f" This part continues `{declaration}` from the previous part and ends it: write only the members in"
+        " this part, without opening it again, then close it."
+    )
+
+
+def split_source_file(file_path, max_tokens, outline=None):
+    """Split a large file into its header and parts of at most max_tokens each, in file order.
+
+    Returns (header, parts, definitions, notes) or None if the file fits in one prompt or can't be split:
+    no grammar for its language, or nothing to split along. header and parts concatenate back into the
+    whole file; definitions holds the first line of every top-level node after the header. A top-level
+    node larger than max_tokens is split between its members, e.g. the methods of a class, and each
+    of its parts gets a note, in notes, on where it stands in the node; other notes are empty. A node
+    that can't be split that way becomes an oversized part of its own, with a warning. outline, from
+    decompose_repository, spares parsing the file again.
+    """
+    with open(file_path, "rb") as file:
+        source = file.read()
+    if estimate_tokens(source.decode("utf8", errors="replace")) <= max_tokens:
+        return None
+
+    extension = file_path.split(".")[-1]
+    if outline is None:
+        if extension not in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO:
+            return None
+        try:
+            outline = outline_file(file_path)
+        except Exception:
+            return None
+    nodes = [(node_type, start, end) for node_type, _, start, end, _ in outline]
+    if not nodes:
+        return None
+
+    # the header ends at the first definition, but never takes more than half of the budget
+    body_start = len(nodes)
+    for index, (node_type, _, end) in enumerate(nodes):
+        if is_definition(node_type) or end // CHARS_PER_TOKEN > max_tokens // 2:
+            body_start = index
+            break
+    header_end = nodes[body_start][1] if body_start < len(nodes) else len(source)
+
+    # (start byte, note) of every part
+    boundaries = []
+    part_tokens = 0
+    root = None
+    warned = False
+    for _, start, end in nodes[body_start:]:
+        node_tokens = (end - start) // CHARS_PER_TOKEN + 1
+        if node_tokens > max_tokens:
+            if root is None:
+                try:
+                    root = get_parser(extension).parse(source).root_node
+                except Exception:
+                    root = False
+            starts = [start]
+            group_tokens = 0
+            for member_start, member_end in _members(root, source, start) if root else []:
+                member_tokens = (member_end - member_start) // CHARS_PER_TOKEN + 1
+                if group_tokens and (member_start - starts[-1]) // CHARS_PER_TOKEN + member_tokens > max_tokens:
+                    starts.append(member_start)
+                    group_tokens = 0
+                group_tokens += member_tokens
+            if len(starts) > 1:
+                declaration = source[start:end].decode("utf8", errors="replace").split("\n")[0].strip()
+                boundaries += [
+                    (part_start, _part_note(index, len(starts), declaration)) for index, part_start in enumerate(starts)
+                ]
+                # whatever follows the node starts a part of its own
+                part_tokens = max_tokens
+                continue
+            _warn_oversized(file_path, node_tokens, max_tokens)
+            warned = True
+        if not boundaries or part_tokens + node_tokens > max_tokens:
+            boundaries.append((start, ""))
+            part_tokens = 0
+        part_tokens += node_tokens
+    if len(boundaries) < 2:
+        if not warned:
+            _warn_oversized(file_path, estimate_tokens(source.decode("utf8", errors="replace")), max_tokens)
+        return None
+
+    boundaries[0] = (header_end, boundaries[0][1])
+    starts = [part_start for part_start, _ in boundaries] + [len(source)]
+    header = source[:header_end].decode("utf8", errors="replace")
+    parts = [source[start:end].decode("utf8", errors="replace") for start, end in zip(starts, starts[1:])]
+    definitions = [
+        source[start:end].decode("utf8", errors="replace").split("\n")[0] for _, start, end in nodes[body_start:]
+    ]
+    return header, parts, definitions, [note for _, note in boundaries]
+
+
+def _warn_oversized(file_path, tokens, max_tokens):
+    typer.echo(
+        typer.style(
+            f"Warning: {file_path} has about {tokens} tokens that can't be split below {max_tokens}"
+            " (MIGRATION_CHUNK_TOKENS); they are migrated in one prompt, which may be cut short.",
+            fg=typer.colors.YELLOW,
+        )
+    )
@@ -10,6 +10,97 @@ Global variables
 """
 MAX_ERROR_MESSAGE_CHARACTERS = 5000
 MAX_DOCKER_LOG_CHARACTERS = 2000
+MAX_SYMBOL_DEFINITIONS = 30
+
+"""
+LLM response cache
+"""
+DEFAULT_CACHE_DIR = os.environ.get("GPT_MIGRATE_CACHE_DIR", "~/.cache/gpt_migrate/responses")
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+"""
+Tree-sitter grammars
+"""
+# Grammar clones and the libraries built from them, shared by every run of this user
+GRAMMAR_CACHE_DIR = os.environ.get("GPT_MIGRATE_GRAMMAR_DIR", "~/.cache/gpt_migrate/tree-sitter")
+# Prebuilt bundles of every grammar, made by provision.py; copy this directory to offline hosts
+GRAMMAR_BUNDLE_DIR = os.environ.get("GPT_MIGRATE_GRAMMAR_BUNDLE", os.path.join(GRAMMAR_CACHE_DIR, "bundles"))
+# Clone and build grammars missing from the bundle when first needed; set to "0" on air-gapped hosts
+GRAMMAR_BUILD_MISSING = os.environ.get("GPT_MIGRATE_GRAMMAR_BUILD", "1") != "0"
+
+"""
+LLM request concurrency
+"""
+MAX_CONCURRENT_REQUESTS = 8
+# Per-model caps applied on top of MAX_CONCURRENT_REQUESTS, e.g. {"gpt-4-32k": 2}
+MODEL_CONCURRENCY_LIMITS: dict[str, int] = {}
+# Requests started per minute by all jobs of a batch run together
+MAX_REQUESTS_PER_MINUTE = 60
+
+"""
+Large file migration
+"""
+# Source files estimated above this many tokens are migrated in parts split along top-level definitions
+MIGRATION_CHUNK_TOKENS = 6000
+# Rough characters per token, good enough to size prompts without a tokenizer
+CHARS_PER_TOKEN = 4
+
+"""
+Repository decomposition
+"""
+# Processes parsing source files into outlines of their top-level nodes, each reusing one parser per language
+DECOMPOSE_WORKERS = os.cpu_count() or 1
+# Files handed to a worker at once; smaller batches balance better, larger ones cost less to send
+DECOMPOSE_BATCH_FILES = 32
+
+"""
+Outline cache
+"""
+# Outlines and import statements of parsed files, keyed by their content and grammar, shared by every run
+OUTLINE_CACHE_DIR = os.environ.get("GPT_MIGRATE_OUTLINE_DIR", "~/.cache/gpt_migrate/outlines")
+# Past this size the cache is rewritten with its most recently added entries only
+OUTLINE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+"""
+Directory structures in prompts
+"""
+# Larger trees are shown in full near the file a prompt is about and summarized further away
+DIRECTORY_STRUCTURE_TOKENS = 2000
+
+"""
+Migration pipeline
+"""
+# Files waiting between two stages (generation, signature extraction) before the stage feeding them blocks
+PIPELINE_QUEUE_SIZE = 16
+# Workers extracting the signatures of migrated files; extraction is local, so few are needed
+SIGNATURE_WORKERS = 2
+
+"""
+Job queue (--distribute and worker.py)
+"""
+# A job whose worker stops renewing its lease for this long is handed to another worker
+JOB_LEASE_SECONDS = 600
+JOB_MAX_ATTEMPTS = 3
+# Failed jobs wait attempts * this long before they are retried
+JOB_RETRY_BACKOFF_SECONDS = 30
+# How often idle workers look for new jobs
+JOB_POLL_SECONDS = 2
+# "wal" needs every process on one host; use "delete" when workers on several hosts share a network filesystem
+JOB_QUEUE_JOURNAL_MODE = "wal"
+
+"""
+Dry-run estimates (--plan)
+"""
+# Answer sizes assumed for prompts whose answer can't be derived from the source
+ESTIMATED_DEPENDENCY_OUTPUT_TOKENS = 40
+ESTIMATED_DOCKERFILE_OUTPUT_TOKENS = 300
+ESTIMATED_TESTS_OUTPUT_TOKENS = 1500
+# Migrated code is assumed to be about as long as its source, and its function signatures a tenth of that
+TARGET_TOKENS_PER_SOURCE_TOKEN = 1.0
+SIGNATURE_TOKENS_PER_SOURCE_TOKEN = 0.1
+# Latency of one request: a fixed overhead plus the time to generate its answer
+ESTIMATED_REQUEST_OVERHEAD_SECONDS = 2.0
+ESTIMATED_OUTPUT_TOKENS_PER_SECOND = 50
 
 """
 Prompt directory
@@ -19,11 +110,15 @@ GUIDELINES = "p1_guidelines/guidelines"
 WRITE_CODE = "p2_actions/write_code"
 CREATE_DOCKER = "p3_setup/create_target_docker"
 GET_EXTERNAL_DEPS = "p3_migrate/1_get_external_deps"
+MAP_EXTERNAL_DEPS = "p3_migrate/1_map_external_deps"
 GET_INTERNAL_DEPS = "p3_migrate/2_get_internal_deps"
 WRITE_MIGRATION = "p3_migrate/3_write_migration"
+WRITE_MIGRATION_HEADER = "p3_migrate/3_write_migration_header"
+WRITE_MIGRATION_PART = "p3_migrate/3_write_migration_part"
 ADD_DOCKER_REQUIREMENTS = "p3_migrate/4_add_docker_requirements"
 REFINE_DOCKERFILE = "p3_migrate/5_refine_target_docker"
 GET_FUNCTION_SIGNATURES = "p3_migrate/6_get_function_signatures"
+DESCRIBE_FUNCTION_SIGNATURES = "p3_migrate/6_describe_function_signatures"
 CREATE_TESTS = "p3_test/create_tests"
 DEBUG_DOCKERFILE = "p3_debug/debug_target_docker"
 IDENTIFY_ACTION = "p3_debug/identify_action"
@@ -43,7 +138,7 @@ SINGLEFILE_EXPLAIN = "p4_output_formats/single_file_explain"
 FILENAMES = "p4_output_formats/filenames"
 
 """
-Living list of types of files that should be excluded from being copied over
+Living list of types of files that should be excluded from being copied over, in .gitignore syntax
 """
 EXCLUDED_FILES = [
     # Docker
@@ -55,12 +150,20 @@ EXCLUDED_FILES = [
     "package.json",
     "package-lock.json",
     "yarn.lock",
-    "node_modules/"
+    "node_modules/",
     # Rust
     "Cargo.toml",
     # TODO: add more
 ]
 
+"""
+Copying files over (add_env_files)
+"""
+# Files copied at once; copies run in the kernel, or share blocks, so this mostly overlaps I/O latency
+SYNC_WORKERS = 8
+# Hardlink copied files to the source instead of copying them. Fastest, but edits to a copy then change the source
+SYNC_HARDLINKS = False
+
 """
 Living list of file extensions that should be copied over
 """
@@ -98,6 +201,13 @@ EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO = {
     "jl": TREE_SITTER_REPO_STUB + "julia",
 }
 
+# Grammars that live in a subdirectory of their tree-sitter repo
+TREE_SITTER_GRAMMAR_SUBDIRS = {
+    "ts": "typescript",
+    "tsx": "tsx",
+    "php": "php",
+}
+
 EXTENSION_TO_LANGUAGE = {
     "py": "Python",
     "js": "JavaScript",
@@ -140,3 +250,36 @@ for key, val in EXTENSION_TO_LANGUAGE.items():
 EXCLUDED_EXTENSIONS_SOURCE = [
     ".md",
 ]
+
+# Interpreters named by the shebang line of extensionless scripts
+INTERPRETER_TO_LANGUAGE = {
+    "python": "Python",
+    "node": "JavaScript",
+    "deno": "TypeScript",
+    "ts-node": "TypeScript",
+    "ruby": "Ruby",
+    "perl": "Perl",
+    "php": "PHP",
+    "lua": "Lua",
+    "Rscript": "R",
+    "elixir": "Elixir",
+    "julia": "Julia",
+    "groovy": "Groovy",
+    "kotlin": "Kotlin",
+    "scala": "Scala",
+    "swift": "Swift",
+    "dart": "Dart",
+    "runghc": "Haskell",
+    "escript": "Erlang",
+}
+
+"""
+Source language detection
+"""
+# Files count with their size, capped so that one large generated or vendored file can't decide the language
+LANGUAGE_DETECTION_MAX_FILE_BYTES = 256 * 1024
+# Detection stops early once this many source files were seen and the leading language holds this share
+LANGUAGE_DETECTION_MIN_FILES = 500
+LANGUAGE_DETECTION_CONFIDENCE = 0.9
+# Other languages holding at least this share are reported as secondary languages
+LANGUAGE_DETECTION_SECONDARY_SHARE = 0.05
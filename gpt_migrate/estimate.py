@@ -0,0 +1,433 @@
+"""Dry-run estimate of the calls, tokens, cost and time of a migration, made without calling the model."""
+
+import os
+import string
+from collections import deque
+from parser import decompose_repository
+
+from chunking import split_source_file
+from config import (
+    ADD_DOCKER_REQUIREMENTS,
+    CHARS_PER_TOKEN,
+    CREATE_DOCKER,
+    CREATE_TESTS,
+    DESCRIBE_FUNCTION_SIGNATURES,
+    DIRECTORY_STRUCTURE_TOKENS,
+    ESTIMATED_DEPENDENCY_OUTPUT_TOKENS,
+    ESTIMATED_DOCKERFILE_OUTPUT_TOKENS,
+    ESTIMATED_OUTPUT_TOKENS_PER_SECOND,
+    ESTIMATED_REQUEST_OVERHEAD_SECONDS,
+    ESTIMATED_TESTS_OUTPUT_TOKENS,
+    EXTENSION_TO_LANGUAGE,
+    EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO,
+    GET_EXTERNAL_DEPS,
+    GET_FUNCTION_SIGNATURES,
+    GET_INTERNAL_DEPS,
+    GUIDELINES,
+    HIERARCHY,
+    LANGUAGE_TO_EXTENSION,
+    MAP_EXTERNAL_DEPS,
+    MIGRATION_CHUNK_TOKENS,
+    REFINE_DOCKERFILE,
+    SIGNATURE_TOKENS_PER_SOURCE_TOKEN,
+    SINGLEFILE,
+    TARGET_TOKENS_PER_SOURCE_TOKEN,
+    WRITE_CODE,
+    WRITE_MIGRATION,
+    WRITE_MIGRATION_HEADER,
+    WRITE_MIGRATION_PART,
+)
+from imports import find_imported_packages, find_internal_dependencies
+from incremental import MigrationManifest, file_hash, migration_settings
+from litellm import model_cost
+from packages import detect_source_packages, load_package_equivalents
+from planner import DependencyGraph
+from utils import prompt_constructor
+
+# Target language names that LANGUAGE_TO_EXTENSION doesn't spell the same way
+TARGET_LANGUAGE_EXTENSIONS = {"nodejs": "js", "node": "js", "golang": "go", "csharp": "cs"}
+
+
+def rendered_length(template, **field_lengths):
+    """Length of template.format(**fields), computed from the length of every field without rendering it"""
+    length = 0
+    for literal, field, _, _ in string.Formatter().parse(template):
+        length += len(literal)
+        if field is not None:
+            length += field_lengths.get(field, 0)
+    return length
+
+
+def count_tokens(characters):
+    return int(characters) // CHARS_PER_TOKEN + 1
+
+
+def request_seconds(output_tokens):
+    return ESTIMATED_REQUEST_OVERHEAD_SECONDS + output_tokens / ESTIMATED_OUTPUT_TOKENS_PER_SECOND
+
+
+def token_prices(model):
+    """(input, output) dollars per token of a model from litellm's price list, or None if it isn't listed"""
+    for name in [model, model.split("/", 1)[-1]]:
+        prices = model_cost.get(name)
+        if prices and "input_cost_per_token" in prices and "output_cost_per_token" in prices:
+            return prices["input_cost_per_token"], prices["output_cost_per_token"]
+    return None
+
+
+def target_extension(targetlang):
+    extensions = {language.lower(): extension for language, extension in LANGUAGE_TO_EXTENSION.items()}
+    extensions.update(TARGET_LANGUAGE_EXTENSIONS)
+    return extensions.get(targetlang.lower())
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds // 60:.0f}m {seconds % 60:02.0f}s"
+    return f"{seconds // 3600:.0f}h {seconds % 3600 // 60:02.0f}m"
+
+
+def _dollars(cost):
+    return f"${cost:,.2f}" if cost >= 1 else f"${cost:.4f}"
+
+
+class MigrationEstimate:
+    """Requests a migration would send, grouped by kind, and how long they would take.
+
+    Every request counts its prompt tokens, its expected answer tokens and their price. Wall time is
+    the longer of the critical path (requests that have to wait for each other) and the time all
+    requests take when spread over the concurrency.
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.kinds = {}
+        self.files = 0
+        self.stale_files = 0
+        self.unresolved_files = 0
+        self.request_seconds = 0.0
+        self.critical_path_seconds = 0.0
+        self.unpriced_models = set()
+
+    def add(self, kind, model, prompt_characters, output_tokens):
+        """Count one request. Returns its estimated latency in seconds."""
+        input_tokens = count_tokens(prompt_characters)
+        output_tokens = max(1, int(output_tokens))
+        totals = self.kinds.setdefault(kind, {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0})
+        totals["calls"] += 1
+        totals["input_tokens"] += input_tokens
+        totals["output_tokens"] += output_tokens
+        prices = token_prices(model)
+        if prices is None:
+            self.unpriced_models.add(model)
+        else:
+            totals["cost"] += input_tokens * prices[0] + output_tokens * prices[1]
+        seconds = request_seconds(output_tokens)
+        self.request_seconds += seconds
+        return seconds
+
+    def total(self, field):
+        return sum(totals[field] for totals in self.kinds.values())
+
+    @property
+    def wall_seconds(self):
+        return max(self.critical_path_seconds, self.request_seconds / self.concurrency)
+
+    def report(self):
+        width = max([len("total")] + [len(kind) for kind in self.kinds])
+        lines = [
+            f"Migration plan: {self.files} files, {self.stale_files} to migrate"
+            + (
+                f", {self.unresolved_files} whose dependencies the model has to identify (files they import are not counted)"
+                if self.unresolved_files
+                else ""
+            )
+            + ".",
+            "",
+            f"{'':<{width}}  {'calls':>7}  {'input tokens':>13}  {'output tokens':>13}  {'cost':>9}",
+        ]
+        for kind, totals in [*self.kinds.items(), ("total", None)]:
+            if totals is None:
+                totals = {field: self.total(field) for field in ["calls", "input_tokens", "output_tokens", "cost"]}
+            lines.append(
+                f"{kind:<{width}}  {totals['calls']:>7}  {totals['input_tokens']:>13,}  "
+                f"{totals['output_tokens']:>13,}  {_dollars(totals['cost']):>9}"
+            )
+        lines += [
+            "",
+            f"Projected wall time at concurrency {self.concurrency}: {_duration(self.wall_seconds)} "
+            f"(critical path {_duration(self.critical_path_seconds)}, {_duration(self.request_seconds)} of requests in total).",
+            "Debugging and test runs are not included, and prompts answered from the response cache cost nothing.",
+        ]
+        if self.unpriced_models:
+            lines.append(
+                f"No prices are known for {', '.join(sorted(self.unpriced_models))}; their cost is counted as $0."
+            )
+        return "\n".join(lines)
+
+
+def estimate_migration(globals, concurrency, step="all", incremental=True):
+    """Walk the migration the way run_steps would and count every prompt it would send.
+
+    Dependencies come from the same static import analysis and migration manifest as a real run; files
+    whose imports can't be resolved statically count an LLM request and are treated as leaves. Prompt
+    sizes are the exact lengths of the rendered prompt templates, except for content the model has yet
+    to write (migrated code, signatures, the target directory structure), which is sized after the
+    source. Nothing is written and the model is never called.
+    """
+    estimate = MigrationEstimate(concurrency)
+    model = globals.ai.model_name
+    sourcedir = globals.sourcedir
+    sizes = {}
+
+    def size(sourcefile):
+        if sourcefile not in sizes:
+            sizes[sourcefile] = os.path.getsize(os.path.join(sourcedir, sourcefile))
+        return sizes[sourcefile]
+
+    tree_characters = DIRECTORY_STRUCTURE_TOKENS * CHARS_PER_TOKEN
+    common = {
+        "targetlang": len(globals.targetlang),
+        "sourcelang": len(globals.sourcelang),
+        "guidelines": len(globals.guidelines),
+        # trees larger than the budget are summarized to fit it; the target tree mirrors the source tree
+        "source_directory_structure": min(len(globals.source_directory_structure), tree_characters),
+        "target_directory_structure": min(len(globals.source_directory_structure), tree_characters),
+    }
+    dockerfile_characters = ESTIMATED_DOCKERFILE_OUTPUT_TOKENS * CHARS_PER_TOKEN
+
+    # Setup and test generation run alongside the migration
+    side_seconds = [0.0]
+    if step in ["setup", "all"]:
+        template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, CREATE_DOCKER, SINGLEFILE)
+        side_seconds.append(
+            estimate.add(
+                "setup",
+                model,
+                rendered_length(template, sourceentry=len(globals.sourceentry), **common),
+                ESTIMATED_DOCKERFILE_OUTPUT_TOKENS,
+            )
+        )
+    if step in ["test", "all"]:
+        template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, CREATE_TESTS, SINGLEFILE)
+        side_seconds.append(
+            sum(
+                estimate.add(
+                    "tests",
+                    model,
+                    rendered_length(
+                        template,
+                        targetport=len(str(globals.targetport)),
+                        old_file_content=size(testfile),
+                        **common,
+                    ),
+                    ESTIMATED_TESTS_OUTPUT_TOKENS,
+                )
+                for testfile in globals.testfiles.split(",")
+            )
+        )
+    if step not in ["migrate", "all"]:
+        estimate.critical_path_seconds = max(side_seconds)
+        return estimate
+
+    manifest = MigrationManifest(globals.targetdir, migration_settings(globals), reuse=incremental)
+
+    # Discovery: when each file is found, and when its dependencies are known
+    external_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_EXTERNAL_DEPS)
+    internal_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_INTERNAL_DEPS)
+    graph = DependencyGraph()
+    source_hashes = {}
+    found_at = {globals.sourceentry: 0.0}
+    known_at = {}
+    queue = deque([globals.sourceentry])
+    while queue:
+        sourcefile = queue.popleft()
+        if manifest.files:
+            source_hashes[sourcefile] = file_hash(os.path.join(sourcedir, sourcefile))
+        recorded = (
+            manifest.recorded_dependencies(sourcefile, source_hashes[sourcefile])
+            if sourcefile in source_hashes
+            else None
+        )
+        seconds = 0.0
+        if recorded is not None:
+            internal_deps_list = recorded[0]
+        else:
+            if find_imported_packages(sourcefile, sourcedir) is None:
+                prompt_length = rendered_length(external_template, sourcefile_content=size(sourcefile), **common)
+                seconds = estimate.add("dependencies", model, prompt_length, ESTIMATED_DEPENDENCY_OUTPUT_TOKENS)
+            internal_deps_list = find_internal_dependencies(sourcefile, sourcedir)
+            if internal_deps_list is None:
+                prompt_length = rendered_length(
+                    internal_template, sourcefile=len(sourcefile), sourcefile_content=size(sourcefile), **common
+                )
+                seconds = max(
+                    seconds, estimate.add("dependencies", model, prompt_length, ESTIMATED_DEPENDENCY_OUTPUT_TOKENS)
+                )
+                internal_deps_list = []
+                estimate.unresolved_files += 1
+        graph.add_file(
+            sourcefile, [dep for dep in internal_deps_list if os.path.isfile(os.path.join(sourcedir, dep))], []
+        )
+        known_at[sourcefile] = found_at[sourcefile] + seconds
+        for dep in graph.deps[sourcefile]:
+            if dep not in found_at:
+                found_at[dep] = known_at[sourcefile]
+                queue.append(dep)
+
+    # Third-party packages not mapped by an earlier run are mapped in one request before discovery starts.
+    # A real run reads the imports of every source file in the entrypoint's language; only the discovered
+    # files are read here, which keeps planning fast on large trees.
+    map_seconds = 0.0
+    entry_language = EXTENSION_TO_LANGUAGE.get(globals.sourceentry.split(".")[-1])
+    sourcefiles = [
+        sourcefile
+        for sourcefile in graph.deps
+        if entry_language and EXTENSION_TO_LANGUAGE.get(sourcefile.split(".")[-1]) == entry_language
+    ]
+    equivalents = load_package_equivalents(globals.sourcelang, globals.targetlang)
+    unknown_packages = [
+        package for package in detect_source_packages(sourcedir, sourcefiles) if package not in equivalents
+    ]
+    if unknown_packages:
+        template = prompt_constructor(HIERARCHY, GUIDELINES, MAP_EXTERNAL_DEPS)
+        map_seconds = estimate.add(
+            "package map",
+            model,
+            rendered_length(template, source_packages=sum(len(package) + 1 for package in unknown_packages), **common),
+            ESTIMATED_DEPENDENCY_OUTPUT_TOKENS * len(unknown_packages),
+        )
+
+    if manifest.files:
+        stale = manifest.stale_files(graph, source_hashes)
+    else:
+        stale = set(graph.deps)
+    estimate.files = len(graph.deps)
+    estimate.stale_files = len(stale)
+
+    # Generation and signature extraction of every stale file
+    write_template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, WRITE_MIGRATION, SINGLEFILE)
+    header_template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, WRITE_MIGRATION_HEADER, SINGLEFILE)
+    part_template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, WRITE_MIGRATION_PART, SINGLEFILE)
+    signatures_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_FUNCTION_SIGNATURES)
+    describe_template = prompt_constructor(HIERARCHY, GUIDELINES, DESCRIBE_FUNCTION_SIGNATURES)
+    signatures_parsed = target_extension(globals.targetlang) in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO
+
+    # every file to be split is parsed up front, on every core
+    large_files = [sourcefile for sourcefile in stale if count_tokens(size(sourcefile)) > MIGRATION_CHUNK_TOKENS]
+    outlines = dict(decompose_repository(sourcedir, large_files))
+
+    work_seconds = {}
+    for sourcefile in graph.deps:
+        if sourcefile not in stale:
+            work_seconds[sourcefile] = 0.0
+            continue
+        source_tokens = count_tokens(size(sourcefile))
+        target_tokens = source_tokens * TARGET_TOKENS_PER_SOURCE_TOKEN
+        signatures_characters = sum(size(dep) for dep in graph.deps[sourcefile]) * SIGNATURE_TOKENS_PER_SOURCE_TOKEN
+        fields = {**common, "sourcefile": len(sourcefile), "targetlang_function_signatures": signatures_characters}
+        chunks = None
+        if source_tokens > MIGRATION_CHUNK_TOKENS:
+            chunks = split_source_file(
+                os.path.join(sourcedir, sourcefile), MIGRATION_CHUNK_TOKENS, outlines.get(sourcefile)
+            )
+        if chunks is None:
+            seconds = estimate.add(
+                "migration",
+                model,
+                rendered_length(write_template, sourcefile_content=size(sourcefile), **fields),
+                target_tokens,
+            )
+        else:
+            header, parts, definitions, notes = chunks
+            header_tokens = count_tokens(len(header)) * TARGET_TOKENS_PER_SOURCE_TOKEN
+            seconds = estimate.add(
+                "migration",
+                model,
+                rendered_length(
+                    header_template,
+                    header_content=len(header),
+                    outline=sum(len(definition) + 1 for definition in definitions),
+                    **fields,
+                ),
+                header_tokens,
+            )
+            seconds += max(
+                estimate.add(
+                    "migration",
+                    model,
+                    rendered_length(
+                        part_template,
+                        target_file_name=len(sourcefile),
+                        part_number=len(str(len(parts))),
+                        part_count=len(str(len(parts))),
+                        header_content=len(header),
+                        target_header=header_tokens * CHARS_PER_TOKEN,
+                        part_content=len(part),
+                        part_note=len(note),
+                        **fields,
+                    ),
+                    count_tokens(len(part)) * TARGET_TOKENS_PER_SOURCE_TOKEN,
+                )
+                for part, note in zip(parts, notes)
+            )
+
+        target_characters = target_tokens * CHARS_PER_TOKEN
+        signature_tokens = target_tokens * SIGNATURE_TOKENS_PER_SOURCE_TOKEN
+        if not signatures_parsed:
+            seconds += estimate.add(
+                "signatures",
+                model,
+                rendered_length(signatures_template, targetfile_content=target_characters, **common),
+                signature_tokens,
+            )
+        elif globals.signature_ai is not None:
+            seconds += estimate.add(
+                "signature descriptions",
+                globals.signature_ai.model_name,
+                rendered_length(
+                    describe_template,
+                    targetfile_content=target_characters,
+                    signatures=signature_tokens * CHARS_PER_TOKEN,
+                    **common,
+                ),
+                signature_tokens,
+            )
+        work_seconds[sourcefile] = seconds
+
+    # A group of files starts once it is discovered and everything it depends on is migrated
+    finished_at = {}
+    for group in graph.strongly_connected_components():
+        start = max(
+            [map_seconds + known_at[sourcefile] for sourcefile in group]
+            + [finished_at[dep] for sourcefile in group for dep in graph.deps[sourcefile] if dep not in group]
+        )
+        end = start + max(work_seconds[sourcefile] for sourcefile in group)
+        for sourcefile in group:
+            finished_at[sourcefile] = end
+    migration_seconds = max(finished_at.values(), default=map_seconds)
+
+    # Environment files are written once both the migration and the setup are done
+    template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, ADD_DOCKER_REQUIREMENTS, SINGLEFILE)
+    env_seconds = estimate.add(
+        "environment",
+        model,
+        rendered_length(template, dockerfile_content=dockerfile_characters, **common),
+        ESTIMATED_DEPENDENCY_OUTPUT_TOKENS * 10,
+    )
+    template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, REFINE_DOCKERFILE, SINGLEFILE)
+    env_seconds += estimate.add(
+        "environment",
+        model,
+        rendered_length(
+            template,
+            dockerfile_content=dockerfile_characters,
+            external_deps_content=ESTIMATED_DEPENDENCY_OUTPUT_TOKENS * 10 * CHARS_PER_TOKEN,
+            **common,
+        ),
+        ESTIMATED_DOCKERFILE_OUTPUT_TOKENS,
+    )
+    estimate.critical_path_seconds = max(migration_seconds, *side_seconds) + env_seconds
+    return estimate
@@ -0,0 +1,246 @@
+"""Tree-sitter grammar libraries: a prebuilt offline bundle, or built on demand once in a per-user cache."""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from functools import cache
+from importlib.metadata import version
+
+from config import (
+    EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO,
+    GRAMMAR_BUILD_MISSING,
+    GRAMMAR_BUNDLE_DIR,
+    GRAMMAR_CACHE_DIR,
+    TREE_SITTER_GRAMMAR_SUBDIRS,
+)
+from tree_sitter import Language
+
+TREE_SITTER_VERSION = version("tree-sitter")
+
+BUNDLE_LIBRARY = "grammars.so"
+BUNDLE_MANIFEST = "manifest.json"
+
+_build_lock = threading.Lock()
+
+
+def grammar_cache_dir():
+    return os.path.expanduser(GRAMMAR_CACHE_DIR)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path, shared with every other process locking the same file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as lock_file:
+        try:
+            import fcntl
+        except ImportError:
+            # no advisory locks on this platform; builds are still atomic, only possibly repeated
+            yield
+            return
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def grammar_language_name(extension):
+    """Name of the language in the grammar for extension, e.g. "c_sharp" or "tsx" """
+    repo_name = EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO[extension].split("/")[-1]
+    name = TREE_SITTER_GRAMMAR_SUBDIRS.get(extension, repo_name)
+    return name.removeprefix("tree-sitter-").replace("-", "_")
+
+
+def grammar_repo(extension):
+    """Local clone of the grammar repository for extension, cloned on first use"""
+    repo_url = EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO[extension]
+    repo_name = repo_url.split("/")[-1]
+    repos_dir = os.path.join(grammar_cache_dir(), "repos")
+    repo_dir = os.path.join(repos_dir, repo_name)
+    if not os.path.isdir(repo_dir):
+        with file_lock(os.path.join(grammar_cache_dir(), "locks", repo_name + ".lock")):
+            if not os.path.isdir(repo_dir):
+                os.makedirs(repos_dir, exist_ok=True)
+                tmp_dir = f"{repo_dir}.{os.getpid()}.tmp"
+                subprocess.run(
+                    ["git", "clone", "--depth", "1", repo_url, tmp_dir],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    check=True,
+                    text=True,
+                )
+                os.replace(tmp_dir, repo_dir)
+    return repo_dir
+
+
+@cache
+def grammar_commit(repo_dir):
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=repo_dir, stdout=subprocess.PIPE, check=True, text=True
+    ).stdout.strip()
+
+
+def _grammar_dir(repo_dir, extension):
+    if extension in TREE_SITTER_GRAMMAR_SUBDIRS:
+        return os.path.join(repo_dir, TREE_SITTER_GRAMMAR_SUBDIRS[extension])
+    return repo_dir
+
+
+def grammar_library(extension):
+    """Path of the shared library of the grammar for extension, built unless already in the cache.
+
+    Libraries are keyed by the grammar's commit and the tree-sitter version, so upgrading either
+    builds a new one. A file lock makes concurrent processes wait for one build instead of racing.
+    """
+    repo_dir = grammar_repo(extension)
+    grammar_dir = _grammar_dir(repo_dir, extension)
+    language_name = grammar_language_name(extension)
+    library_name = f"{language_name}-{grammar_commit(repo_dir)[:12]}-ts{TREE_SITTER_VERSION}.so"
+    library_path = os.path.join(grammar_cache_dir(), "libraries", library_name)
+    if not os.path.exists(library_path):
+        with file_lock(os.path.join(grammar_cache_dir(), "locks", library_name + ".lock")):
+            if not os.path.exists(library_path):
+                tmp_path = f"{library_path}.{os.getpid()}.tmp.so"
+                Language.build_library(tmp_path, [grammar_dir])
+                os.replace(tmp_path, library_path)
+    return library_path
+
+
+def _source_revision(repo_dir, grammar_dir):
+    """The commit of a grammar checkout, or a hash of its generated parser if it was vendored without git"""
+    if os.path.isdir(os.path.join(repo_dir, ".git")):
+        return grammar_commit(repo_dir)
+    with open(os.path.join(grammar_dir, "src", "parser.c"), "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _bundle_pointer(bundle_dir):
+    # a bundle only loads with the tree-sitter version it was built for, so each version has its own
+    return os.path.join(bundle_dir, f"current-ts{TREE_SITTER_VERSION}")
+
+
+def build_bundle(bundle_dir=GRAMMAR_BUNDLE_DIR, sources=None, extensions=None):
+    """Build every grammar into one shared library, in a bundle that becomes the current one. Returns its path.
+
+    Grammars come from checkouts named after their repositories in sources, for hosts without network
+    access, or else from the per-user clones, cloned if needed. The bundle's directory is named after
+    the tree-sitter version and the revisions of its grammars, so building the same grammars again
+    reuses it, and it can be copied as-is to other hosts with the same tree-sitter version.
+    """
+    bundle_dir = os.path.expanduser(bundle_dir)
+    grammars = {}
+    for extension in extensions or EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO:
+        repo_url = EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO[extension]
+        if sources is not None:
+            repo_dir = os.path.join(os.path.expanduser(sources), repo_url.split("/")[-1])
+        else:
+            repo_dir = grammar_repo(extension)
+        grammar_dir = _grammar_dir(repo_dir, extension)
+        revision = _source_revision(repo_dir, grammar_dir)
+        grammar = grammars.setdefault(
+            grammar_language_name(extension),
+            {"repo": repo_url, "revision": revision, "dir": grammar_dir, "extensions": []},
+        )
+        grammar["extensions"].append(extension)
+
+    revisions = json.dumps({language: grammar["revision"] for language, grammar in grammars.items()}, sort_keys=True)
+    digest = hashlib.sha256(revisions.encode()).hexdigest()[:12]
+    bundle_name = f"ts{TREE_SITTER_VERSION}-{digest}"
+    bundle_path = os.path.join(bundle_dir, bundle_name)
+    with file_lock(os.path.join(bundle_dir, "build.lock")):
+        if not os.path.exists(os.path.join(bundle_path, BUNDLE_MANIFEST)):
+            tmp_dir = f"{bundle_path}.{os.getpid()}.tmp"
+            os.makedirs(tmp_dir, exist_ok=True)
+            try:
+                Language.build_library(
+                    os.path.join(tmp_dir, BUNDLE_LIBRARY), [grammar["dir"] for grammar in grammars.values()]
+                )
+                manifest = {
+                    "tree_sitter": TREE_SITTER_VERSION,
+                    "library": BUNDLE_LIBRARY,
+                    "grammars": {
+                        language: {key: grammar[key] for key in ("repo", "revision", "extensions")}
+                        for language, grammar in grammars.items()
+                    },
+                }
+                with open(os.path.join(tmp_dir, BUNDLE_MANIFEST), "w") as file:
+                    json.dump(manifest, file, indent=2, sort_keys=True)
+                shutil.rmtree(bundle_path, ignore_errors=True)
+                os.replace(tmp_dir, bundle_path)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        pointer = _bundle_pointer(bundle_dir)
+        with open(pointer + ".tmp", "w") as file:
+            file.write(bundle_name + "\n")
+        os.replace(pointer + ".tmp", pointer)
+    load_bundle.cache_clear()
+    grammar_version.cache_clear()
+    return bundle_path
+
+
+@cache
+def load_bundle(bundle_dir=GRAMMAR_BUNDLE_DIR):
+    """(library path, revision of each language it holds) of the current bundle for this tree-sitter version, or None"""
+    bundle_dir = os.path.expanduser(bundle_dir)
+    try:
+        with open(_bundle_pointer(bundle_dir)) as file:
+            bundle_path = os.path.join(bundle_dir, file.read().strip())
+        with open(os.path.join(bundle_path, BUNDLE_MANIFEST)) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("tree_sitter") != TREE_SITTER_VERSION:
+        return None
+    revisions = {language: grammar["revision"] for language, grammar in manifest["grammars"].items()}
+    return os.path.join(bundle_path, manifest["library"]), revisions
+
+
+def _require_build(language_name):
+    if not GRAMMAR_BUILD_MISSING:
+        raise RuntimeError(
+            f"The tree-sitter grammar for {language_name} is not in the grammar bundle and building it is"
+            " disabled. Run provision.py on a host with network access and copy the bundle over."
+        )
+
+
+@cache
+def get_language(extension):
+    """The tree-sitter Language for a file extension, loaded once per process.
+
+    Languages in the bundle come straight from its library, which the dynamic loader maps into memory
+    on first use and pages in lazily, so nothing is cloned or compiled. Other grammars are built into
+    the per-user cache, unless GRAMMAR_BUILD_MISSING is off.
+    """
+    language_name = grammar_language_name(extension)
+    bundle = load_bundle()
+    if bundle is not None and language_name in bundle[1]:
+        library_path = bundle[0]
+    else:
+        _require_build(language_name)
+        library_path = None
+    with _build_lock:
+        return Language(library_path or grammar_library(extension), language_name)
+
+
+@cache
+def grammar_version(extension):
+    """Identifies the grammar parsing extension and the tree-sitter version, e.g. "python@4bfdd9033a2c/ts0.21.3".
+
+    Anything derived from a parse tree stays valid for as long as this doesn't change. Raises, like
+    get_language, for a grammar missing from the bundle when building it is disabled.
+    """
+    language_name = grammar_language_name(extension)
+    bundle = load_bundle()
+    if bundle is not None and language_name in bundle[1]:
+        revision = bundle[1][language_name]
+    else:
+        # never clone a grammar just to learn its version when it couldn't be built anyway
+        _require_build(language_name)
+        revision = grammar_commit(grammar_repo(extension))
+    return f"{language_name}@{revision[:12]}/ts{TREE_SITTER_VERSION}"
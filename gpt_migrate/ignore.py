@@ -0,0 +1,198 @@
+"""Compiled .gitignore rules for a directory tree, and a walk that never descends into ignored directories."""
+
+import os
+import re
+from collections import deque
+
+# Never part of a project, whatever its .gitignore says
+ALWAYS_IGNORED = [".git/"]
+
+
+class IgnoreRule:
+    """One .gitignore line, as a regex over paths relative to the root of the tree"""
+
+    def __init__(self, pattern, base=""):
+        self.negated = pattern.startswith("!")
+        if self.negated:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        # a slash anywhere but at the end anchors the pattern to the directory of its .gitignore
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        prefix = re.escape(base) + "/" if base else ""
+        self.regex = f"{prefix}{'' if anchored else '(?:.*/)?'}{_translate(pattern)}"
+
+
+def _translate(pattern):
+    """Regex for a gitignore glob: * and ? stop at slashes, ** spans directories"""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            double = pattern.startswith("**", i)
+            if double and (i == 0 or pattern[i - 1] == "/") and (i + 2 == n or pattern[i + 2] == "/"):
+                if i + 2 == n:
+                    out.append(".*")
+                    i += 2
+                else:
+                    out.append("(?:.*/)?")
+                    i += 3
+                continue
+            while i < n and pattern[i] == "*":
+                i += 1
+            out.append("[^/]*")
+            continue
+        if c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            # a ] right after the opening bracket, or after its negation, is part of the set
+            end = pattern.find("]", i + 3 if pattern.startswith(("[!", "[^"), i) else i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : end].replace("[", "\\[")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                out.append(f"(?!/)[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def parse_gitignore(text):
+    """The patterns of a .gitignore file, in order"""
+    patterns = []
+    for line in text.splitlines():
+        if not line.endswith("\\ "):
+            line = line.rstrip()
+        if line and not line.startswith("#"):
+            patterns.append(line)
+    return patterns
+
+
+class _Level:
+    """Every rule that applies in one directory, compiled into two regexes checked in a single match.
+
+    Alternatives are ordered last rule first, so the alternative that matches is the rule git would
+    apply: later lines override earlier ones and deeper .gitignore files override shallower ones.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._for_dirs = self._compile(range(len(rules)))
+        self._for_files = self._compile([index for index, rule in enumerate(rules) if not rule.dir_only])
+
+    def _compile(self, indexes):
+        if not indexes:
+            return None
+        alternatives = [f"(?P<r{index}>{self.rules[index].regex})" for index in reversed(indexes)]
+        return re.compile(f"(?:{'|'.join(alternatives)})\\Z", re.DOTALL)
+
+    def ignored(self, relative_path, is_dir):
+        regex = self._for_dirs if is_dir else self._for_files
+        if regex is None:
+            return False
+        match = regex.match(relative_path)
+        return match is not None and not self.rules[int(match.lastgroup[1:])].negated
+
+
+class IgnoreMatcher:
+    """The .gitignore files of a tree, loaded as the walk reaches their directories, plus extra patterns.
+
+    Extra patterns, in .gitignore syntax, apply everywhere and win over every .gitignore file. Paths
+    are relative to root with forward slashes. As in git, a path inside an ignored directory is
+    ignored too, which callers get for free by not descending into directories found ignored.
+    """
+
+    def __init__(self, root, extra_patterns=(), use_gitignore=True):
+        self.root = os.path.abspath(root)
+        self.use_gitignore = use_gitignore
+        self._extra = [IgnoreRule(pattern) for pattern in [*ALWAYS_IGNORED, *extra_patterns]]
+        # directory -> (rules of the .gitignore files down to it, compiled level)
+        self._levels = {}
+        self._gitignore_mtimes = {}
+
+    def _gitignore_rules(self, relative_dir):
+        path = os.path.join(self.root, relative_dir, ".gitignore")
+        try:
+            self._gitignore_mtimes[relative_dir] = os.stat(path).st_mtime_ns
+            with open(path, errors="replace") as file:
+                return [IgnoreRule(pattern, relative_dir) for pattern in parse_gitignore(file.read())]
+        except OSError:
+            self._gitignore_mtimes[relative_dir] = None
+            return []
+
+    def _level(self, relative_dir):
+        cached = self._levels.get(relative_dir)
+        if cached is not None:
+            return cached
+        if relative_dir:
+            inherited, parent_level = self._level(relative_dir.rpartition("/")[0])
+        else:
+            inherited, parent_level = [], None
+        own = self._gitignore_rules(relative_dir) if self.use_gitignore else []
+        if own or parent_level is None:
+            rules = inherited + own
+            cached = (rules, _Level(rules + self._extra))
+        else:
+            # most directories have no .gitignore and share the compiled rules of their parent
+            cached = (inherited, parent_level)
+        self._levels[relative_dir] = cached
+        return cached
+
+    def ignored(self, relative_path, is_dir=False):
+        return self._level(relative_path.rpartition("/")[0])[1].ignored(relative_path, is_dir)
+
+    def stale(self):
+        """True if a .gitignore file loaded so far, or missing so far, changed since"""
+        for relative_dir, mtime_ns in list(self._gitignore_mtimes.items()):
+            try:
+                current = os.stat(os.path.join(self.root, relative_dir, ".gitignore")).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime_ns:
+                return True
+        return False
+
+    def walk(self, relative_dir="", breadth_first=False):
+        """Yield (relative_dir, dirs, files) for every directory not ignored, top-down, like os.walk.
+
+        dirs and files are lists of os.DirEntry; remove entries from dirs to skip descending into
+        them. Symlinked directories are followed once. breadth_first visits shallow directories before
+        deep ones, for callers that may stop early and want a sample of the whole tree.
+        """
+        seen = set()
+        pending = deque([relative_dir])
+        while pending:
+            relative_dir = pending.popleft() if breadth_first else pending.pop()
+            dirs, files = [], []
+            try:
+                with os.scandir(os.path.join(self.root, relative_dir)) as scanner:
+                    for entry in scanner:
+                        entry_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            continue
+                        if self.ignored(entry_path, is_dir):
+                            continue
+                        if is_dir and entry.is_symlink():
+                            key = (entry.stat().st_dev, entry.stat().st_ino)
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                        (dirs if is_dir else files).append(entry)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            yield relative_dir, dirs, files
+            pending.extend(
+                f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                for entry in (dirs if breadth_first else reversed(dirs))
+            )
@@ -0,0 +1,649 @@
+"""Static extraction of import statements and their resolution against the source tree.
+
+find_internal_dependencies() returns the internal dependency files of a source file, or None when the
+imports cannot be resolved unambiguously; callers then fall back to asking the LLM.
+"""
+
+import os
+import posixpath
+import re
+import sys
+from collections import defaultdict
+from functools import cache, lru_cache
+from parser import get_parser
+
+from config import EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO
+from outlines import decode_spans, encode_spans, get_outline_cache
+
+JS_EXTENSIONS = (".js", ".jsx", ".ts", ".tsx", ".mjs", ".cjs")
+
+# Top-level or nested parse tree node types that hold import statements, per file extension
+IMPORT_NODE_TYPES = {
+    "py": {"import_statement", "import_from_statement"},
+    "js": {"import_statement", "export_statement", "call_expression"},
+    "java": {"import_declaration"},
+    "rb": {"call"},
+    "php": {
+        "require_expression",
+        "require_once_expression",
+        "include_expression",
+        "include_once_expression",
+        "namespace_use_declaration",
+    },
+    "go": {"import_declaration"},
+    "rs": {"mod_item", "use_declaration", "extern_crate_declaration"},
+    "c": {"preproc_include"},
+    "scala": {"import_declaration"},
+    "hs": {"import"},
+    "jl": {"import_statement", "using_statement", "call_expression"},
+}
+
+# Extensions that share import syntax with another language
+EXTENSION_ALIASES = {
+    "jsx": "js",
+    "ts": "js",
+    "tsx": "js",
+    "cpp": "c",
+    "cc": "c",
+    "cxx": "c",
+}
+
+
+_unavailable_grammars = set()
+
+
+class AmbiguousImportError(Exception):
+    pass
+
+
+class SourceIndex:
+    """Relative paths of every file in the source tree, with lookups by path suffix"""
+
+    def __init__(self, sourcedir):
+        self.sourcedir = sourcedir
+        self.files = set()
+        self.dirs = set()
+        self.by_name = defaultdict(list)
+        for root, dirnames, filenames in os.walk(sourcedir):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".") and d != "node_modules"]
+            relative_root = os.path.relpath(root, sourcedir).replace(os.sep, "/")
+            relative_root = "" if relative_root == "." else relative_root
+            if relative_root:
+                self.dirs.add(relative_root)
+            for filename in filenames:
+                path = posixpath.join(relative_root, filename)
+                self.files.add(path)
+                self.by_name[filename].append(path)
+
+    def exists(self, path):
+        return posixpath.normpath(path) in self.files
+
+    def with_suffix(self, suffix):
+        name = suffix.split("/")[-1]
+        return [path for path in self.by_name.get(name, []) if path == suffix or path.endswith("/" + suffix)]
+
+    def has_dir_suffix(self, suffix):
+        return any(d == suffix or d.endswith("/" + suffix) for d in self.dirs)
+
+    def siblings(self, path, extensions):
+        directory = posixpath.dirname(path)
+        return [
+            other
+            for other in self.files
+            if other != path and posixpath.dirname(other) == directory and other.endswith(extensions)
+        ]
+
+
+@cache
+def get_source_index(sourcedir):
+    """The index of sourcedir, built once per run; run_steps clears it, as files may have changed since"""
+    return SourceIndex(sourcedir)
+
+
+def find_internal_dependencies(sourcefile, sourcedir):
+    """Internal dependency files of sourcefile relative to sourcedir, or None if the LLM has to decide"""
+    extension = sourcefile.split(".")[-1]
+    language = EXTENSION_ALIASES.get(extension, extension)
+    if language not in RESOLVERS or extension not in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO:
+        return None
+    if extension in _unavailable_grammars:
+        return None
+
+    try:
+        statements = extract_import_statements(os.path.join(sourcedir, sourcefile))
+    except Exception:
+        # grammar could not be fetched or built; don't try again for every file
+        _unavailable_grammars.add(extension)
+        return None
+
+    index = get_source_index(sourcedir)
+    sourcefile = sourcefile.replace(os.sep, "/")
+    resolver = RESOLVERS[language]
+    deps = []
+    try:
+        for statement in statements:
+            deps.extend(resolver(statement, sourcefile, index))
+        if language in ("java", "scala", "go"):
+            deps.extend(_same_package_deps(sourcefile, index, language))
+    except AmbiguousImportError:
+        return None
+    return [dep for dep in dict.fromkeys(posixpath.normpath(dep) for dep in deps) if dep != sourcefile]
+
+
+def find_imported_packages(sourcefile, sourcedir):
+    """Third-party packages imported by sourcefile, or None if they can't be read statically"""
+    extension = sourcefile.split(".")[-1]
+    language = EXTENSION_ALIASES.get(extension, extension)
+    if language not in PACKAGE_EXTRACTORS or extension not in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO:
+        return None
+    if extension in _unavailable_grammars:
+        return None
+
+    try:
+        statements = extract_import_statements(os.path.join(sourcedir, sourcefile))
+    except Exception:
+        _unavailable_grammars.add(extension)
+        return None
+
+    index = get_source_index(sourcedir)
+    sourcefile = sourcefile.replace(os.sep, "/")
+    packages = []
+    try:
+        for statement in statements:
+            packages.extend(PACKAGE_EXTRACTORS[language](statement, sourcefile, index))
+    except AmbiguousImportError:
+        # e.g. a module name that matches several local files; the LLM reads the imports instead
+        return None
+    return list(dict.fromkeys(packages))
+
+
+def extract_import_statements(file_path):
+    """Source text of every import statement in the file, in order. Their spans are cached by content."""
+    stat = os.stat(file_path)
+    # keyed by modification time and size too, so long-lived processes see edited files
+    return _import_statements(file_path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=4096)
+def _import_statements(file_path, mtime_ns, size):
+    extension = file_path.split(".")[-1]
+    node_types = IMPORT_NODE_TYPES[EXTENSION_ALIASES.get(extension, extension)]
+    with open(file_path, "rb") as file:
+        source = file.read()
+
+    cache = get_outline_cache()
+    # spans found with other node types are not reused
+    key = cache.key("imports:" + ",".join(sorted(node_types)), extension, source)
+    spans = cache.get(key, decode_spans) if key is not None else None
+    if spans is None:
+        spans = []
+        stack = [get_parser(extension).parse(source).root_node]
+        while stack:
+            node = stack.pop()
+            if node.type in node_types:
+                spans.append((node.start_byte, node.end_byte))
+                if node.type not in ("call_expression", "call"):
+                    continue
+            stack.extend(reversed(node.children))
+        if key is not None:
+            cache.put(key, encode_spans(spans))
+    return [source[start:end].decode("utf8", errors="replace").replace("\r\n", "\n") for start, end in spans]
+
+
+def _candidates(index, paths):
+    return list(dict.fromkeys(posixpath.normpath(path) for path in paths if index.exists(path)))
+
+
+def _single(matches):
+    if len(matches) > 1:
+        raise AmbiguousImportError()
+    return matches
+
+
+def _resolve_python(statement, sourcefile, index):
+    statement = re.sub(r"#.*", "", statement).replace("\\\n", " ")
+    match = re.match(r"\s*from\s+(\.*)([\w.]*)\s+import\s+\(?([^)]*)\)?", statement, re.DOTALL)
+    if match:
+        level, module, names = len(match.group(1)), match.group(2), match.group(3)
+        names = [name.split(" as ")[0].strip() for name in names.split(",")]
+        modules = [module + "." + name if module else name for name in names if name and name != "*"]
+        found = []
+        for submodule in modules:
+            found.extend(_python_module(level, submodule, sourcefile, index, required=False))
+        if not found and (module or level):
+            found = _python_module(level, module, sourcefile, index, required=bool(module) and level > 0)
+        return found
+
+    match = re.match(r"\s*import\s+(.+)", statement, re.DOTALL)
+    if not match:
+        return []
+    found = []
+    for name in match.group(1).split(","):
+        module = name.split(" as ")[0].strip()
+        if module:
+            found.extend(_python_module(0, module, sourcefile, index, required=False))
+    return found
+
+
+def _python_module(level, module, sourcefile, index, required):
+    if level:
+        base = posixpath.dirname(sourcefile)
+        for _ in range(level - 1):
+            base = posixpath.dirname(base)
+        bases = [base]
+    else:
+        bases = list(dict.fromkeys(["", posixpath.dirname(sourcefile)]))
+
+    path = module.replace(".", "/")
+    paths = []
+    for base in bases:
+        if path:
+            paths.append(posixpath.join(base, path + ".py"))
+        paths.append(posixpath.join(base, path, "__init__.py"))
+    found = _single(_candidates(index, paths))
+    if required and not found:
+        raise AmbiguousImportError()
+    return found
+
+
+def _resolve_js(statement, sourcefile, index):
+    if re.match(r"\s*(import|export)\b(?!\s*\()", statement):
+        specifiers = re.findall(r"""(?:\bfrom|^\s*import)\s*['"]([^'"]+)['"]""", statement, re.MULTILINE)
+    else:
+        match = re.match(r"""\s*(?:require|import)\s*\(\s*(['"`])?([^'"`)]*)""", statement)
+        if not match:
+            return []
+        if not match.group(1) or "${" in match.group(2):
+            # require(someVariable)
+            raise AmbiguousImportError()
+        specifiers = [match.group(2)]
+    found = []
+    for specifier in specifiers:
+        if specifier.startswith("/"):
+            raise AmbiguousImportError()
+        if not specifier.startswith("."):
+            continue
+        base = posixpath.normpath(posixpath.join(posixpath.dirname(sourcefile), specifier))
+        paths = [base] + [base + ext for ext in JS_EXTENSIONS] + [base + "/index" + ext for ext in JS_EXTENSIONS]
+        matches = [path for path in paths if index.exists(path)]
+        if not matches:
+            raise AmbiguousImportError()
+        found.append(matches[0])
+    return found
+
+
+def _resolve_dotted_path(parts, extension, index):
+    # Longest prefix of a dotted module path that names a file, e.g. a.b.C.member -> a/b/C.java
+    for end in range(len(parts), 0, -1):
+        matches = index.with_suffix("/".join(parts[:end]) + extension)
+        if matches:
+            return _single(matches)
+    if len(parts) > 1 and index.has_dir_suffix("/".join(parts[:-1])):
+        raise AmbiguousImportError()
+    return []
+
+
+def _resolve_java(statement, sourcefile, index):
+    match = re.match(r"\s*import\s+(?:static\s+)?([\w.]+?)(\.\*)?\s*;", statement)
+    if not match:
+        return []
+    parts = match.group(1).split(".")
+    if match.group(2):
+        if index.has_dir_suffix("/".join(parts)):
+            raise AmbiguousImportError()
+        return []
+    return _resolve_dotted_path(parts, ".java", index)
+
+
+def _resolve_scala(statement, sourcefile, index):
+    found = []
+    for clause in re.sub(r"^\s*import\s+", "", statement).split(","):
+        clause = clause.strip()
+        match = re.match(r"([\w.]+?)\.\{([^}]*)\}", clause)
+        if match:
+            names = [name.split("=>")[0].strip() for name in match.group(2).split(",")]
+            paths = [match.group(1) + "." + name for name in names if name and name != "_"]
+        else:
+            paths = [clause]
+        for path in paths:
+            parts = path.split(".")
+            if parts[-1] == "_":
+                if index.has_dir_suffix("/".join(parts[:-1])):
+                    raise AmbiguousImportError()
+                continue
+            found.extend(_resolve_dotted_path(parts, ".scala", index))
+    return found
+
+
+def _resolve_haskell(statement, sourcefile, index):
+    match = re.match(r"\s*import\s+(?:qualified\s+)?([\w.]+)", statement)
+    if not match:
+        return []
+    return _single(index.with_suffix(match.group(1).replace(".", "/") + ".hs"))
+
+
+def _resolve_go(statement, sourcefile, index):
+    module = _go_module(index)
+    found = []
+    for specifier in re.findall(r'"([^"]+)"', statement):
+        if module and (specifier == module or specifier.startswith(module + "/")):
+            directory = specifier[len(module) :].strip("/")
+        elif not module and "." not in specifier.split("/")[0] and index.has_dir_suffix(specifier):
+            raise AmbiguousImportError()
+        else:
+            continue
+        package_files = [
+            path
+            for path in index.files
+            if posixpath.dirname(path) == directory and path.endswith(".go") and not path.endswith("_test.go")
+        ]
+        if not package_files:
+            raise AmbiguousImportError()
+        found.extend(package_files)
+    return found
+
+
+def _go_module(index):
+    if not index.exists("go.mod"):
+        return None
+    with open(os.path.join(index.sourcedir, "go.mod")) as file:
+        match = re.search(r"^module\s+(\S+)", file.read(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def _resolve_rust(statement, sourcefile, index):
+    module_dir = _rust_module_dir(sourcefile)
+    match = re.match(r"\s*(?:#\[[^\]]*\]\s*)*(?:pub(?:\([^)]*\))?\s+)?mod\s+(\w+)\s*;", statement)
+    if match:
+        name = match.group(1)
+        found = _candidates(
+            index, [posixpath.join(module_dir, name + ".rs"), posixpath.join(module_dir, name, "mod.rs")]
+        )
+        if not found:
+            raise AmbiguousImportError()
+        return found[:1]
+
+    match = re.match(r"\s*(?:pub(?:\([^)]*\))?\s+)?use\s+(.+?);?\s*$", statement, re.DOTALL)
+    if not match:
+        return []
+    found = []
+    for path in _expand_rust_use(match.group(1)):
+        found.extend(_resolve_rust_path(path, sourcefile, module_dir, index))
+    return found
+
+
+def _expand_rust_use(tree):
+    # a::{b, c::{d, e}} -> a::b, a::c::d, a::c::e
+    tree = re.sub(r"\s+", "", re.sub(r"\s+as\s+\w+", "", tree))
+    if "{" not in tree:
+        return [tree]
+    prefix, rest = tree.split("{", 1)
+    inner = rest[: rest.rfind("}")]
+    items, depth, current = [], 0, ""
+    for char in inner:
+        if char == "," and depth == 0:
+            items.append(current)
+            current = ""
+            continue
+        depth += char == "{"
+        depth -= char == "}"
+        current += char
+    items.append(current)
+    return [path for item in items if item for path in _expand_rust_use(prefix + item)]
+
+
+def _resolve_rust_path(path, sourcefile, module_dir, index):
+    parts = [part for part in path.split("::") if part and part != "*"]
+    if len(parts) > 1 and parts[-1] == "self":
+        parts = parts[:-1]
+    if not parts:
+        return []
+    if parts[0] == "crate":
+        base, parts = _rust_crate_root(sourcefile, index), parts[1:]
+    elif parts[0] == "self":
+        base, parts = module_dir, parts[1:]
+    elif parts[0] == "super":
+        base = module_dir
+        while parts and parts[0] == "super":
+            base, parts = posixpath.dirname(base), parts[1:]
+        if not parts:
+            return _candidates(index, [base + ".rs", posixpath.join(base, "mod.rs")])[:1]
+    else:
+        return []
+    for end in range(len(parts), 0, -1):
+        module_path = posixpath.join(base, *parts[:end])
+        found = _candidates(index, [module_path + ".rs", posixpath.join(module_path, "mod.rs")])
+        if found:
+            return found[:1]
+    if parts:
+        raise AmbiguousImportError()
+    return []
+
+
+def _rust_module_dir(sourcefile):
+    directory, filename = posixpath.split(sourcefile)
+    if filename in ("mod.rs", "lib.rs", "main.rs"):
+        return directory
+    return posixpath.join(directory, filename[: -len(".rs")])
+
+
+def _rust_crate_root(sourcefile, index):
+    directory = posixpath.dirname(sourcefile)
+    while True:
+        if index.exists(posixpath.join(directory, "lib.rs")) or index.exists(posixpath.join(directory, "main.rs")):
+            return directory
+        if not directory:
+            raise AmbiguousImportError()
+        directory = posixpath.dirname(directory)
+
+
+def _resolve_c(statement, sourcefile, index):
+    match = re.match(r'\s*#\s*include\s*(["<])([^">]+)[">]', statement)
+    if not match:
+        return []
+    quoted, header = match.group(1) == '"', match.group(2)
+    if quoted:
+        relative = _candidates(index, [posixpath.join(posixpath.dirname(sourcefile), header)])
+        if relative:
+            return relative
+    return _single(index.with_suffix(posixpath.normpath(header)))
+
+
+def _resolve_ruby(statement, sourcefile, index):
+    match = re.match(r"\s*(require_relative|require|load)\b\s*\(?\s*(['\"])?([^'\")\s]*)", statement)
+    if not match:
+        return []
+    method, literal, path = match.groups()
+    if not literal:
+        raise AmbiguousImportError()
+    if not path.endswith(".rb"):
+        path += ".rb"
+    if method == "require_relative":
+        found = _candidates(index, [posixpath.join(posixpath.dirname(sourcefile), path)])
+        if not found:
+            raise AmbiguousImportError()
+        return found
+    return _single(_candidates(index, [path, posixpath.join("lib", path)]))
+
+
+def _resolve_php(statement, sourcefile, index):
+    if re.match(r"\s*use\b", statement):
+        if "{" in statement:
+            raise AmbiguousImportError()
+        found = []
+        for clause in re.sub(r"^\s*use\s+(function\s+|const\s+)?", "", statement).rstrip(";").split(","):
+            parts = clause.split(" as ")[0].strip().strip("\\").split("\\")
+            for start in range(len(parts) - 1):
+                matches = index.with_suffix("/".join(parts[start:]) + ".php")
+                if matches:
+                    found.extend(_single(matches))
+                    break
+        return found
+
+    match = re.search(r"""['"]([^'"]+\.php)['"]""", statement)
+    if not match:
+        raise AmbiguousImportError()
+    path = match.group(1).lstrip("/")
+    found = _candidates(index, [posixpath.join(posixpath.dirname(sourcefile), path), path])
+    if not found:
+        raise AmbiguousImportError()
+    return found[:1]
+
+
+def _resolve_julia(statement, sourcefile, index):
+    match = re.match(r"""\s*include\s*\(\s*(")?([^")]*)""", statement)
+    if match:
+        if not match.group(1):
+            raise AmbiguousImportError()
+        found = _candidates(index, [posixpath.join(posixpath.dirname(sourcefile), match.group(2))])
+        if not found:
+            raise AmbiguousImportError()
+        return found
+    if re.match(r"\s*(using|import)\s+\.", statement):
+        raise AmbiguousImportError()
+    return []
+
+
+def _same_package_deps(sourcefile, index, extension):
+    # Classes and package members of the same directory are visible without an import
+    siblings = index.siblings(sourcefile, "." + extension)
+    if extension == "go":
+        return [path for path in siblings if not path.endswith("_test.go")]
+    with open(os.path.join(index.sourcedir, sourcefile)) as file:
+        content = file.read()
+    identifiers = set(re.findall(r"\b[A-Z]\w*\b", content))
+    return [path for path in siblings if posixpath.basename(path).rsplit(".", 1)[0] in identifiers]
+
+
+NODE_BUILTIN_MODULES = {
+    "assert",
+    "buffer",
+    "child_process",
+    "cluster",
+    "crypto",
+    "dgram",
+    "dns",
+    "events",
+    "fs",
+    "http",
+    "http2",
+    "https",
+    "net",
+    "os",
+    "path",
+    "process",
+    "querystring",
+    "readline",
+    "stream",
+    "string_decoder",
+    "timers",
+    "tls",
+    "tty",
+    "url",
+    "util",
+    "v8",
+    "vm",
+    "worker_threads",
+    "zlib",
+}
+
+RUST_BUILTIN_CRATES = {"crate", "self", "super", "std", "core", "alloc"}
+
+
+def _python_packages(statement, sourcefile, index):
+    statement = re.sub(r"#.*", "", statement).replace("\\\n", " ")
+    match = re.match(r"\s*from\s+(\w[\w.]*)\s+import", statement)
+    if match:
+        modules = [match.group(1)]
+    else:
+        match = re.match(r"\s*import\s+(.+)", statement, re.DOTALL)
+        modules = [name.split(" as ")[0].strip() for name in match.group(1).split(",")] if match else []
+    packages = []
+    for module in modules:
+        top_level = module.split(".")[0]
+        if not top_level or top_level in sys.stdlib_module_names or top_level == "__future__":
+            continue
+        if _python_module(0, top_level, sourcefile, index, required=False) or index.has_dir_suffix(top_level):
+            continue
+        packages.append(top_level)
+    return packages
+
+
+def _js_packages(statement, sourcefile, index):
+    specifiers = re.findall(
+        r"""(?:\bfrom|^\s*import|\brequire\s*\(|\bimport\s*\()\s*['"]([^'"]+)['"]""", statement, re.MULTILINE
+    )
+    packages = []
+    for specifier in specifiers:
+        if specifier.startswith((".", "/")) or specifier.startswith("node:"):
+            continue
+        parts = specifier.split("/")
+        package = "/".join(parts[:2]) if specifier.startswith("@") else parts[0]
+        if package not in NODE_BUILTIN_MODULES:
+            packages.append(package)
+    return packages
+
+
+def _ruby_packages(statement, sourcefile, index):
+    match = re.match(r"""\s*require\s*\(?\s*['"]([^'"]+)['"]""", statement)
+    if not match:
+        return []
+    path = match.group(1)
+    if _candidates(index, [path + ".rb", posixpath.join("lib", path + ".rb")]):
+        return []
+    return [path.split("/")[0]]
+
+
+def _go_packages(statement, sourcefile, index):
+    module = _go_module(index)
+    packages = []
+    for specifier in re.findall(r'"([^"]+)"', statement):
+        if module and (specifier == module or specifier.startswith(module + "/")):
+            continue
+        parts = specifier.split("/")
+        if "." not in parts[0]:
+            # standard library
+            continue
+        packages.append("/".join(parts[:3]))
+    return packages
+
+
+def _rust_packages(statement, sourcefile, index):
+    match = re.match(r"\s*(?:pub(?:\([^)]*\))?\s+)?(?:use\s+:*|extern\s+crate\s+)(\w+)", statement)
+    if not match or match.group(1) in RUST_BUILTIN_CRATES:
+        return []
+    return [match.group(1)]
+
+
+def _julia_packages(statement, sourcefile, index):
+    match = re.match(r"\s*(?:using|import)\s+([\w.,\s:]+)", statement)
+    if not match:
+        return []
+    names = [name.split(":")[0].split(".")[0].strip() for name in match.group(1).split(",")]
+    return [name for name in names if name and name not in ("Base", "Core")]
+
+
+PACKAGE_EXTRACTORS = {
+    "py": _python_packages,
+    "js": _js_packages,
+    "rb": _ruby_packages,
+    "go": _go_packages,
+    "rs": _rust_packages,
+    "jl": _julia_packages,
+}
+
+# C# and Swift are deliberately missing: any file can use any other file of its module without an import
+# statement, so imports alone never tell the whole story and the LLM always decides.
+RESOLVERS = {
+    "py": _resolve_python,
+    "js": _resolve_js,
+    "java": _resolve_java,
+    "rb": _resolve_ruby,
+    "php": _resolve_php,
+    "go": _resolve_go,
+    "rs": _resolve_rust,
+    "c": _resolve_c,
+    "scala": _resolve_scala,
+    "hs": _resolve_haskell,
+    "jl": _resolve_julia,
+}
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+
+from config import (
+    DESCRIBE_FUNCTION_SIGNATURES,
+    GET_EXTERNAL_DEPS,
+    GET_FUNCTION_SIGNATURES,
+    GET_INTERNAL_DEPS,
+    GUIDELINES,
+    HIERARCHY,
+    MAP_EXTERNAL_DEPS,
+    SINGLEFILE,
+    WRITE_CODE,
+    WRITE_MIGRATION,
+    WRITE_MIGRATION_HEADER,
+    WRITE_MIGRATION_PART,
+)
+
+MANIFEST_PATH = "gpt_migrate/migration_manifest.json"
+
+# Prompts whose wording shapes the migrated files; editing any of them invalidates every file
+MIGRATION_PROMPTS = [
+    HIERARCHY,
+    GUIDELINES,
+    WRITE_CODE,
+    GET_EXTERNAL_DEPS,
+    MAP_EXTERNAL_DEPS,
+    GET_INTERNAL_DEPS,
+    WRITE_MIGRATION,
+    WRITE_MIGRATION_HEADER,
+    WRITE_MIGRATION_PART,
+    SINGLEFILE,
+    GET_FUNCTION_SIGNATURES,
+    DESCRIBE_FUNCTION_SIGNATURES,
+]
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def migration_settings(globals):
+    """Everything besides the source files that determines what the migration writes"""
+    return {
+        "model": globals.ai.model_name,
+        "temperature": globals.ai.temperature,
+        "max_tokens": globals.ai.max_tokens,
+        "sourcelang": globals.sourcelang,
+        "targetlang": globals.targetlang,
+        "guidelines": globals.guidelines,
+        "signature_model": globals.signature_ai.model_name if globals.signature_ai is not None else None,
+        "prompts": {prompt: file_hash(os.path.abspath(f"prompts/{prompt}")) for prompt in MIGRATION_PROMPTS},
+    }
+
+
+class MigrationManifest:
+    """Record of which target file each source file produced, and from which content and settings.
+
+    Stored in the target directory so that the next run only re-migrates source files that changed,
+    plus every file that depends on them.
+    """
+
+    def __init__(self, targetdir, settings, reuse=True):
+        self.path = os.path.join(targetdir, MANIFEST_PATH)
+        self.targetdir = targetdir
+        self.settings = settings
+        self.files = {}
+        if reuse and os.path.exists(self.path):
+            with open(self.path) as file:
+                data = json.load(file)
+            # different model, prompts or languages: nothing recorded can be reused
+            if data.get("settings") == settings:
+                self.files = data.get("files", {})
+
+    def is_current(self, sourcefile, source_hash):
+        entry = self.files.get(sourcefile)
+        return (
+            entry is not None
+            and entry["hash"] == source_hash
+            and os.path.exists(os.path.join(self.targetdir, entry["target"]))
+        )
+
+    def recorded_dependencies(self, sourcefile, source_hash):
+        entry = self.files.get(sourcefile)
+        if entry is None or entry["hash"] != source_hash:
+            return None
+        return entry["deps"], entry["external_deps"]
+
+    def stale_files(self, graph, source_hashes):
+        """Files to migrate again: changed files and everything that transitively depends on them"""
+        dependents = graph.dependents()
+        stale = set()
+        queue = [sourcefile for sourcefile in graph.deps if not self.is_current(sourcefile, source_hashes[sourcefile])]
+        while queue:
+            sourcefile = queue.pop()
+            if sourcefile in stale:
+                continue
+            stale.add(sourcefile)
+            queue.extend(dependents[sourcefile])
+        return stale
+
+    def record(self, sourcefile, source_hash, deps, external_deps, target):
+        self.files[sourcefile] = {
+            "hash": source_hash,
+            "deps": list(deps),
+            "external_deps": list(external_deps),
+            "target": target,
+        }
+        self.save()
+
+    def prune(self, sourcefiles):
+        """Forget source files that are no longer part of the migration"""
+        self.files = {sourcefile: entry for sourcefile, entry in self.files.items() if sourcefile in sourcefiles}
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"settings": self.settings, "files": self.files}, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,272 @@
+"""Durable SQLite queue of migration jobs, shared by every process working on one target directory."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_QUEUE_JOURNAL_MODE, JOB_RETRY_BACKOFF_SECONDS
+
+JOB_QUEUE_PATH = "gpt_migrate/jobs.db"
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT NOT NULL DEFAULT '',
+    UNIQUE (kind, key)
+);
+CREATE TABLE IF NOT EXISTS job_deps (
+    job_id INTEGER NOT NULL,
+    dep_id INTEGER NOT NULL,
+    PRIMARY KEY (job_id, dep_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, available_at);
+CREATE INDEX IF NOT EXISTS job_deps_by_dep ON job_deps (dep_id);
+"""
+
+
+class Job:
+    def __init__(self, id, kind, key, payload, attempts, dep_results):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+        # results of the jobs this one depends on, keyed by (kind, key)
+        self.dep_results = dep_results
+
+
+class JobQueue:
+    """Jobs identified by (kind, key), run once all the jobs they depend on are done.
+
+    A worker leases a ready job for lease_seconds and renews the lease while it works. A job whose
+    lease runs out, because its worker died or lost the filesystem, is handed to the next worker; the
+    late result of the old lease holder is ignored. Failed jobs are retried after a backoff until
+    max_attempts, after which they and every job depending on them fail. Enqueueing an existing
+    (kind, key) changes nothing, so producers can be restarted safely.
+
+    Every operation is its own transaction, with BEGIN IMMEDIATE where a job changes hands, so any
+    number of processes can share the database. The default WAL journal requires all of them to run
+    on one host; set JOB_QUEUE_JOURNAL_MODE to "delete" for hosts sharing a network filesystem.
+    """
+
+    def __init__(self, path, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self.connection.execute(f"PRAGMA journal_mode={JOB_QUEUE_JOURNAL_MODE}")
+            self.connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self, immediate=False):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def set_meta(self, key, value):
+        with self._transaction():
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value, sort_keys=True))
+            )
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def enqueue(self, kind, key, payload, depends_on=(), priority=0, result=None):
+        """Add a job unless (kind, key) is already queued. depends_on lists (kind, key) of queued jobs.
+
+        A job enqueued with a result is recorded as already done, e.g. work reused from an earlier run
+        that other jobs still need the result of.
+        """
+        with self._transaction(immediate=True):
+            self.connection.execute(
+                "INSERT OR IGNORE INTO jobs (kind, key, payload, priority, state, result) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    key,
+                    json.dumps(payload, sort_keys=True),
+                    priority,
+                    DONE if result is not None else PENDING,
+                    json.dumps(result) if result is not None else None,
+                ),
+            )
+            job_id = self._job_id(kind, key)
+            for dep_kind, dep_key in depends_on:
+                dep_id = self._job_id(dep_kind, dep_key)
+                if dep_id is None:
+                    raise KeyError(f"{kind} job {key} depends on {dep_kind} job {dep_key}, which is not queued")
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO job_deps (job_id, dep_id) VALUES (?, ?)", (job_id, dep_id)
+                )
+        return job_id
+
+    def _job_id(self, kind, key):
+        row = self.connection.execute("SELECT id FROM jobs WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def lease(self, owner, kinds=None):
+        """Lease the most urgent ready job to owner, or return None if no job is ready"""
+        now = time.time()
+        query = (
+            "SELECT id, kind, key, payload, attempts FROM jobs j"
+            " WHERE ((state = ? AND available_at <= ?) OR (state = ? AND lease_expires < ?))"
+            " AND NOT EXISTS (SELECT 1 FROM job_deps d JOIN jobs p ON p.id = d.dep_id"
+            " WHERE d.job_id = j.id AND p.state != ?)"
+        )
+        parameters = [PENDING, now, LEASED, now, DONE]
+        if kinds:
+            query += f" AND kind IN ({','.join('?' * len(kinds))})"
+            parameters += list(kinds)
+        query += " ORDER BY priority DESC, id LIMIT 1"
+        with self._transaction(immediate=True):
+            row = self.connection.execute(query, parameters).fetchone()
+            if row is None:
+                return None
+            job_id, kind, key, payload, attempts = row
+            self.connection.execute(
+                "UPDATE jobs SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (LEASED, owner, now + self.lease_seconds, job_id),
+            )
+            dep_results = {
+                (dep_kind, dep_key): json.loads(result)
+                for dep_kind, dep_key, result in self.connection.execute(
+                    "SELECT p.kind, p.key, p.result FROM job_deps d JOIN jobs p ON p.id = d.dep_id WHERE d.job_id = ?",
+                    (job_id,),
+                )
+            }
+        return Job(job_id, kind, key, json.loads(payload), attempts + 1, dep_results)
+
+    def renew(self, job, owner):
+        """Extend the lease on a running job. Returns False if the lease was lost to another worker."""
+        with self._transaction(immediate=True):
+            cursor = self.connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = ? AND lease_owner = ?",
+                (time.time() + self.lease_seconds, job.id, LEASED, owner),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job, owner, result):
+        """Record the result of a job. Returns False, recording nothing, if owner no longer holds the lease."""
+        with self._transaction(immediate=True):
+            cursor = self.connection.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = '', lease_owner = NULL, lease_expires = NULL"
+                " WHERE id = ? AND state = ? AND lease_owner = ?",
+                (DONE, json.dumps(result), job.id, LEASED, owner),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job, owner, error):
+        """Put a job back for a retry after a backoff, or fail it and its dependents for good"""
+        with self._transaction(immediate=True):
+            row = self.connection.execute(
+                "SELECT attempts FROM jobs WHERE id = ? AND state = ? AND lease_owner = ?", (job.id, LEASED, owner)
+            ).fetchone()
+            if row is None:
+                return
+            if row[0] < self.max_attempts:
+                self.connection.execute(
+                    "UPDATE jobs SET state = ?, available_at = ?, error = ?, lease_owner = NULL, lease_expires = NULL"
+                    " WHERE id = ?",
+                    (PENDING, time.time() + JOB_RETRY_BACKOFF_SECONDS * row[0], error, job.id),
+                )
+                return
+            failed = [job.id]
+            errors = {job.id: error}
+            while failed:
+                job_id = failed.pop()
+                self.connection.execute(
+                    "UPDATE jobs SET state = ?, error = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ?",
+                    (FAILED, errors[job_id], job_id),
+                )
+                for (dependent,) in self.connection.execute(
+                    "SELECT d.job_id FROM job_deps d JOIN jobs j ON j.id = d.job_id WHERE d.dep_id = ? AND j.state != ?",
+                    (job_id, FAILED),
+                ).fetchall():
+                    errors[dependent] = f"a job it depends on failed: {errors[job_id]}"
+                    failed.append(dependent)
+
+    def retry_failed(self):
+        """Give every failed job a fresh set of attempts"""
+        with self._transaction(immediate=True):
+            self.connection.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, available_at = 0 WHERE state = ?", (PENDING, FAILED)
+            )
+
+    def retain(self, keys):
+        """Drop the jobs not yet done whose key is not in keys, e.g. jobs for files that changed since"""
+        keys = set(keys)
+        with self._transaction(immediate=True):
+            obsolete = [
+                job_id
+                for job_id, key in self.connection.execute("SELECT id, key FROM jobs WHERE state != ?", (DONE,))
+                if key not in keys
+            ]
+            self.connection.executemany(
+                "DELETE FROM job_deps WHERE job_id = ? OR dep_id = ?", [(job_id, job_id) for job_id in obsolete]
+            )
+            self.connection.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in obsolete])
+
+    def counts(self):
+        with self._lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def drained(self):
+        """True once no job is waiting or running"""
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def results(self, kind):
+        """Results of the done jobs of one kind, by key"""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT key, result FROM jobs WHERE kind = ? AND state = ?", (kind, DONE)
+            ).fetchall()
+        return {key: json.loads(result) for key, result in rows}
+
+    def failures(self):
+        """(kind, key, error) of every failed job"""
+        with self._lock:
+            return self.connection.execute(
+                "SELECT kind, key, error FROM jobs WHERE state = ? ORDER BY id", (FAILED,)
+            ).fetchall()
+
+    def reset(self):
+        """Forget every job, e.g. when the run they belong to was started with different settings"""
+        with self._transaction(immediate=True):
+            self.connection.execute("DELETE FROM job_deps")
+            self.connection.execute("DELETE FROM jobs")
+            self.connection.execute("DELETE FROM meta")
+
+
+def get_job_queue(targetdir):
+    return JobQueue(os.path.join(os.path.abspath(targetdir), JOB_QUEUE_PATH))
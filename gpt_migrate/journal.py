@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+
+JOURNAL_PATH = "gpt_migrate/journal.jsonl"
+
+
+class RunJournal:
+    """Append-only log of the units of work completed by the current run.
+
+    Every record is written as one line with a single write() and fsync'ed before the work that follows
+    it starts, so a crash can at most leave a torn last line, which is dropped on replay. A journal
+    belongs to one set of migration settings; it is set aside once the run completes or the settings
+    change, and the next run starts from scratch.
+    """
+
+    def __init__(self, targetdir, settings):
+        self.path = os.path.join(targetdir, JOURNAL_PATH)
+        self.settings = settings
+        self.records = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._replay()
+        if not os.path.exists(self.path):
+            self.append("run", "", settings=settings)
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        records = {}
+        valid_bytes = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records[(record["kind"], record["key"])] = record.get("data", {})
+                valid_bytes += len(line)
+
+        if records.get(("run", ""), {}).get("settings") != self.settings:
+            self._set_aside()
+            return
+        if valid_bytes != os.path.getsize(self.path):
+            # drop the torn tail so new records start on a fresh line
+            with open(self.path, "r+b") as file:
+                file.truncate(valid_bytes)
+        self.records = records
+
+    def _set_aside(self):
+        os.replace(self.path, self.path + ".prev")
+        self.records = {}
+
+    def get(self, kind, key=""):
+        return self.records.get((kind, key))
+
+    def done(self, kind, key=""):
+        return (kind, key) in self.records
+
+    def done_with(self, kind, inputs, key=""):
+        """True if the unit of work was completed from the same inputs, as recorded by append(..., inputs=...)"""
+        record = self.get(kind, key)
+        return record is not None and record.get("inputs") == inputs
+
+    def append(self, kind, key="", **data):
+        line = json.dumps({"kind": kind, "key": key, "data": data}, sort_keys=True) + "\n"
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.records[(kind, key)] = data
+
+    def discard(self, *kinds):
+        """Forget the records of kinds, e.g. once the step that replays them has finished"""
+        with self._lock:
+            self.records = {key: data for key, data in self.records.items() if key[0] not in kinds}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.writelines(
+                    json.dumps({"kind": kind, "key": key, "data": data}, sort_keys=True) + "\n"
+                    for (kind, key), data in self.records.items()
+                )
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+
+    def complete(self):
+        """Mark the run as finished; the next run starts a new journal"""
+        with self._lock:
+            if os.path.exists(self.path):
+                self._set_aside()
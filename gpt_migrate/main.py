@@ -1,18 +1,30 @@
+import asyncio
 import os
 import time
-from collections import defaultdict
 
 import typer
-from ai import AI
+from ai import AsyncAI, ConcurrencyLimiter
+from cache import ResponseCache
+from config import CREATE_DOCKER, DEFAULT_CACHE_DIR, LANGUAGE_DETECTION_SECONDARY_SHARE, MAX_CONCURRENT_REQUESTS
+from estimate import estimate_migration
+from imports import get_source_index
+from incremental import MigrationManifest, file_hash, migration_settings
+from journal import RunJournal
 from steps.debug import debug_error, debug_testfile
-from steps.migrate import add_env_files, get_dependencies, write_migration
+from steps.distribute import distribute_migration
+from steps.migrate import add_env_files, amap_external_dependencies, migrate_pipeline
 from steps.setup import create_environment
 from steps.test import create_tests, run_dockerfile, run_test, validate_tests
-from utils import build_directory_structure, detect_language
+from store import use_namespace
+from utils import build_directory_structure, detect_languages
 
 app = typer.Typer()
 
 
+def echo_resumed(work):
+    typer.echo(typer.style(f"Skipping {work}: already completed by the interrupted run.", fg=typer.colors.BLUE))
+
+
 class Globals:
     def __init__(
         self,
@@ -41,6 +53,143 @@ class Globals:
         self.targetport = targetport
         self.guidelines = guidelines
         self.ai = ai
+        # source package -> target libraries, and the deduplicated target libraries of this run
+        self.package_map = None
+        self.external_deps = {}
+        self.journal = None
+        # cheaper model describing extracted function signatures that have no doc comment, if any
+        self.signature_ai = None
+        # source file -> outline of its top-level nodes, parsed up front for files migrated in parts
+        self.outlines = {}
+        # files this run sent to the model, as opposed to those reused from an earlier run
+        self.migrated_files = 0
+
+
+def run_steps(globals, step="all", incremental=True, distribute=False):
+    """Run the setup, migration and testing steps for one repository.
+
+    Returns the number of files migrated and the number of files reused from an earlier run.
+
+    With distribute, file migrations go through the job queue in the target directory, shared with
+    any worker.py processes.
+    """
+    # What this run remembers between steps is kept apart from concurrent runs on other target directories
+    with use_namespace(os.path.abspath(globals.targetdir)):
+        return _run_steps(globals, step, incremental, distribute)
+
+
+def _run_steps(globals, step, incremental, distribute):
+    targetdir = globals.targetdir
+    sourceentry = globals.sourceentry
+    migrated_files = reused_files = 0
+    globals.migrated_files = 0
+
+    # The source tree may have changed since an earlier run in this process, e.g. a batch job
+    get_source_index.cache_clear()
+
+    # Units of work finished by an interrupted run with the same settings are replayed, not redone
+    journal = RunJournal(targetdir, migration_settings(globals))
+    globals.journal = journal
+
+    # Settings changes set the whole journal aside; these steps also depend on inputs outside the settings
+    setup_inputs = {"sourceentry": sourceentry, "prompt": file_hash(os.path.abspath(f"prompts/{CREATE_DOCKER}"))}
+    setup_done = journal.done_with("setup", setup_inputs) and os.path.exists(os.path.join(targetdir, "Dockerfile"))
+    testfiles = globals.testfiles.split(",")
+
+    def setup():
+        # Set up environment (Docker)
+        create_environment(globals)
+        journal.append("setup", inputs=setup_inputs)
+
+    def generate_tests():
+        # Unit tests are written from the source app, so they don't wait for the migration
+        for testfile in testfiles:
+            if not journal.done("test_passed", testfile) and not tests_created(testfile):
+                journal.append("tests_created", testfile, file=create_tests(testfile, globals))
+
+    def tests_created(testfile):
+        created = journal.get("tests_created", testfile)
+        return created is not None and os.path.exists(os.path.join(targetdir, "gpt_migrate", created["file"]))
+
+    """ 1. Setup """
+    if step in ["setup", "all"]:
+        if setup_done:
+            echo_resumed("Docker environment")
+        elif step == "setup":
+            setup()
+
+    """ 2. Migration """
+    if step in ["migrate", "all"]:
+
+        async def migrate(sourceentry, globals):
+            # discovery, generation and signature extraction overlap in one pipeline; with step "all", the
+            # Docker environment and the unit tests are written alongside it
+            manifest = MigrationManifest(globals.targetdir, migration_settings(globals), reuse=incremental)
+            side_work = []
+            if step == "all":
+                if not setup_done:
+                    side_work.append(asyncio.to_thread(setup))
+                side_work.append(asyncio.to_thread(generate_tests))
+
+            async def migrate_files():
+                await amap_external_dependencies(globals)
+                if distribute:
+                    return await distribute_migration(sourceentry, globals, manifest)
+                return await migrate_pipeline(sourceentry, globals, manifest)
+
+            graph, *_ = await asyncio.gather(migrate_files(), *side_work)
+            return len(graph.deps)
+
+        files = asyncio.run(migrate(sourceentry, globals))
+        migrated_files = globals.migrated_files
+        reused_files = files - migrated_files
+        # new external dependencies must reach the dependency file and the Dockerfile
+        env_inputs = {"external_deps": sorted(globals.external_deps)}
+        if journal.done_with("env_files", env_inputs):
+            echo_resumed("environment files")
+        else:
+            add_env_files(globals)
+            journal.append("env_files", inputs=env_inputs)
+        # the manifest records the finished migration; a later run decides what to migrate again from it alone
+        journal.discard("deps", "migrated")
+
+    """ 3. Testing """
+    if step in ["test", "all"]:
+        if all(journal.done("test_passed", testfile) for testfile in testfiles):
+            echo_resumed("tests")
+        else:
+            while True:
+                result = run_dockerfile(globals)
+                if result == "success":
+                    break
+                debug_error(result, "", globals)
+        for testfile in testfiles:
+            if journal.done("test_passed", testfile):
+                continue
+            if tests_created(testfile):
+                generated_testfile = journal.get("tests_created", testfile)["file"]
+            else:
+                generated_testfile = create_tests(testfile, globals)
+                journal.append("tests_created", testfile, file=generated_testfile)
+            if globals.sourceport and not journal.done("tests_validated", testfile):
+                while True:
+                    result = validate_tests(generated_testfile, globals)
+                    time.sleep(0.3)
+                    if result == "success":
+                        break
+                    debug_testfile(result, testfile, globals)
+                journal.append("tests_validated", testfile)
+            while True:
+                result = run_test(generated_testfile, globals)
+                if result == "success":
+                    break
+                debug_error(result, globals.testfiles, globals)
+                run_dockerfile(globals)
+                time.sleep(1)  # wait for docker to spin up
+            journal.append("test_passed", testfile)
+        journal.complete()
+
+    return migrated_files, reused_files
 
 
 @app.command()
@@ -78,19 +227,53 @@ def main(
         help='Stylistic or small functional guidelines that you\'d like to be followed during the migration. For instance, "Use tabs, not spaces".',
     ),
     step: str = typer.Option("all", help="Step to run. Options are 'setup', 'migrate', 'test', 'all'."),
+    cache: bool = typer.Option(
+        True, help="Reuse cached LLM responses for identical prompts. Use --no-cache to always call the model."
+    ),
+    cachedir: str = typer.Option(DEFAULT_CACHE_DIR, help="Directory where LLM responses are cached."),
+    concurrency: int = typer.Option(
+        MAX_CONCURRENT_REQUESTS, help="Maximum number of LLM requests in flight at the same time."
+    ),
+    incremental: bool = typer.Option(
+        True,
+        help="Only re-migrate source files that changed since the last run, and the files that depend on them. Use --no-incremental to migrate everything again.",
+    ),
+    signature_model: str = typer.Option(
+        None,
+        help="(Optional) cheaper model that writes one-line descriptions for function signatures without a doc comment.",
+    ),
+    distribute: bool = typer.Option(
+        False,
+        "--distribute",
+        help="Queue file migrations in gpt_migrate/jobs.db in the target directory, so that worker.py processes on this or other hosts sharing the filesystem can take part.",
+    ),
+    plan: bool = typer.Option(
+        False,
+        "--plan",
+        help="Estimate the LLM calls, tokens, cost and wall time of the migration at --concurrency without calling the model, then exit.",
+    ),
 ):
-    ai = AI(
+    ai = AsyncAI(
         model=model,
         temperature=temperature,
+        cache=ResponseCache(cache_dir=cachedir, bypass=not cache),
+        limiter=ConcurrencyLimiter(max_concurrency=concurrency),
     )
 
     sourcedir = os.path.abspath(sourcedir)
     targetdir = os.path.abspath(targetdir)
     os.makedirs(targetdir, exist_ok=True)
 
-    detected_language = sourcelang or detect_language(sourcedir)
-
     if not sourcelang:
+        languages = detect_languages(sourcedir)
+        detected_language = languages[0][0] if languages else None
+        secondary = [
+            f"{language} ({share:.0%})"
+            for language, share in languages[1:]
+            if share >= LANGUAGE_DETECTION_SECONDARY_SHARE
+        ]
+        if secondary:
+            typer.echo(typer.style(f"The source project also contains {', '.join(secondary)}.", fg=typer.colors.BLUE))
         if detected_language:
             is_correct = typer.confirm(f"Is your source project a {detected_language} project?")
             if is_correct:
@@ -120,6 +303,15 @@ def main(
         guidelines,
         ai,
     )
+    if signature_model:
+        globals.signature_ai = AsyncAI(model=signature_model, temperature=0, cache=ai.cache, limiter=ai.limiter)
+
+    if plan:
+        started = time.monotonic()
+        estimate = estimate_migration(globals, concurrency, step, incremental)
+        typer.echo(typer.style(estimate.report(), fg=typer.colors.BLUE))
+        typer.echo(typer.style(f"Planned in {time.monotonic() - started:.1f}s.", dim=True))
+        return
 
     typer.echo(
         typer.style(
@@ -137,55 +329,16 @@ def main(
     time.sleep(0.3)
     typer.echo(typer.style("Source directory structure: \n\n" + source_directory_structure, fg=typer.colors.BLUE))
 
-    """ 1. Setup """
-    if step in ["setup", "all"]:
-        # Set up environment (Docker)
-        create_environment(globals)
+    run_steps(globals, step, incremental, distribute)
 
-    """ 2. Migration """
-    if step in ["migrate", "all"]:
-        target_deps_per_file = defaultdict(list)
-
-        def migrate(sourcefile, globals, parent_file=None):
-            # recursively work through each of the files in the source directory, starting with the entrypoint.
-            internal_deps_list, external_deps_list = get_dependencies(sourcefile=sourcefile, globals=globals)
-            for dependency in internal_deps_list:
-                migrate(dependency.strip(), globals, parent_file=sourcefile)
-            file_name = write_migration(
-                sourcefile,
-                external_deps_list,
-                target_deps_per_file.get(sourcefile),
-                globals,
+    if cache:
+        cache_stats = ai.cache.stats()
+        typer.echo(
+            typer.style(
+                f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.",
+                fg=typer.colors.BLUE,
             )
-            target_deps_per_file[parent_file].append(file_name)
-
-        migrate(sourceentry, globals)
-        add_env_files(globals)
-
-    """ 3. Testing """
-    if step in ["test", "all"]:
-        while True:
-            result = run_dockerfile(globals)
-            if result == "success":
-                break
-            debug_error(result, "", globals)
-        for testfile in globals.testfiles.split(","):
-            generated_testfile = create_tests(testfile, globals)
-            if globals.sourceport:
-                while True:
-                    result = validate_tests(generated_testfile, globals)
-                    time.sleep(0.3)
-                    if result == "success":
-                        break
-                    debug_testfile(result, testfile, globals)
-            while True:
-                result = run_test(generated_testfile, globals)
-                if result == "success":
-                    break
-                debug_error(result, globals.testfiles, globals)
-                run_dockerfile(globals)
-                time.sleep(1)  # wait for docker to spin up
-
+        )
     typer.echo(typer.style("All tests complete. Ready to rumble. 💪", fg=typer.colors.GREEN))
 
 
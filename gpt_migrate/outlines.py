@@ -0,0 +1,188 @@
+"""Persistent cache of what parsing a file yields, keyed by the file's content and grammar, read through mmap."""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from itertools import starmap
+
+from config import OUTLINE_CACHE_DIR, OUTLINE_CACHE_MAX_BYTES
+from grammars import file_lock, grammar_version
+
+OUTLINE_PACK = "outlines.pack"
+
+# Every record is a 16-byte key and the length of the payload that follows
+RECORD_HEADER = struct.Struct("<16sI")
+# An outline is a count of strings and of nodes, the strings, each prefixed by its length, then the nodes
+OUTLINE_HEADER = struct.Struct("<II")
+STRING_LENGTH = struct.Struct("<I")
+# type and name (indexes into the strings), start byte, end byte, hash
+OUTLINE_NODE = struct.Struct("<IIII8s")
+SPAN = struct.Struct("<II")
+
+# Extensions whose grammar version could not be determined; their results are never cached
+_unversioned = set()
+
+
+def encode_outline(outline):
+    strings = {}
+    nodes = []
+    for node_type, name, start, end, node_hash in outline:
+        type_index = strings.setdefault(node_type, len(strings))
+        name_index = strings.setdefault(name, len(strings))
+        nodes.append(OUTLINE_NODE.pack(type_index, name_index, start, end, bytes.fromhex(node_hash)))
+    parts = [OUTLINE_HEADER.pack(len(strings), len(nodes))]
+    for string in strings:
+        encoded = string.encode("utf8")
+        parts += [STRING_LENGTH.pack(len(encoded)), encoded]
+    return b"".join(parts + nodes)
+
+
+def decode_outline(buffer):
+    string_count, node_count = OUTLINE_HEADER.unpack_from(buffer)
+    offset = OUTLINE_HEADER.size
+    strings = []
+    for _ in range(string_count):
+        (length,) = STRING_LENGTH.unpack_from(buffer, offset)
+        offset += STRING_LENGTH.size
+        strings.append(bytes(buffer[offset : offset + length]).decode("utf8"))
+        offset += length
+    nodes = buffer[offset : offset + node_count * OUTLINE_NODE.size]
+    return [
+        (strings[type_index], strings[name_index], start, end, node_hash.hex())
+        for type_index, name_index, start, end, node_hash in OUTLINE_NODE.iter_unpack(nodes)
+    ]
+
+
+def encode_spans(spans):
+    return b"".join(starmap(SPAN.pack, spans))
+
+
+def decode_spans(buffer):
+    return list(SPAN.iter_unpack(buffer))
+
+
+class OutlineCache:
+    """Records appended to one pack file, shared by every process, and read through a memory map.
+
+    Each process maps the pack and indexes the records it holds; records appended since by other
+    processes are indexed when a lookup misses. Appends take a file lock, and a record cut short by a
+    crash is truncated away by the next append. Once the pack outgrows max_bytes it is rewritten with
+    the most recent records that fill half of it.
+    """
+
+    def __init__(self, cache_dir=OUTLINE_CACHE_DIR, max_bytes=OUTLINE_CACHE_MAX_BYTES):
+        self.path = os.path.join(os.path.expanduser(cache_dir), OUTLINE_PACK)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._map = None
+        self._inode = None
+        # key -> (payload offset, payload length), and how far the pack has been indexed
+        self._index = {}
+        self._indexed = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    @staticmethod
+    def key(kind, extension, source):
+        """Key of what parsing source yields for kind, e.g. "outline", or None if the grammar is unknown"""
+        if extension in _unversioned:
+            return None
+        try:
+            version = grammar_version(extension)
+        except Exception:
+            _unversioned.add(extension)
+            return None
+        digest = hashlib.blake2b(source, digest_size=16).digest()
+        return hashlib.blake2b(f"{kind}\0{version}\0".encode() + digest, digest_size=16).digest()
+
+    def _refresh(self):
+        """Index the records appended since the last refresh, remapping the pack if it grew or was replaced"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._indexed
+        if stat.st_ino != self._inode:
+            self._close()
+            self._inode = stat.st_ino
+        if stat.st_size > self._indexed:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = self._indexed
+            while offset + RECORD_HEADER.size <= len(self._map):
+                key, length = RECORD_HEADER.unpack_from(self._map, offset)
+                payload = offset + RECORD_HEADER.size
+                if payload + length > len(self._map):
+                    break
+                self._index[key] = (payload, length)
+                offset = payload + length
+            self._indexed = offset
+        return self._indexed
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._index = {}
+        self._indexed = 0
+
+    def get(self, key, decode):
+        """decode applied to the payload stored under key, read in place from the map, or None"""
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self.hits += 1
+            offset, length = self._index[key]
+            # the view must not outlive the lock: the map is replaced when the pack grows
+            with memoryview(self._map)[offset : offset + length] as payload:
+                return decode(payload)
+
+    def put(self, key, payload):
+        with self._lock, file_lock(self.path + ".lock"):
+            end = self._refresh()
+            with open(self.path, "ab") as file:
+                # drop a record left incomplete by a writer that died
+                if file.tell() > end:
+                    file.truncate(end)
+                file.write(RECORD_HEADER.pack(key, len(payload)) + payload)
+            if self.max_bytes and end + RECORD_HEADER.size + len(payload) > self.max_bytes:
+                self._compact()
+
+    def _compact(self):
+        self._refresh()
+        kept = []
+        size = 0
+        # the index holds the last record of each key, in the order records were appended
+        for key, (offset, length) in sorted(self._index.items(), key=lambda item: item[1][0], reverse=True):
+            size += RECORD_HEADER.size + length
+            if size > self.max_bytes // 2:
+                break
+            kept.append((key, offset, length))
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            for key, offset, length in reversed(kept):
+                file.write(RECORD_HEADER.pack(key, length))
+                file.write(self._map[offset : offset + length])
+        os.replace(tmp_path, self.path)
+        self._close()
+        self._inode = None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_outline_cache():
+    """The outline cache of this process, opened on first use"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = OutlineCache()
+        return _cache
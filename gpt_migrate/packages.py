@@ -0,0 +1,124 @@
+"""Third-party packages of the source tree and their target language equivalents."""
+
+import json
+import os
+import re
+
+import tomllib
+from imports import find_imported_packages, get_source_index
+from store import SHARED_NAMESPACE, get_memory_store, use_namespace
+
+# Store document of the equivalents of each pair of languages, shared by every run
+PACKAGE_EQUIVALENTS_DOCUMENT = "package_equivalents/{sourcelang}->{targetlang}"
+
+
+def read_manifest_packages(sourcedir):
+    """Package names declared in every manifest of the source tree, in discovery order"""
+    packages = []
+    for path in sorted(get_source_index(sourcedir).files):
+        name = os.path.basename(path)
+        reader = MANIFEST_READERS.get(name)
+        if reader is None and re.fullmatch(r"requirements.*\.txt", name):
+            reader = _read_requirements
+        if reader is None:
+            continue
+        try:
+            with open(os.path.join(sourcedir, path), encoding="utf-8") as file:
+                packages.extend(reader(file.read()))
+        except (OSError, ValueError):
+            continue
+    return list(dict.fromkeys(package for package in packages if package))
+
+
+def detect_source_packages(sourcedir, sourcefiles):
+    """Manifest packages plus every package imported by sourcefiles that can be read statically"""
+    packages = read_manifest_packages(sourcedir)
+    for sourcefile in sourcefiles:
+        packages.extend(find_imported_packages(sourcefile, sourcedir) or [])
+    return list(dict.fromkeys(packages))
+
+
+def _requirement_name(requirement):
+    requirement = requirement.split("#")[0].strip()
+    if not requirement or requirement.startswith(("-", "git+", "http:", "https:")):
+        return None
+    return re.split(r"[\s\[<>=!~;@]", requirement, maxsplit=1)[0]
+
+
+def _read_requirements(content):
+    return [_requirement_name(line) for line in content.splitlines()]
+
+
+def _read_pyproject(content):
+    data = tomllib.loads(content)
+    packages = [_requirement_name(requirement) for requirement in data.get("project", {}).get("dependencies", [])]
+    poetry = data.get("tool", {}).get("poetry", {})
+    packages.extend(name for name in poetry.get("dependencies", {}) if name != "python")
+    return packages
+
+
+def _read_pipfile(content):
+    return list(tomllib.loads(content).get("packages", {}))
+
+
+def _read_package_json(content):
+    return list(json.loads(content).get("dependencies", {}))
+
+
+def _read_cargo_toml(content):
+    return list(tomllib.loads(content).get("dependencies", {}))
+
+
+def _read_go_mod(content):
+    requirements = re.findall(r"^\s*require\s+(\S+)\s+\S+", content, re.MULTILINE)
+    for block in re.findall(r"^\s*require\s*\((.*?)\)", content, re.MULTILINE | re.DOTALL):
+        requirements.extend(
+            line.split()[0] for line in block.splitlines() if line.strip() and "// indirect" not in line
+        )
+    return requirements
+
+
+def _read_gemfile(content):
+    return re.findall(r"""^\s*gem\s+['"]([^'"]+)['"]""", content, re.MULTILINE)
+
+
+def _read_composer_json(content):
+    return [name for name in json.loads(content).get("require", {}) if name != "php" and not name.startswith("ext-")]
+
+
+MANIFEST_READERS = {
+    "pyproject.toml": _read_pyproject,
+    "Pipfile": _read_pipfile,
+    "package.json": _read_package_json,
+    "Cargo.toml": _read_cargo_toml,
+    "go.mod": _read_go_mod,
+    "Gemfile": _read_gemfile,
+    "composer.json": _read_composer_json,
+}
+
+
+def _equivalents_document(sourcelang, targetlang):
+    return PACKAGE_EQUIVALENTS_DOCUMENT.format(sourcelang=sourcelang.lower(), targetlang=targetlang.lower())
+
+
+def load_package_equivalents(sourcelang, targetlang):
+    """Cached mapping of source packages to their target language equivalents"""
+    with use_namespace(SHARED_NAMESPACE):
+        return get_memory_store().get(_equivalents_document(sourcelang, targetlang), {})
+
+
+def store_package_equivalents(sourcelang, targetlang, equivalents):
+    with use_namespace(SHARED_NAMESPACE):
+        get_memory_store().update(_equivalents_document(sourcelang, targetlang), equivalents)
+
+
+def parse_package_mapping(response):
+    """Parse the LLM's JSON answer to the package mapping prompt, tolerating code fences"""
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    if not match:
+        raise ValueError("No JSON object in package mapping response")
+    mapping = json.loads(match.group(0))
+    return {
+        str(package): [str(dep) for dep in (deps if isinstance(deps, list) else [deps]) if dep]
+        for package, deps in mapping.items()
+    }
@@ -1,56 +1,165 @@
-import subprocess
+import hashlib
+import os
+import threading
 from collections.abc import Iterator
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 
 import typer
-from config import EXTENSION_TO_LANGUAGE, EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO
-from tree_sitter import Language, Node, Parser
-from yaspin import yaspin
+from config import (
+    DECOMPOSE_BATCH_FILES,
+    DECOMPOSE_WORKERS,
+    EXTENSION_TO_LANGUAGE,
+    EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO,
+)
+from grammars import get_language
+from ignore import IgnoreMatcher
+from outlines import decode_outline, encode_outline, get_outline_cache
+from tree_sitter import Node, Parser, Tree
+
+_parsers = threading.local()
 
 
 def decompose_file(file_path: str) -> Iterator[Node]:
     # Do a first-level parse tree decomposition of the file at file_path
-    with yaspin(text="Decomposing file", spinner="dots") as spinner:
-        repo_url = EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO.get(file_path.split(".")[-1])
-
-        if not repo_url:
-            success_text = typer.style(
-                "Couldn't find tree-sitter grammar for programming language {}. Aborting decomposition of file.".format(
-                    EXTENSION_TO_LANGUAGE.get(file_path.split(".")[-1])
-                ),
-                fg=typer.colors.RED,
-            )
-            typer.echo(success_text)
-
-        repo_name = repo_url.split("/")[-1]
-        if not Path("cache/tree-sitter/" + repo_name).exists():
-            Path("cache/tree-sitter").mkdir(parents=True, exist_ok=True)
-            result = subprocess.run(
-                ["git", "clone", repo_url],
-                cwd="cache/tree-sitter",
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                check=True,
-                text=True,
-            )
-
-        grammar_lib_path = Path("cache/tree-sitter/my-languages.so")
-        if grammar_lib_path.exists():
-            grammar_lib_path.unlink()
-
-        Language.build_library("cache/tree-sitter/my-languages.so", ["cache/tree-sitter/" + repo_name])
-
-        lang = Language("cache/tree-sitter/my-languages.so", repo_url.split("-")[-1])
+    extension = file_path.split(".")[-1]
+
+    if not EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO.get(extension):
+        success_text = typer.style(
+            "Couldn't find tree-sitter grammar for programming language {}. Aborting decomposition of file.".format(
+                EXTENSION_TO_LANGUAGE.get(extension)
+            ),
+            fg=typer.colors.RED,
+        )
+        typer.echo(success_text)
+        return
+
+    tree = parse_file(file_path)
+
+    root_node = tree.root_node
+
+    yield from root_node.children
+
+
+def parse_file(file_path: str) -> Tree:
+    parser = get_parser(file_path.split(".")[-1])
+
+    with open(file_path) as f:
+        source_code = f.read()
+
+    return parser.parse(bytes(source_code, "utf8"))
+
+
+def get_parser(extension: str) -> Parser:
+    """This thread's tree-sitter parser for the file extension; parsers are reused but never shared by threads"""
+    parsers = getattr(_parsers, "by_extension", None)
+    if parsers is None:
+        parsers = _parsers.by_extension = {}
+    if extension not in parsers:
         parser = Parser()
-        parser.set_language(lang)
+        parser.set_language(get_language(extension))
+        parsers[extension] = parser
+    return parsers[extension]
+
+
+def _node_name(node: Node) -> str:
+    name = node.child_by_field_name("name")
+    if name is not None:
+        return name.text.decode("utf8", errors="replace")
+    # decorated definitions and exports are named after what they wrap
+    for field in ("definition", "declaration"):
+        inner = node.child_by_field_name(field)
+        if inner is not None:
+            return _node_name(inner)
+    return ""
+
+
+def _outline(source: bytes, extension: str) -> list[tuple[str, str, int, int, str]]:
+    tree = get_parser(extension).parse(source)
+    return [
+        (
+            node.type,
+            _node_name(node),
+            node.start_byte,
+            node.end_byte,
+            hashlib.blake2b(source[node.start_byte : node.end_byte], digest_size=8).hexdigest(),
+        )
+        for node in tree.root_node.children
+    ]
+
+
+def _read_cached_outline(file_path: str):
+    """(source, cache key, cached outline or None) of the file"""
+    with open(file_path, "rb") as f:
+        source = f.read()
+    cache = get_outline_cache()
+    key = cache.key("outline", file_path.split(".")[-1], source)
+    return source, key, cache.get(key, decode_outline) if key is not None else None
+
+
+def outline_file(file_path: str) -> list[tuple[str, str, int, int, str]]:
+    """(type, name, start byte, end byte, hash) of every top-level node of the file, in file order.
+
+    Byte ranges index the file as stored. The hash of a node's bytes tells whether it changed without
+    comparing its text; nodes without a name, such as statements, have an empty name. Outlines are
+    cached by content, so an unchanged file is parsed once across runs.
+    """
+    source, key, outline = _read_cached_outline(file_path)
+    if outline is None:
+        outline = _outline(source, file_path.split(".")[-1])
+        if key is not None:
+            get_outline_cache().put(key, encode_outline(outline))
+    return outline
+
 
-        with open(file_path) as f:
-            source_code = f.read()
+def _outline_batch(sourcedir, relative_paths):
+    outlines = []
+    for relative_path in relative_paths:
+        try:
+            outlines.append((relative_path, outline_file(os.path.join(sourcedir, relative_path))))
+        except Exception:
+            # unreadable file, or a grammar that could not be loaded in this worker
+            outlines.append((relative_path, None))
+    return outlines
 
-        tree = parser.parse(bytes(source_code, "utf8"))
 
-        root_node = tree.root_node
+def decompose_repository(sourcedir, files=None, workers=DECOMPOSE_WORKERS):
+    """Yield (relative path, outline) for every file with a tree-sitter grammar, as soon as it is parsed.
 
-        yield from root_node.children
+    files, relative to sourcedir, default to every file not ignored by a .gitignore. Cached outlines come
+    first; the other files are parsed in batches by a pool of worker processes, each keeping one parser per
+    language, and arrive in the order batches finish. The outline of a file that can't be parsed is None.
+    """
+    if files is None:
+        files = [
+            f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            for relative_dir, _, entries in IgnoreMatcher(sourcedir, [".gitignore"]).walk()
+            for entry in entries
+        ]
+    files = [path for path in files if path.split(".")[-1] in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO]
+    # cached outlines are read here; only files that changed since they were last parsed go to the workers
+    changed = []
+    for path in files:
+        try:
+            outline = _read_cached_outline(os.path.join(sourcedir, path))[2]
+        except OSError:
+            outline = None
+        if outline is None:
+            changed.append(path)
+        else:
+            yield path, outline
+    files = changed
+    batches = [files[start : start + DECOMPOSE_BATCH_FILES] for start in range(0, len(files), DECOMPOSE_BATCH_FILES)]
+    if workers <= 1 or len(batches) <= 1:
+        for batch in batches:
+            yield from _outline_batch(sourcedir, batch)
+        return
 
-        spinner.ok("✅ ")
+    # spawned, not forked: the caller's threads may hold locks a forked copy would never see released
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(batches)), mp_context=get_context("spawn"))
+    try:
+        futures = [executor.submit(_outline_batch, sourcedir, batch) for batch in batches]
+        for future in as_completed(futures):
+            yield from future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
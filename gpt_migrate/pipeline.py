@@ -0,0 +1,75 @@
+"""Stages of a producer/consumer pipeline connected by asyncio queues, and where their time goes."""
+
+import asyncio
+import time
+from contextlib import contextmanager
+
+
+class StageMetrics:
+    """Time the workers of one pipeline stage spent on each of three states, summed over all workers.
+
+    busy: handling an item. starved: waiting for an item from the stage before. blocked: waiting for
+    room in the queue of the stage after, i.e. held back by a slower downstream stage.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    @contextmanager
+    def measure(self, state):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            setattr(self, state, getattr(self, state) + time.monotonic() - started)
+
+    def utilization(self, elapsed):
+        capacity = self.workers * elapsed
+        if not capacity:
+            return {"busy": 0.0, "starved": 0.0, "blocked": 0.0}
+        return {state: getattr(self, state) / capacity for state in ["busy", "starved", "blocked"]}
+
+    def summary(self, elapsed):
+        utilization = self.utilization(elapsed)
+        return (
+            f"{self.name}: {self.items} files, {self.workers} workers, busy {utilization['busy']:.0%}, "
+            f"waiting for input {utilization['starved']:.0%}, blocked on the next stage {utilization['blocked']:.0%}"
+        )
+
+
+async def stage_worker(metrics, inbox, handle, outbox=None):
+    """Take items from inbox forever, await handle(item) and put its result into outbox, if any"""
+    while True:
+        with metrics.measure("starved"):
+            item = await inbox.get()
+        with metrics.measure("busy"):
+            result = await handle(item)
+        metrics.items += 1
+        if outbox is not None:
+            with metrics.measure("blocked"):
+                await outbox.put(result)
+
+
+async def forward(inbox, outbox):
+    """Move items from an unbounded queue into a bounded one as room frees up"""
+    while True:
+        await outbox.put(await inbox.get())
+
+
+async def run_until(finished, tasks):
+    """Wait until the finished event is set, then cancel tasks. Re-raises the first task that fails."""
+    waiter = asyncio.ensure_future(finished.wait())
+    try:
+        done, _ = await asyncio.wait([waiter, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task is not waiter and task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in [waiter, *tasks]:
+            task.cancel()
+        await asyncio.gather(waiter, *tasks, return_exceptions=True)
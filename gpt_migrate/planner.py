@@ -0,0 +1,118 @@
+from collections import defaultdict
+
+
+class DependencyGraph:
+    """Internal dependency graph of the source tree, keyed by source file path."""
+
+    def __init__(self):
+        self.deps = {}
+        self.external_deps = {}
+
+    def add_file(self, sourcefile, internal_deps, external_deps):
+        self.deps[sourcefile] = [dep for dep in dict.fromkeys(internal_deps) if dep != sourcefile]
+        self.external_deps[sourcefile] = list(external_deps)
+
+    def dependents(self):
+        dependents = defaultdict(list)
+        for sourcefile, deps in self.deps.items():
+            for dep in deps:
+                dependents[dep].append(sourcefile)
+        return dependents
+
+    def chain_lengths(self):
+        """Length of the longest chain of dependents waiting on each file.
+
+        Files at the bottom of long chains gate the most downstream work, so they are scheduled first.
+        """
+        dependents = self.dependents()
+        lengths = {}
+        for sourcefile in self._reverse_topological_order():
+            lengths[sourcefile] = 1 + max((lengths[parent] for parent in dependents[sourcefile]), default=0)
+        return lengths
+
+    def _reverse_topological_order(self):
+        # Dependents before their dependencies, so chain_lengths() only ever looks at computed parents.
+        # Files caught in an import cycle never reach a zero count; condense() the graph first.
+        remaining = dict.fromkeys(self.deps, 0)
+        for deps in self.deps.values():
+            for dep in deps:
+                remaining[dep] += 1
+        queue = [sourcefile for sourcefile, count in remaining.items() if count == 0]
+        order = []
+        while queue:
+            sourcefile = queue.pop()
+            order.append(sourcefile)
+            for dep in self.deps[sourcefile]:
+                remaining[dep] -= 1
+                if remaining[dep] == 0:
+                    queue.append(dep)
+        return order
+
+    def strongly_connected_components(self):
+        """Group files into strongly connected components (Tarjan's algorithm, iterative).
+
+        A component with more than one file is an import cycle; components are returned dependencies first.
+        """
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        components = []
+        counter = 0
+
+        for root in self.deps:
+            if root in index:
+                continue
+            work = [(root, iter(self.deps[root]))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                sourcefile, deps = work[-1]
+                for dep in deps:
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(self.deps[dep])))
+                        break
+                    if dep in on_stack:
+                        lowlink[sourcefile] = min(lowlink[sourcefile], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[sourcefile])
+                    if lowlink[sourcefile] == index[sourcefile]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == sourcefile:
+                                break
+                        components.append(tuple(sorted(component)))
+        return components
+
+    def condense(self):
+        """Collapse every import cycle into a single node.
+
+        Returns a DependencyGraph keyed by tuples of source files, where each tuple is one group of files
+        that has to be migrated together.
+        """
+        group_of = {}
+        for component in self.strongly_connected_components():
+            for sourcefile in component:
+                group_of[sourcefile] = component
+
+        condensed = DependencyGraph()
+        for component in set(group_of.values()):
+            deps = [group_of[dep] for sourcefile in component for dep in self.deps[sourcefile]]
+            condensed.add_file(
+                component,
+                [dep for dep in deps if dep != component],
+                [dep for sourcefile in component for dep in self.external_deps[sourcefile]],
+            )
+        return condensed
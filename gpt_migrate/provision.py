@@ -0,0 +1,42 @@
+import time
+
+import typer
+from config import EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO, GRAMMAR_BUNDLE_DIR
+from grammars import TREE_SITTER_VERSION, build_bundle
+
+app = typer.Typer()
+
+
+@app.command()
+def provision(
+    bundledir: str = typer.Option(GRAMMAR_BUNDLE_DIR, help="Directory the grammar bundle is written to."),
+    sources: str = typer.Option(
+        None,
+        help="(Optional) directory of grammar checkouts named after their repositories, e.g. tree-sitter-python, to"
+        " build from instead of cloning.",
+    ),
+    extensions: str = typer.Option(
+        None, help="(Optional) comma-separated file extensions whose grammars to bundle. Default is every grammar."
+    ),
+):
+    """Prebuild the tree-sitter grammars into a bundle, so parsing never clones or compiles a grammar."""
+    selected = [extension.strip() for extension in extensions.split(",")] if extensions else None
+    unknown = [extension for extension in selected or [] if extension not in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO]
+    if unknown:
+        typer.echo(typer.style(f"No tree-sitter grammar for: {', '.join(unknown)}", fg=typer.colors.RED))
+        raise typer.Exit(code=1)
+
+    start = time.monotonic()
+    bundle_path = build_bundle(bundledir, sources, selected)
+    seconds = time.monotonic() - start
+    typer.echo(
+        typer.style(
+            f"Grammar bundle for tree-sitter {TREE_SITTER_VERSION} ready in {seconds:.1f}s: {bundle_path}",
+            fg=typer.colors.GREEN,
+        )
+    )
+    typer.echo(f"To parse offline elsewhere, copy {bundledir} over and point GPT_MIGRATE_GRAMMAR_BUNDLE at it.")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,176 @@
+"""Function signatures of target files, read from their parse tree instead of asking the LLM."""
+
+from parser import parse_file
+
+from config import EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO
+
+# Bumped whenever extraction changes, so signatures cached by an older version are not reused
+SIGNATURE_EXTRACTOR_VERSION = 2
+
+FUNCTION_NODE_TYPES = {
+    "function_definition",
+    "function_declaration",
+    "generator_function_declaration",
+    "method_definition",
+    "method_declaration",
+    "constructor_declaration",
+    "function_item",
+    "method",
+    "singleton_method",
+}
+
+CLASS_NODE_TYPES = {
+    "class_definition",
+    "class_declaration",
+    "interface_declaration",
+    "class",
+    "module",
+    "impl_item",
+    "trait_item",
+    "object_definition",
+    "class_specifier",
+}
+
+# Nodes that bind a name to a function expression, e.g. `const f = (a) => ...` or `exports.f = function (a) ...`
+BINDING_NODE_TYPES = {"variable_declarator": ("name", "value"), "assignment_expression": ("left", "right")}
+FUNCTION_VALUE_TYPES = {"arrow_function", "function_expression", "function"}
+
+# Nodes wrapping a definition; comments documenting the definition precede the wrapper
+WRAPPER_NODE_TYPES = {
+    "export_statement",
+    "decorated_definition",
+    "lexical_declaration",
+    "variable_declaration",
+    "expression_statement",
+}
+
+MAX_DESCRIPTION_CHARACTERS = 200
+
+
+# Extensions whose grammar could not be fetched or built; the LLM reads their signatures instead
+_unavailable_grammars = set()
+
+
+def extract_signatures(file_path):
+    """Signatures of the functions, classes and methods of file_path, described by their doc comments.
+
+    Methods follow their class, indented by four spaces. Definitions without a docstring or doc comment
+    get an empty description. Besides signature and description, every entry has the defined name, its
+    kind (function, class or method) and its 1-based line. Returns None if there is no tree-sitter grammar
+    for the file.
+    """
+    extension = file_path.split(".")[-1]
+    if extension not in EXTENSION_TO_TREE_SITTER_GRAMMAR_REPO or extension in _unavailable_grammars:
+        return None
+    try:
+        tree = parse_file(file_path)
+    except Exception:
+        _unavailable_grammars.add(extension)
+        return None
+
+    signatures = []
+
+    def visit(node, depth):
+        if node.type in FUNCTION_NODE_TYPES:
+            kind = "method" if depth else "function"
+            signatures.append(_signature(_declaration_text(node), _name(node), kind, node, depth))
+        elif node.type in CLASS_NODE_TYPES:
+            signatures.append(_signature(_declaration_text(node), _name(node), "class", node, depth))
+            body = node.child_by_field_name("body") or node
+            for child in body.named_children:
+                visit(child, depth + 1)
+        elif node.type in BINDING_NODE_TYPES:
+            name_field, value_field = BINDING_NODE_TYPES[node.type]
+            name, value = node.child_by_field_name(name_field), node.child_by_field_name(value_field)
+            if name is not None and value is not None and value.type in FUNCTION_VALUE_TYPES:
+                declaration = _text(name) + _parameters_text(value)
+                signatures.append(_signature(declaration, _text(name).split(".")[-1], "function", node, depth))
+        else:
+            for child in node.named_children:
+                visit(child, depth)
+
+    # the root itself is never a definition, even where its node type is one elsewhere (Python's "module")
+    for node in tree.root_node.named_children:
+        visit(node, 0)
+    return signatures
+
+
+def _text(node):
+    return node.text.decode("utf8", errors="replace")
+
+
+def _declaration_text(node):
+    """The declaration of a definition without its body, on one line"""
+    body = node.child_by_field_name("body")
+    parameters = node.child_by_field_name("parameters")
+    if body is not None:
+        end = body.start_byte
+    elif parameters is not None:
+        end = parameters.end_byte
+    else:
+        end = node.end_byte
+    text = node.text[: end - node.start_byte].decode("utf8", errors="replace")
+    if body is None and parameters is None:
+        text = text.split("\n")[0]
+    return " ".join(text.split()).removesuffix("=>").rstrip(" :{=")
+
+
+def _parameters_text(function):
+    parameters = function.child_by_field_name("parameters")
+    if parameters is not None:
+        return " ".join(_text(parameters).split())
+    parameter = function.child_by_field_name("parameter")
+    return f"({_text(parameter)})" if parameter is not None else "()"
+
+
+def _name(node):
+    name = node.child_by_field_name("name")
+    if name is None and node.child_by_field_name("declarator") is not None:
+        # C and C++ functions name their innermost declarator, e.g. `int *name(int a)`
+        name = node.child_by_field_name("declarator")
+        while name.child_by_field_name("declarator") is not None:
+            name = name.child_by_field_name("declarator")
+    if name is None:
+        # Rust impl blocks are named after the implementing type
+        name = node.child_by_field_name("type")
+    return _text(name) if name is not None else None
+
+
+def _signature(declaration, name, kind, node, depth):
+    return {
+        "signature": "    " * depth + declaration,
+        "description": _description(node),
+        "name": name,
+        "kind": kind,
+        "line": node.start_point[0] + 1,
+    }
+
+
+def _description(node):
+    """First line of the docstring of a Python definition, or of the comments right before any definition"""
+    body = node.child_by_field_name("body")
+    if body is not None and body.named_child_count and body.named_children[0].type == "expression_statement":
+        statement = body.named_children[0]
+        if statement.named_child_count and statement.named_children[0].type == "string":
+            return _first_line(_text(statement.named_children[0]).lstrip("rbuRBU").strip("\"'"))
+
+    anchor = node
+    while anchor.parent is not None and anchor.parent.type in WRAPPER_NODE_TYPES:
+        anchor = anchor.parent
+    comments = []
+    start_row = anchor.start_point[0]
+    sibling = anchor.prev_named_sibling
+    # only the comment lines directly above the definition, without a blank line in between
+    while sibling is not None and "comment" in sibling.type and sibling.end_point[0] >= start_row - 1:
+        comments.insert(0, _text(sibling))
+        start_row = sibling.start_point[0]
+        sibling = sibling.prev_named_sibling
+    return _first_line("\n".join(comments))
+
+
+def _first_line(text):
+    for line in text.splitlines():
+        line = line.strip().lstrip("/*#-!").rstrip("*/").strip()
+        if line:
+            return line[:MAX_DESCRIPTION_CHARACTERS]
+    return ""
@@ -0,0 +1,388 @@
+"""In-memory snapshots of directory trees, kept current incrementally, for the directory structures in prompts."""
+
+import heapq
+import os
+import threading
+from collections import Counter
+
+from config import CHARS_PER_TOKEN
+from ignore import IgnoreMatcher
+
+# Always hidden: .gitignore files and the bookkeeping gpt-migrate keeps in the target directory
+DEFAULT_IGNORE_PATTERNS = [".gitignore", "**/gpt_migrate/*"]
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _Directory:
+    __slots__ = ("entries", "mtime_ns")
+
+    def __init__(self):
+        # name -> _Directory for subdirectories, None for files, in os.scandir order
+        self.entries = {}
+        self.mtime_ns = None
+
+
+class DirectorySnapshot:
+    """The files and directories under root that are not ignored, scanned once and then kept current.
+
+    Before each render, every known directory is stat'ed and only those whose modification time
+    changed are listed again, so files written by other processes show up too, without walking the
+    whole tree. Files written through write_target_file are added right away. The rendered text is
+    memoized until the tree changes; a changed .gitignore file has the whole tree scanned again. A
+    snapshot is shared by all threads of the process under a lock.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self._tree = None
+        self._matcher = None
+        self._rendered = None
+        self._statistics = None
+
+    def _scan(self, directory, relative_path):
+        """List directory again, reusing the nodes of subdirectories that are still there"""
+        path = os.path.join(self.root, relative_path)
+        directory.mtime_ns = _mtime_ns(path)
+        entries = {}
+        try:
+            with os.scandir(path) as scanner:
+                for entry in scanner:
+                    entry_path = f"{relative_path}/{entry.name}" if relative_path else entry.name
+                    is_dir = entry.is_dir()
+                    # ignored directories are never listed
+                    if self._matcher.ignored(entry_path, is_dir):
+                        continue
+                    if is_dir:
+                        subdirectory = directory.entries.get(entry.name)
+                        if subdirectory is None:
+                            subdirectory = _Directory()
+                            self._scan(subdirectory, entry_path)
+                        entries[entry.name] = subdirectory
+                    else:
+                        entries[entry.name] = None
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        directory.entries = entries
+        self._rendered = None
+        self._statistics = None
+
+    def _revalidate(self, directory, relative_path):
+        if _mtime_ns(os.path.join(self.root, relative_path)) != directory.mtime_ns:
+            self._scan(directory, relative_path)
+        for name, subdirectory in directory.entries.items():
+            if subdirectory is not None:
+                self._revalidate(subdirectory, f"{relative_path}/{name}" if relative_path else name)
+
+    def _refresh(self):
+        if self._tree is None or self._matcher.stale():
+            self._matcher = IgnoreMatcher(self.root, DEFAULT_IGNORE_PATTERNS)
+            self._tree = _Directory()
+            self._scan(self._tree, "")
+        else:
+            self._revalidate(self._tree, "")
+
+    def file_written(self, relative_path):
+        """Add a file just written under root, listing again only the directory it was written to"""
+        with self._lock:
+            if self._tree is None:
+                return
+            parts = os.path.normpath(relative_path).replace(os.sep, "/").split("/")
+            if parts[0] == ".." or os.path.isabs(relative_path):
+                return
+            directory, walked = self._tree, []
+            for part in parts[:-1]:
+                walked.append(part)
+                subdirectory = directory.entries.get(part)
+                if subdirectory is None:
+                    # new directories, and any directory whose listing is outdated, are listed again
+                    self._scan(directory, "/".join(walked[:-1]))
+                    subdirectory = directory.entries.get(part)
+                    if subdirectory is None:
+                        return
+                directory = subdirectory
+            self._scan(directory, "/".join(parts[:-1]))
+
+    def invalidate(self):
+        """Forget the tree, e.g. after many files were copied in; the next render scans it again"""
+        with self._lock:
+            self._tree = None
+            self._rendered = None
+            self._statistics = None
+
+    def render(self):
+        """The tree as indented text, in the layout build_directory_structure has always produced"""
+        with self._lock:
+            self._refresh()
+            if self._rendered is None:
+                lines = []
+                self._render(self._tree, 1, "    ", lines)
+                self._rendered = "".join(lines)
+            return self._rendered
+
+    def render_near(self, focus, max_tokens, related=(), words=frozenset()):
+        """The tree as indented text of at most about max_tokens, detailed around the file focus.
+
+        A tree that fits is rendered in full. Otherwise the directories leading to focus are listed,
+        then more directories are opened by relevance while the budget lasts: those holding files of
+        related, then those whose name is one of words (e.g. the identifiers of the file's imports),
+        then the closest to focus. Directories left closed are summarized as "name/ (312 files, .py)".
+        """
+        with self._lock:
+            self._refresh()
+            if self._rendered is None:
+                lines = []
+                self._render(self._tree, 1, "    ", lines)
+                self._rendered = "".join(lines)
+            budget = max_tokens * CHARS_PER_TOKEN
+            if len(self._rendered) <= budget:
+                return self._rendered
+            if self._statistics is None:
+                self._statistics = {}
+                _count_files(self._tree, self._statistics)
+            return _FocusedRendering(self._tree, self._statistics, focus, related, words, budget).render()
+
+    def _render(self, directory, depth, parent_prefix, lines):
+        indent = "    " * depth
+        names = list(directory.entries)
+        for index, name in enumerate(names):
+            is_last = index == len(names) - 1
+            subdirectory = directory.entries[name]
+            branch = "└── " if is_last else "├── "
+            lines.append(f"{indent}{parent_prefix}{branch}{name}{'/' if subdirectory is not None else ''}\n")
+            if subdirectory is not None:
+                self._render(subdirectory, depth + 1, parent_prefix + ("    " if is_last else "│   "), lines)
+
+
+def _count_files(directory, statistics):
+    """Fill statistics with the number of files, by extension, under every directory of the tree"""
+    counts = Counter()
+    for name, subdirectory in directory.entries.items():
+        if subdirectory is None:
+            counts[os.path.splitext(name)[1]] += 1
+        else:
+            counts.update(_count_files(subdirectory, statistics))
+    statistics[id(directory)] = counts
+    return counts
+
+
+def _describe(counts):
+    files = sum(counts.values())
+    described = f"{files} file" if files == 1 else f"{files} files"
+    extensions = [extension for extension, _ in counts.most_common() if extension][:3]
+    return f"{described}, {', '.join(extensions)}" if extensions else described
+
+
+# Longest line summarizing the entries a directory has no room for
+MORE_ENTRIES_PLACEHOLDER = "... 999999 more entries (999999 files, .xxxx, .xxxx, .xxxx)"
+
+
+def _line_length(depth, text):
+    # indent and branches take 8 characters per level, plus the 4 of the entry's own branch
+    return 8 * depth + 4 + len(text) + 1
+
+
+class _FocusedRendering:
+    """One budgeted rendering of a tree around a file; see DirectorySnapshot.render_near"""
+
+    def __init__(self, tree, statistics, focus, related, words, budget):
+        self.tree = tree
+        self.statistics = statistics
+        self.words = words
+        self.budget = budget
+        focus = focus.replace(os.sep, "/")
+        self.focus_parts = focus.split("/")[:-1]
+        self.focus_extension = os.path.splitext(focus)[1]
+        self.spine = {"/".join(self.focus_parts[:depth]) for depth in range(len(self.focus_parts) + 1)}
+        self.focus = focus
+        # related files under every directory
+        self.related = set()
+        self.related_counts = Counter()
+        for path in related:
+            parts = path.replace(os.sep, "/").split("/")
+            self.related.add("/".join(parts))
+            for depth in range(len(parts)):
+                self.related_counts["/".join(parts[:depth])] += 1
+        # directory path -> names of the entries listed, for every opened directory
+        self.opened = {}
+
+    def _summary(self, name, subdirectory):
+        counts = self.statistics[id(subdirectory)]
+        return f"{name}/ ({_describe(counts)})" if counts else f"{name}/"
+
+    def _relevance(self, path, name, is_dir):
+        if path in self.spine or path == self.focus:
+            return 3
+        if path in self.related or self.related_counts[path]:
+            return 2
+        stem = name if is_dir else os.path.splitext(name)[0]
+        if stem in self.words:
+            return 1
+        return 0.5 if not is_dir and os.path.splitext(name)[1] == self.focus_extension else 0
+
+    def _distance(self, path):
+        parts = path.split("/") if path else []
+        common = 0
+        for part, focus_part in zip(parts, self.focus_parts):
+            if part != focus_part:
+                break
+            common += 1
+        return len(parts) + len(self.focus_parts) - 2 * common
+
+    def _open(self, directory, path, depth, used, forced):
+        """List the entries of a directory, as many as fit when forced, else all of them or none.
+
+        Returns the characters used afterwards, or None if the directory was left closed.
+        """
+        entries = []
+        for name, subdirectory in directory.entries.items():
+            entry_path = f"{path}/{name}" if path else name
+            text = name if subdirectory is None else self._summary(name, subdirectory)
+            cost = _line_length(depth + 1, text)
+            entries.append((name, cost, self._relevance(entry_path, name, subdirectory is not None)))
+        # a directory listed in full shows "name/" instead of its summary
+        own = 0
+        if path:
+            name = path.rpartition("/")[2]
+            own = _line_length(depth, name + "/") - _line_length(depth, self._summary(name, directory))
+        total = own + sum(cost for _, cost, _ in entries)
+        if used + total <= self.budget:
+            self.opened[path] = [name for name, _, _ in entries]
+            return used + total
+        if not forced:
+            return None
+        # list the most relevant entries that fit, and one line summarizing the rest
+        used += own + _line_length(depth + 1, MORE_ENTRIES_PLACEHOLDER)
+        if used > self.budget and path not in self.spine:
+            return None
+        listed = []
+        for index in sorted(range(len(entries)), key=lambda index: -entries[index][2]):
+            name, cost, _ = entries[index]
+            if used + cost <= self.budget:
+                listed.append(name)
+                used += cost
+        self.opened[path] = listed
+        return used
+
+    def render(self):
+        # the directories on the way to the focus file are opened first, deepest first; each keeps room
+        # for the lines leading from its parent down to it
+        spine = [(self.tree, "")]
+        for part in self.focus_parts:
+            subdirectory = spine[-1][0].entries.get(part)
+            if subdirectory is None:
+                break
+            spine.append((subdirectory, f"{spine[-1][1]}/{part}" if spine[-1][1] else part))
+        minimum = [_line_length(depth + 1, MORE_ENTRIES_PLACEHOLDER) for depth in range(len(spine))]
+        for depth in range(len(spine) - 1):
+            minimum[depth] += _line_length(depth + 1, self._summary(self.focus_parts[depth], spine[depth + 1][0]))
+        used = sum(minimum)
+        for depth in reversed(range(len(spine))):
+            directory, path = spine[depth]
+            used = self._open(directory, path, depth, used - minimum[depth], forced=True)
+
+        # then the most relevant of the directories left closed, while the budget lasts
+        candidates = []
+        counter = 0
+
+        def push(directory, path, depth):
+            nonlocal counter
+            for name in self.opened[path]:
+                subdirectory = directory.entries[name]
+                entry_path = f"{path}/{name}" if path else name
+                if entry_path in self.opened:
+                    push(subdirectory, entry_path, depth + 1)
+                elif subdirectory is not None and subdirectory.entries:
+                    key = (
+                        -self._relevance(entry_path, name, True),
+                        self._distance(entry_path),
+                        sum(self.statistics[id(subdirectory)].values()),
+                        counter,
+                    )
+                    heapq.heappush(candidates, (key, subdirectory, entry_path, depth + 1))
+                    counter += 1
+
+        push(self.tree, "", 0)
+        while candidates:
+            key, directory, path, depth = heapq.heappop(candidates)
+            # directories holding related files show what fits of them rather than nothing
+            opened = self._open(directory, path, depth, used, forced=-key[0] >= 2)
+            if opened is None:
+                continue
+            used = opened
+            push(directory, path, depth)
+
+        lines = []
+        self._render(self.tree, "", 1, "    ", lines)
+        return "".join(lines)
+
+    def _render(self, directory, path, depth, parent_prefix, lines):
+        indent = "    " * depth
+        listed = set(self.opened[path])
+        names = [name for name in directory.entries if name in listed]
+        hidden = Counter()
+        hidden_entries = 0
+        for name, subdirectory in directory.entries.items():
+            if name not in listed:
+                hidden_entries += 1
+                if subdirectory is None:
+                    hidden[os.path.splitext(name)[1]] += 1
+                else:
+                    hidden.update(self.statistics[id(subdirectory)])
+        for index, name in enumerate(names):
+            is_last = index == len(names) - 1 and not hidden_entries
+            subdirectory = directory.entries[name]
+            entry_path = f"{path}/{name}" if path else name
+            branch = "└── " if is_last else "├── "
+            if subdirectory is None:
+                text = name
+            elif entry_path in self.opened:
+                text = name + "/"
+            else:
+                text = self._summary(name, subdirectory)
+            lines.append(f"{indent}{parent_prefix}{branch}{text}\n")
+            if subdirectory is not None and entry_path in self.opened:
+                self._render(
+                    subdirectory, entry_path, depth + 1, parent_prefix + ("    " if is_last else "│   "), lines
+                )
+        if hidden_entries:
+            lines.append(f"{indent}{parent_prefix}└── ... {hidden_entries} more entries ({_describe(hidden)})\n")
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_directory_snapshot(path):
+    """The snapshot of the tree under path, created once per process"""
+    root = os.path.abspath(path)
+    with _snapshots_lock:
+        if root not in _snapshots:
+            _snapshots[root] = DirectorySnapshot(root)
+        return _snapshots[root]
+
+
+def directory_changed(path):
+    """Make every snapshot containing path scan its tree again on its next render"""
+    path = os.path.abspath(path)
+    with _snapshots_lock:
+        snapshots = list(_snapshots.values())
+    for snapshot in snapshots:
+        if path == snapshot.root or path.startswith(snapshot.root + os.sep):
+            snapshot.invalidate()
+
+
+def file_written(path):
+    """Record a file written at path in every snapshot containing it"""
+    path = os.path.abspath(path)
+    with _snapshots_lock:
+        snapshots = list(_snapshots.values())
+    for snapshot in snapshots:
+        if path.startswith(snapshot.root + os.sep):
+            snapshot.file_written(os.path.relpath(path, snapshot.root))
@@ -1,4 +1,5 @@
 import os
+import re
 import subprocess
 
 import typer
@@ -14,13 +15,27 @@ from config import (
     IDENTIFY_FILE,
     MAX_DOCKER_LOG_CHARACTERS,
     MAX_ERROR_MESSAGE_CHARACTERS,
+    MAX_SYMBOL_DEFINITIONS,
     MOVE_FILES,
     SINGLEFILE,
     WRITE_CODE,
 )
+from symbols import SOURCE, TARGET, get_symbol_index
 from utils import build_directory_structure, construct_relevant_files, llm_run, llm_write_file, prompt_constructor
 
 
+def find_symbol_definitions(text, globals, root=None):
+    """Where the identifiers mentioned in text are defined, one definition per line, from the symbol index"""
+    names = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]{2,}", text))
+    definitions = get_symbol_index(globals.targetdir).find(names, root=root)[:MAX_SYMBOL_DEFINITIONS]
+    if not definitions:
+        return "None found."
+    return "\n".join(
+        f"{'migration_source/' if root_name == SOURCE else ''}{path}:{line} {signature.strip()}"
+        for root_name, path, line, _, signature in definitions
+    )
+
+
 def debug_error(error_message, relevant_files, globals):
     identify_action_template = prompt_constructor(HIERARCHY, GUIDELINES, IDENTIFY_ACTION)
 
@@ -120,6 +135,11 @@ def debug_error(error_message, relevant_files, globals):
                 error_message=error_message[-min(MAX_ERROR_MESSAGE_CHARACTERS, len(error_message)) :],
                 target_directory_structure=build_directory_structure(globals.targetdir),
                 docker_logs=docker_logs[-min(MAX_DOCKER_LOG_CHARACTERS, len(docker_logs)) :],
+                symbol_definitions=find_symbol_definitions(
+                    error_message[-MAX_ERROR_MESSAGE_CHARACTERS:] + docker_logs[-MAX_DOCKER_LOG_CHARACTERS:],
+                    globals,
+                    root=TARGET,
+                ),
             ),
         )
 
@@ -152,6 +172,7 @@ def debug_error(error_message, relevant_files, globals):
                     sourcelang=globals.sourcelang,
                     docker_logs=docker_logs[-min(MAX_DOCKER_LOG_CHARACTERS, len(docker_logs)) :],
                     relevant_files=relevant_files,
+                    symbol_definitions=find_symbol_definitions(error_message[-MAX_ERROR_MESSAGE_CHARACTERS:], globals),
                     guidelines=globals.guidelines,
                 ),
             )
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import os
+import socket
+
+import typer
+from config import JOB_LEASE_SECONDS, JOB_POLL_SECONDS
+from incremental import file_hash
+from jobqueue import get_job_queue
+from planner import DependencyGraph
+
+from steps.migrate import aget_function_signatures, amigrate_source_file, plan_migration
+
+MIGRATE = "migrate"
+SIGNATURES = "signatures"
+
+# Meta key of the settings every worker rebuilds the run from
+RUN_META_KEY = "run"
+
+
+def run_record(globals):
+    """Everything a worker needs to send the same prompts as the process that queued the jobs"""
+    return {
+        "sourcedir": globals.sourcedir,
+        "targetdir": globals.targetdir,
+        "sourcelang": globals.sourcelang,
+        "targetlang": globals.targetlang,
+        "sourceentry": globals.sourceentry,
+        "source_directory_structure": globals.source_directory_structure,
+        "operating_system": globals.operating_system,
+        "testfiles": globals.testfiles,
+        "sourceport": globals.sourceport,
+        "targetport": globals.targetport,
+        "guidelines": globals.guidelines,
+        "model": globals.ai.model_name,
+        "temperature": globals.ai.temperature,
+        "max_tokens": globals.ai.max_tokens,
+        "signature_model": globals.signature_ai.model_name if globals.signature_ai is not None else None,
+    }
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_migration(graph: DependencyGraph, globals, queue, manifest=None):
+    """Queue a migrate job and a signatures job for every group of files of the graph.
+
+    A group's migrate job waits for the signatures jobs of the groups it depends on. Job keys hash the
+    group's source content together with the keys of its dependencies, so a changed file gets new jobs
+    for itself and everything depending on it, while jobs for unchanged files stay done. Files that are
+    current in manifest are queued as already migrated. Returns the job key of every group.
+    """
+    source_hashes = {sourcefile: file_hash(os.path.join(globals.sourcedir, sourcefile)) for sourcefile in graph.deps}
+    stale = manifest.stale_files(graph, source_hashes) if manifest is not None else set(graph.deps)
+    condensed = graph.condense()
+    priority = condensed.chain_lengths()
+
+    keys = {}
+    for group in condensed.strongly_connected_components():
+        # the condensed graph is acyclic, so every component is a single group, dependencies first
+        group = group[0]
+        dep_keys = sorted(keys[dep] for dep in condensed.deps[group])
+        digest = hashlib.sha256()
+        for sourcefile in group:
+            digest.update(f"{sourcefile}\0{source_hashes[sourcefile]}\0".encode())
+        for dep_key in dep_keys:
+            digest.update(dep_key.encode("utf-8"))
+        keys[group] = f"{','.join(group)}@{digest.hexdigest()[:16]}"
+
+        payload = {
+            "group": list(group),
+            "deps": {sourcefile: graph.deps[sourcefile] for sourcefile in group},
+            "external_deps": {sourcefile: graph.external_deps[sourcefile] for sourcefile in group},
+            "hashes": {sourcefile: source_hashes[sourcefile] for sourcefile in group},
+        }
+        reused = None
+        if not any(sourcefile in stale for sourcefile in group):
+            reused = {sourcefile: manifest.files[sourcefile]["target"] for sourcefile in group}
+        queue.enqueue(
+            MIGRATE,
+            keys[group],
+            payload,
+            depends_on=[(SIGNATURES, dep_key) for dep_key in dep_keys],
+            priority=priority[group],
+            result=reused,
+        )
+        queue.enqueue(
+            SIGNATURES,
+            keys[group],
+            {"group": list(group)},
+            depends_on=[(MIGRATE, keys[group])],
+            priority=priority[group],
+            result=reused,
+        )
+    return keys
+
+
+async def run_migrate_job(job, globals):
+    """Migrate the files of one group. Returns the target file of each."""
+    payload = job.payload
+    graph = DependencyGraph()
+    for sourcefile in payload["group"]:
+        graph.add_file(sourcefile, payload["deps"][sourcefile], payload["external_deps"][sourcefile])
+    target_files = {}
+    for result in job.dep_results.values():
+        target_files.update(result)
+
+    async def migrate(sourcefile):
+        target_deps = [target_files[dep] for dep in graph.deps[sourcefile] if dep in target_files]
+        return sourcefile, await amigrate_source_file(
+            sourcefile, graph, target_deps, payload["hashes"][sourcefile], True, globals
+        )
+
+    return dict(await asyncio.gather(*[migrate(sourcefile) for sourcefile in payload["group"]]))
+
+
+async def run_signatures_job(job, globals):
+    """Index the signatures of a group's migrated files, so dependent groups find them ready"""
+    target_files = job.dep_results[(MIGRATE, job.key)]
+    targets = [target for target in target_files.values() if os.path.isfile(os.path.join(globals.targetdir, target))]
+    await aget_function_signatures(targets, globals)
+    return target_files
+
+
+JOB_HANDLERS = {MIGRATE: run_migrate_job, SIGNATURES: run_signatures_job}
+
+
+async def work(queue, globals, slots, wait=False):
+    """Run jobs from the queue, slots at a time, until no job is waiting or running.
+
+    With wait, keep polling for new jobs instead. Leases are renewed while a job runs; a job that
+    raises is handed back to the queue to be retried.
+    """
+    owner = worker_id()
+    completed = 0
+
+    async def keep_leased(job):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(queue.renew, job, owner):
+                return
+
+    async def slot():
+        nonlocal completed
+        while True:
+            job = await asyncio.to_thread(queue.lease, owner, list(JOB_HANDLERS))
+            if job is None:
+                if not wait and queue.drained():
+                    return
+                await asyncio.sleep(JOB_POLL_SECONDS)
+                continue
+            renewer = asyncio.ensure_future(keep_leased(job))
+            try:
+                result = await JOB_HANDLERS[job.kind](job, globals)
+            except Exception as e:
+                typer.echo(
+                    typer.style(
+                        f"{job.kind} job {job.key} failed (attempt {job.attempts}): {type(e).__name__}: {e}",
+                        fg=typer.colors.YELLOW,
+                    )
+                )
+                await asyncio.to_thread(queue.fail, job, owner, f"{type(e).__name__}: {e}")
+                continue
+            finally:
+                renewer.cancel()
+            if await asyncio.to_thread(queue.complete, job, owner, result):
+                completed += 1
+            else:
+                typer.echo(
+                    typer.style(f"Lost the lease on {job.kind} job {job.key}; its result was discarded.", dim=True)
+                )
+
+    await asyncio.gather(*[slot() for _ in range(slots)])
+    return completed
+
+
+def record_migration(graph, globals, queue, keys, manifest=None):
+    """Record the files migrated by the jobs of keys in the manifest. Raises if any of the jobs failed."""
+    failures = [(kind, key, error) for kind, key, error in queue.failures() if key in keys.values()]
+    if failures:
+        details = "\n".join(f"  {kind} {key}: {error}" for kind, key, error in failures)
+        raise RuntimeError(f"{len(failures)} migration jobs failed:\n{details}")
+    if manifest is None:
+        return
+    results = queue.results(MIGRATE)
+    for group, key in keys.items():
+        for sourcefile, target in results[key].items():
+            manifest.record(
+                sourcefile,
+                file_hash(os.path.join(globals.sourcedir, sourcefile)),
+                graph.deps[sourcefile],
+                graph.external_deps[sourcefile],
+                target,
+            )
+    manifest.prune(graph.deps)
+
+
+async def distribute_migration(sourceentry, globals, manifest=None) -> DependencyGraph:
+    """Plan the migration, queue it as jobs and work on them until every job is done.
+
+    Any number of `python worker.py TARGETDIR` processes can take jobs from the same queue meanwhile.
+    Jobs left over from an earlier run with the same settings are reused when done, retried when they
+    failed and dropped when their files changed. Returns the dependency graph.
+    """
+    graph = await plan_migration(sourceentry, globals, manifest)
+    queue = get_job_queue(globals.targetdir)
+    if queue.get_meta(RUN_META_KEY) != run_record(globals):
+        queue.reset()
+        queue.set_meta(RUN_META_KEY, run_record(globals))
+    keys = enqueue_migration(graph, globals, queue, manifest)
+    queue.retain(keys.values())
+    queue.retry_failed()
+    counts = queue.counts()
+    typer.echo(
+        typer.style(
+            f"Queued the migration of {len(graph.deps)} files: {counts['pending']} jobs to run in {queue.path}. "
+            f"Start more workers with `python worker.py {globals.targetdir}`.",
+            fg=typer.colors.BLUE,
+        )
+    )
+    await work(queue, globals, slots=globals.ai.limiter.max_concurrency)
+    record_migration(graph, globals, queue, keys, manifest)
+    return graph
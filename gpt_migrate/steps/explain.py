@@ -14,34 +14,29 @@ from config import (
     SINGLEFILE,
     WRITE_CODE,
 )
+from store import get_memory_store
 from utils import (
     build_directory_structure,
     copy_files,
     extract_json_from_response,
-    file_exists_in_memory,
     get_near_source_directory_structure,
     llm_run,
     llm_write_file,
     prompt_constructor,
-    read_from_memory,
     write_file_explain,
-    write_to_memory,
 )
 
 
 def get_function_signatures_explain(targetfiles: list[str], globals):
     """Get the function signatures and a one-sentence summary for each function"""
     all_sigs = []
+    store = get_memory_store()
 
     for targetfile in targetfiles:
-        sigs_file_name = targetfile + "_sigs.json"
+        sigs_name = targetfile + "_sigs.json"
 
-        if file_exists_in_memory(sigs_file_name):
-            with open(
-                os.path.join("gpt_migrate_explain/gpt_migrate/memory", sigs_file_name),
-            ) as f:
-                sigs = json.load(f)
-            all_sigs.extend(sigs)
+        if store.exists(sigs_name):
+            all_sigs.extend(store.get(sigs_name))
 
         else:
             function_signatures_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_FUNCTION_SIGNATURES_EXPLAIN)
@@ -69,15 +64,7 @@ def get_function_signatures_explain(targetfiles: list[str], globals):
                     )
                 )
                 all_sigs.extend(sigs)
-
-                memory_dir = "gpt_migrate_explain/gpt_migrate/memory"
-                sigs_file_path = os.path.join(memory_dir, sigs_file_name)
-                os.makedirs(os.path.dirname(sigs_file_path), exist_ok=True)
-                with open(
-                    sigs_file_path,
-                    "w",
-                ) as f:
-                    json.dump(sigs, f)
+                store.put(sigs_name, sigs)
             except json.decoder.JSONDecodeError:
                 pass
 
@@ -108,7 +95,7 @@ def get_dependencies_explain(sourcefile, globals):
     )
 
     external_deps_list = external_dependencies.split(",") if external_dependencies != "NONE" else []
-    write_to_memory("external_dependencies", external_deps_list)
+    get_memory_store().add("external_dependencies", external_deps_list)
 
     near_source_directory_structure = get_near_source_directory_structure(
         globals.source_directory_structure, sourcefile
@@ -143,7 +130,7 @@ def get_dependencies_explain(sourcefile, globals):
         [dep for dep in internal_dependencies.split(",") if dep] if internal_dependencies != "NONE" else []
     )
 
-    write_to_memory("internal_dependencies", internal_deps_list)
+    get_memory_store().add("internal_dependencies", internal_deps_list)
 
     return internal_deps_list, external_deps_list
 
@@ -218,7 +205,7 @@ def add_env_files_explain(globals):
     with open(dockerfile_path) as file:
         dockerfile_content = file.read()
 
-    external_deps = read_from_memory("external_dependencies")
+    external_deps = "".join(dep + "\n" for dep in get_memory_store().items("external_dependencies"))
 
     prompt = add_docker_requirements_template.format(
         dockerfile_content=dockerfile_content,
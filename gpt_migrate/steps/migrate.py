@@ -1,76 +1,239 @@
+import asyncio
 import json
 import os
+import re
+import threading
+import time
+from collections import defaultdict
+from parser import decompose_repository
 
 import typer
+from chunking import split_source_file
 from config import (
     ADD_DOCKER_REQUIREMENTS,
+    CHARS_PER_TOKEN,
+    DESCRIBE_FUNCTION_SIGNATURES,
+    DIRECTORY_STRUCTURE_TOKENS,
     EXCLUDED_FILES,
+    EXTENSION_TO_LANGUAGE,
     GET_EXTERNAL_DEPS,
     GET_FUNCTION_SIGNATURES,
     GET_INTERNAL_DEPS,
     GUIDELINES,
     HIERARCHY,
+    MAP_EXTERNAL_DEPS,
+    MIGRATION_CHUNK_TOKENS,
+    PIPELINE_QUEUE_SIZE,
     REFINE_DOCKERFILE,
+    SIGNATURE_WORKERS,
     SINGLEFILE,
     WRITE_CODE,
     WRITE_MIGRATION,
+    WRITE_MIGRATION_HEADER,
+    WRITE_MIGRATION_PART,
 )
+from imports import find_imported_packages, find_internal_dependencies, get_source_index
+from incremental import file_hash
+from packages import (
+    detect_source_packages,
+    load_package_equivalents,
+    parse_package_mapping,
+    read_manifest_packages,
+    store_package_equivalents,
+)
+from pipeline import StageMetrics, forward, run_until, stage_worker
+from planner import DependencyGraph
+from symbols import SOURCE, TARGET, get_symbol_index
 from utils import (
+    allm_run,
+    allm_write_file,
     build_directory_structure,
     convert_sigs_to_string,
     copy_files,
-    file_exists_in_memory,
-    llm_run,
     llm_write_file,
     prompt_constructor,
-    read_from_memory,
-    write_to_memory,
+    write_target_file,
 )
 
 
-def get_function_signatures(targetfiles: list[str], globals):
-    """Get the function signatures and a one-sentence summary for each function"""
+async def aget_function_signatures(targetfiles: list[str], globals):
+    """Get the function signatures and a one-sentence summary for each function of the target files, all at once"""
+    index = get_symbol_index(globals.targetdir)
+    describe = globals.signature_ai is not None
+
+    async def sigs_for(targetfile):
+        sigs = index.signatures(TARGET, globals.targetdir, targetfile, described=describe)
+        if sigs is not None:
+            return sigs
+        sigs = index.update_file(TARGET, globals.targetdir, targetfile)
+        if sigs is None:
+            sigs = _parse_sigs(
+                await allm_run(
+                    _function_signatures_prompt(targetfile, globals),
+                    waiting_message=f"Parsing function signatures for {targetfile}...",
+                    success_message=None,
+                    globals=globals,
+                )
+            )
+            index.set_signatures(TARGET, globals.targetdir, targetfile, sigs, described=True)
+        elif describe:
+            if _undescribed(sigs):
+                typer.echo(typer.style(f"Describing function signatures of {targetfile}...", dim=True))
+                _apply_descriptions(
+                    sigs, await globals.signature_ai.arun(_describe_signatures_prompt(targetfile, sigs, globals))
+                )
+            index.set_signatures(TARGET, globals.targetdir, targetfile, sigs, described=True)
+        return sigs
+
     all_sigs = []
+    for sigs in await asyncio.gather(*[sigs_for(targetfile) for targetfile in targetfiles]):
+        all_sigs.extend(sigs)
+    return all_sigs
 
-    for targetfile in targetfiles:
-        sigs_file_name = targetfile + "_sigs.json"
 
-        if file_exists_in_memory(sigs_file_name):
-            with open(os.path.join("memory", sigs_file_name)) as f:
-                sigs = json.load(f)
-            all_sigs.extend(sigs)
+def _read_target_file(targetfile, globals):
+    with open(os.path.join(globals.targetdir, targetfile)) as file:
+        return file.read()
 
-        else:
-            function_signatures_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_FUNCTION_SIGNATURES)
 
-            targetfile_content = ""
-            with open(os.path.join(globals.targetdir, targetfile)) as file:
-                targetfile_content = file.read()
+def _function_signatures_prompt(targetfile, globals):
+    function_signatures_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_FUNCTION_SIGNATURES)
 
-            prompt = function_signatures_template.format(
-                targetlang=globals.targetlang, sourcelang=globals.sourcelang, targetfile_content=targetfile_content
-            )
+    return function_signatures_template.format(
+        targetlang=globals.targetlang,
+        sourcelang=globals.sourcelang,
+        targetfile_content=_read_target_file(targetfile, globals),
+    )
 
-            sigs = json.loads(
-                llm_run(
-                    prompt,
-                    waiting_message=f"Parsing function signatures for {targetfile}...",
-                    success_message=None,
-                    globals=globals,
+
+def _describe_signatures_prompt(targetfile, sigs, globals):
+    describe_signatures_template = prompt_constructor(HIERARCHY, GUIDELINES, DESCRIBE_FUNCTION_SIGNATURES)
+
+    return describe_signatures_template.format(
+        targetlang=globals.targetlang,
+        sourcelang=globals.sourcelang,
+        targetfile_content=_read_target_file(targetfile, globals),
+        signatures="\n".join(
+            f"{number}. {sig['signature'].strip()}" for number, sig in enumerate(_undescribed(sigs), 1)
+        ),
+    )
+
+
+def _parse_sigs(response):
+    if response.strip() == "NONE":
+        return []
+    return json.loads(response)
+
+
+def _undescribed(sigs):
+    return [sig for sig in sigs if not sig["description"]]
+
+
+def _apply_descriptions(sigs, response):
+    """Fill in the descriptions answered by the LLM; a malformed answer leaves them empty"""
+    match = re.search(r"\[.*\]", response, re.DOTALL)
+    try:
+        descriptions = json.loads(match.group(0)) if match else []
+    except ValueError:
+        descriptions = []
+    for sig, description in zip(_undescribed(sigs), descriptions):
+        sig["description"] = str(description)
+
+
+async def aget_dependencies(sourcefile, globals):
+    """Get external and internal dependencies of source file; both dependency prompts are sent at once"""
+
+    external_deps_prompt, internal_deps_prompt = _dependency_prompts(sourcefile, globals)
+
+    # static import reading parses the file, and may first fetch and build a grammar: keep it off the event loop
+    requests = {}
+    external_deps_list = await asyncio.to_thread(_mapped_external_dependencies, sourcefile, globals)
+    if external_deps_list is None:
+        requests["external"] = allm_run(
+            external_deps_prompt,
+            waiting_message=f"Identifying external dependencies for {sourcefile}...",
+            success_message=None,
+            globals=globals,
+        )
+    internal_deps_list = await asyncio.to_thread(find_internal_dependencies, sourcefile, globals.sourcedir)
+    if internal_deps_list is None:
+        requests["internal"] = allm_run(
+            internal_deps_prompt,
+            waiting_message=f"Identifying internal dependencies for {sourcefile}...",
+            success_message=None,
+            globals=globals,
+        )
+
+    responses = dict(zip(requests, await asyncio.gather(*requests.values())))
+    if "external" in responses:
+        external_deps_list = _parse_external_dependencies(responses["external"])
+    if "internal" in responses:
+        internal_deps_list = _parse_internal_dependencies(sourcefile, responses["internal"])
+    globals.external_deps.update(dict.fromkeys(external_deps_list))
+
+    return internal_deps_list, external_deps_list
+
+
+async def amap_external_dependencies(globals):
+    """Map every third-party package of the source tree to its target language equivalents.
+
+    Packages come from the manifests (requirements.txt, package.json, Cargo.toml, ...) and from the import
+    statements of all source files written in the entrypoint's language. Equivalents are cached in the
+    memory store, shared by every run, so the LLM is only asked once, in a single prompt, about packages
+    it has not mapped before. Leaves globals.package_map unset if the answer can't be parsed, in which case
+    dependencies are identified per file as before.
+    """
+    entry_language = EXTENSION_TO_LANGUAGE.get(globals.sourceentry.split(".")[-1])
+    sourcefiles = [
+        path
+        for path in sorted(get_source_index(globals.sourcedir).files)
+        if entry_language and EXTENSION_TO_LANGUAGE.get(path.split(".")[-1]) == entry_language
+    ]
+    packages = detect_source_packages(globals.sourcedir, sourcefiles)
+    equivalents = await asyncio.to_thread(load_package_equivalents, globals.sourcelang, globals.targetlang)
+
+    unknown_packages = [package for package in packages if package not in equivalents]
+    if unknown_packages:
+        map_external_deps_template = prompt_constructor(HIERARCHY, GUIDELINES, MAP_EXTERNAL_DEPS)
+        prompt = map_external_deps_template.format(
+            targetlang=globals.targetlang,
+            sourcelang=globals.sourcelang,
+            source_packages="\n".join(unknown_packages),
+        )
+        response = await allm_run(
+            prompt,
+            waiting_message=f"Finding {globals.targetlang} equivalents for {len(unknown_packages)} packages...",
+            success_message=None,
+            globals=globals,
+        )
+        try:
+            mapping = parse_package_mapping(response)
+        except ValueError:
+            typer.echo(
+                typer.style(
+                    "Warning: couldn't parse the package mapping. Identifying external dependencies file by file instead.",
+                    fg=typer.colors.YELLOW,
                 )
             )
+            return
+        await asyncio.to_thread(store_package_equivalents, globals.sourcelang, globals.targetlang, mapping)
+        equivalents.update(mapping)
 
-            all_sigs.extend(sigs)
+    globals.package_map = {package: equivalents.get(package, []) for package in packages}
+    for package in read_manifest_packages(globals.sourcedir):
+        globals.external_deps.update(dict.fromkeys(globals.package_map[package]))
 
-            with open(os.path.join("memory", sigs_file_name), "w") as f:
-                json.dump(sigs, f)
 
-    return all_sigs
+def _mapped_external_dependencies(sourcefile, globals):
+    if globals.package_map is None:
+        return None
+    packages = find_imported_packages(sourcefile, globals.sourcedir)
+    if packages is None:
+        return None
+    return list(dict.fromkeys(dep for package in packages for dep in globals.package_map.get(package, [])))
 
 
-def get_dependencies(sourcefile, globals):
-    """Get external and internal dependencies of source file"""
-
+def _dependency_prompts(sourcefile, globals):
     external_deps_prompt_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_EXTERNAL_DEPS)
     internal_deps_prompt_template = prompt_constructor(HIERARCHY, GUIDELINES, GET_INTERNAL_DEPS)
 
@@ -78,83 +241,476 @@ def get_dependencies(sourcefile, globals):
     with open(os.path.join(globals.sourcedir, sourcefile)) as file:
         sourcefile_content = file.read()
 
-    prompt = external_deps_prompt_template.format(
+    external_deps_prompt = external_deps_prompt_template.format(
         targetlang=globals.targetlang, sourcelang=globals.sourcelang, sourcefile_content=sourcefile_content
     )
 
-    external_dependencies = llm_run(
-        prompt,
-        waiting_message=f"Identifying external dependencies for {sourcefile}...",
-        success_message=None,
-        globals=globals,
-    )
-
-    external_deps_list = external_dependencies.split(",") if external_dependencies != "NONE" else []
-    write_to_memory("external_dependencies", external_deps_list)
-
-    prompt = internal_deps_prompt_template.format(
+    internal_deps_prompt = internal_deps_prompt_template.format(
         targetlang=globals.targetlang,
         sourcelang=globals.sourcelang,
         sourcefile=sourcefile,
         sourcefile_content=sourcefile_content,
-        source_directory_structure=globals.source_directory_structure,
+        source_directory_structure=_source_directory_structure(sourcefile, sourcefile_content, globals),
     )
 
-    internal_dependencies = llm_run(
-        prompt,
-        waiting_message=f"Identifying internal dependencies for {sourcefile}...",
-        success_message=None,
-        globals=globals,
+    return external_deps_prompt, internal_deps_prompt
+
+
+def _import_words(content):
+    """Identifiers and path segments in a file, to tell which directories and files its imports point at"""
+    return frozenset(re.findall(r"[A-Za-z_][\w-]*", content))
+
+
+def _source_directory_structure(sourcefile, sourcefile_content, globals):
+    return build_directory_structure(
+        globals.sourcedir,
+        near=sourcefile,
+        words=_import_words(sourcefile_content),
+        max_tokens=DIRECTORY_STRUCTURE_TOKENS,
+    )
+
+
+def _target_directory_structure(sourcefile, sourcefile_content, target_deps, globals):
+    # the target tree mirrors the source tree, so the migrated file is expected near the source file's path
+    return build_directory_structure(
+        globals.targetdir,
+        near=sourcefile,
+        related=target_deps,
+        words=_import_words(sourcefile_content),
+        max_tokens=DIRECTORY_STRUCTURE_TOKENS,
+    )
+
+
+def _parse_external_dependencies(external_dependencies):
+    external_dependencies = external_dependencies.strip()
+    if external_dependencies == "NONE":
+        return []
+    return [dep.strip() for dep in external_dependencies.split(",") if dep.strip()]
+
+
+def _parse_internal_dependencies(sourcefile, internal_dependencies):
+    internal_deps_list = (
+        [dep.strip() for dep in internal_dependencies.split(",") if dep.strip()]
+        if internal_dependencies != "NONE"
+        else []
     )
 
     # Sanity checking internal dependencies to avoid infinite loops
-    if sourcefile in internal_dependencies:
+    if sourcefile in internal_deps_list:
         typer.echo(
             typer.style(
                 f"Warning: {sourcefile} seems to depend on itself. Automatically removing {sourcefile} from the list of internal dependencies.",
                 fg=typer.colors.YELLOW,
             )
         )
-        internal_dependencies = internal_dependencies.replace(sourcefile, "")
+        internal_deps_list = [dep for dep in internal_deps_list if dep != sourcefile]
 
-    internal_deps_list = (
-        [dep for dep in internal_dependencies.split(",") if dep] if internal_dependencies != "NONE" else []
-    )
-
-    return internal_deps_list, external_deps_list
+    return internal_deps_list
 
 
-def write_migration(sourcefile, external_deps_list, deps_per_file, globals) -> str:
+async def awrite_migration(sourcefile, external_deps_list, deps_per_file, globals) -> str:
     """Write migration file"""
 
-    sigs = get_function_signatures(deps_per_file, globals) if deps_per_file else []
+    sigs = await aget_function_signatures(deps_per_file, globals) if deps_per_file else []
 
+    chunks = split_source_file(
+        os.path.join(globals.sourcedir, sourcefile), MIGRATION_CHUNK_TOKENS, globals.outlines.get(sourcefile)
+    )
+    if chunks is not None:
+        return await _awrite_chunked_migration(sourcefile, external_deps_list, sigs, chunks, deps_per_file, globals)
+
+    return (
+        await allm_write_file(
+            _write_migration_prompt(sourcefile, external_deps_list, sigs, deps_per_file, globals),
+            target_path=None,
+            waiting_message=f"Creating migration file for {sourcefile}...",
+            success_message=None,
+            globals=globals,
+        )
+    )[0]
+
+
+def _write_migration_prompt(sourcefile, external_deps_list, sigs, target_deps, globals):
     write_migration_template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, WRITE_MIGRATION, SINGLEFILE)
 
     sourcefile_content = ""
     with open(os.path.join(globals.sourcedir, sourcefile)) as file:
         sourcefile_content = file.read()
 
-    prompt = write_migration_template.format(
+    return write_migration_template.format(
         targetlang=globals.targetlang,
         targetlang_function_signatures=convert_sigs_to_string(sigs),
         sourcelang=globals.sourcelang,
         sourcefile=sourcefile,
         sourcefile_content=sourcefile_content,
         external_deps=",".join(external_deps_list),
-        source_directory_structure=globals.source_directory_structure,
-        target_directory_structure=build_directory_structure(globals.targetdir),
+        source_directory_structure=_source_directory_structure(sourcefile, sourcefile_content, globals),
+        target_directory_structure=_target_directory_structure(sourcefile, sourcefile_content, target_deps, globals),
         guidelines=globals.guidelines,
     )
 
-    return llm_write_file(
-        prompt,
-        target_path=None,
-        waiting_message=f"Creating migration file for {sourcefile}...",
-        success_message=None,
-        globals=globals,
+
+async def _awrite_chunked_migration(sourcefile, external_deps_list, sigs, chunks, target_deps, globals) -> str:
+    """Migrate a file too large for one prompt: first its header, then all of its parts at once.
+
+    Every part is migrated with both the source and the migrated header as context, and the migrated
+    parts are appended to the header in source order. Parts of a definition split between its members
+    carry a note on which of them opens and closes it.
+    """
+    header, parts, definitions, notes = chunks
+    typer.echo(
+        typer.style(
+            f"{sourcefile} is too large for one prompt. Migrating it in {len(parts)} parts.", fg=typer.colors.YELLOW
+        )
+    )
+
+    header_template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, WRITE_MIGRATION_HEADER, SINGLEFILE)
+    typer.echo(typer.style(f"Creating migration header for {sourcefile}...", dim=True))
+    file_name, _, target_header = (
+        await globals.ai.awrite_code(
+            header_template.format(
+                targetlang=globals.targetlang,
+                targetlang_function_signatures=convert_sigs_to_string(sigs),
+                sourcelang=globals.sourcelang,
+                sourcefile=sourcefile,
+                header_content=header,
+                outline="\n".join(definitions),
+                external_deps=",".join(external_deps_list),
+                source_directory_structure=_source_directory_structure(sourcefile, header, globals),
+                target_directory_structure=_target_directory_structure(sourcefile, header, target_deps, globals),
+                guidelines=globals.guidelines,
+            )
+        )
     )[0]
 
+    part_template = prompt_constructor(HIERARCHY, GUIDELINES, WRITE_CODE, WRITE_MIGRATION_PART, SINGLEFILE)
+
+    async def migrate_part(part_number, part, note):
+        typer.echo(typer.style(f"Migrating part {part_number} of {len(parts)} of {sourcefile}...", dim=True))
+        return (
+            await globals.ai.awrite_code(
+                part_template.format(
+                    targetlang=globals.targetlang,
+                    targetlang_function_signatures=convert_sigs_to_string(sigs),
+                    sourcelang=globals.sourcelang,
+                    sourcefile=sourcefile,
+                    target_file_name=file_name,
+                    part_number=part_number,
+                    part_count=len(parts),
+                    header_content=header,
+                    target_header=target_header,
+                    part_content=part,
+                    part_note=note,
+                    external_deps=",".join(external_deps_list),
+                    guidelines=globals.guidelines,
+                )
+            )
+        )[0][2]
+
+    target_parts = await asyncio.gather(
+        *[migrate_part(number, part, note) for number, (part, note) in enumerate(zip(parts, notes), 1)]
+    )
+    file_content = "\n\n".join(content.strip("\n") for content in [target_header, *target_parts]) + "\n"
+    await asyncio.to_thread(write_target_file, globals.targetdir, file_name, file_content)
+    typer.echo(typer.style(f"Created {file_name} at {globals.targetdir}", fg=typer.colors.GREEN))
+    return file_name
+
+
+async def discover_dependencies(sourcefile, source_hash, globals, manifest=None):
+    """Internal and external dependencies of a source file.
+
+    Files unchanged since the run recorded in manifest, or since the interrupted run in the journal,
+    reuse their recorded dependencies. Internal dependencies that are not in the source directory are
+    dropped with a warning.
+    """
+    recorded = manifest.recorded_dependencies(sourcefile, source_hash) if manifest is not None else None
+    journaled = globals.journal.get("deps", sourcefile) if globals.journal else None
+    if recorded is None and journaled and journaled["hash"] == source_hash:
+        recorded = journaled["internal"], journaled["external"]
+    if recorded is None:
+        internal_deps_list, external_deps_list = await aget_dependencies(sourcefile, globals)
+        if globals.journal:
+            globals.journal.append(
+                "deps", sourcefile, hash=source_hash, internal=internal_deps_list, external=external_deps_list
+            )
+    else:
+        internal_deps_list, external_deps_list = recorded
+        globals.external_deps.update(dict.fromkeys(external_deps_list))
+
+    internal_deps_list = [dep.strip() for dep in internal_deps_list if dep.strip()]
+    missing = [dep for dep in internal_deps_list if not os.path.isfile(os.path.join(globals.sourcedir, dep))]
+    if missing:
+        typer.echo(
+            typer.style(
+                f"Warning: ignoring dependencies of {sourcefile} that are not in the source directory: {', '.join(missing)}",
+                fg=typer.colors.YELLOW,
+            )
+        )
+    return [dep for dep in internal_deps_list if dep not in missing], external_deps_list
+
+
+async def plan_migration(sourceentry, globals, manifest=None) -> DependencyGraph:
+    """Discover the whole internal dependency graph, starting from the entrypoint.
+
+    Dependencies of every newly discovered file are requested as soon as it is found, so discovery
+    runs as wide as the graph allows. Files unchanged since the run recorded in manifest reuse their
+    recorded dependencies.
+    """
+
+    async def discover(sourcefile):
+        source_hash = file_hash(os.path.join(globals.sourcedir, sourcefile))
+        return await discover_dependencies(sourcefile, source_hash, globals, manifest)
+
+    graph = DependencyGraph()
+    pending = {asyncio.ensure_future(discover(sourceentry)): sourceentry}
+    seen = {sourceentry}
+
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            sourcefile = pending.pop(task)
+            internal_deps_list, external_deps_list = task.result()
+            graph.add_file(sourcefile, internal_deps_list, external_deps_list)
+            for dep in internal_deps_list:
+                if dep not in seen:
+                    seen.add(dep)
+                    pending[asyncio.ensure_future(discover(dep))] = dep
+
+    return graph
+
+
+async def amigrate_source_file(sourcefile, graph, target_deps, source_hash, stale, globals, manifest=None) -> str:
+    """Migrate one file of the graph, or reuse its target if it is not stale. Returns the target file name.
+
+    A file migrated by the interrupted run in the journal is reused if neither it nor the targets of
+    its dependencies changed since.
+    """
+    if not stale:
+        return manifest.files[sourcefile]["target"]
+    dep_hashes = {dep: _target_hash(globals.targetdir, dep) for dep in target_deps}
+    journaled = globals.journal.get("migrated", sourcefile) if globals.journal else None
+    if (
+        journaled
+        and journaled["hash"] == source_hash
+        and journaled.get("deps") == dep_hashes
+        and os.path.exists(os.path.join(globals.targetdir, journaled["target"]))
+    ):
+        target = journaled["target"]
+    else:
+        target = await awrite_migration(sourcefile, graph.external_deps[sourcefile], target_deps, globals)
+        globals.migrated_files += 1
+        if globals.journal:
+            globals.journal.append("migrated", sourcefile, hash=source_hash, deps=dep_hashes, target=target)
+    if manifest is not None:
+        manifest.record(sourcefile, source_hash, graph.deps[sourcefile], graph.external_deps[sourcefile], target)
+    return target
+
+
+def _target_hash(targetdir, target):
+    path = os.path.join(targetdir, target)
+    return file_hash(path) if os.path.isfile(path) else None
+
+
+def _prefetch_outlines(sourcefiles, globals, stop):
+    """Parse the source files large enough to be migrated in parts on every core, ahead of their migration.
+
+    Stops early, dropping the batches not started yet, once the stop event is set.
+    """
+    min_bytes = MIGRATION_CHUNK_TOKENS * CHARS_PER_TOKEN
+    large = []
+    for sourcefile in sourcefiles:
+        try:
+            if os.path.getsize(os.path.join(globals.sourcedir, sourcefile)) > min_bytes:
+                large.append(sourcefile)
+        except OSError:
+            continue
+    try:
+        for sourcefile, outline in decompose_repository(globals.sourcedir, large):
+            if outline is not None:
+                globals.outlines[sourcefile] = outline
+            if stop.is_set():
+                break
+    except Exception:
+        # outlines only spare parsing; files without one are parsed when they are migrated
+        pass
+
+
+def _echo_import_cycle(group):
+    typer.echo(
+        typer.style(
+            f"Import cycle detected between {', '.join(group)}. Migrating them together.",
+            fg=typer.colors.YELLOW,
+        )
+    )
+
+
+async def migrate_pipeline(sourceentry, globals, manifest=None) -> DependencyGraph:
+    """Discover, migrate and index the files of the migration in three overlapping pipeline stages.
+
+    discovery finds the dependencies of a file and releases it to generation as soon as all of them
+    have been discovered and migrated, while the rest of the graph is still being discovered.
+    generation writes the target file and hands it to signatures, which indexes its function
+    signatures and in turn releases the files that depend on it. Generation and signature extraction
+    are fed through bounded queues, so a slow stage holds back the one before it. Released files wait
+    for generation longest chain of dependents first, and files in an import cycle are released
+    together once nothing else can make progress. Prints how each stage spent its time and returns the
+    discovered dependency graph.
+    """
+    workers = globals.ai.limiter.max_concurrency
+    discovery = StageMetrics("discovery", workers)
+    generation = StageMetrics("generation", workers)
+    signatures = StageMetrics("signatures", SIGNATURE_WORKERS)
+
+    # discovery feeds itself, so its queue can't be bounded without risking a deadlock; released files
+    # wait in an unbounded ready queue until the bounded generation queue has room, longest chain of
+    # dependents first, since those files gate the most downstream work
+    discovery_queue = asyncio.Queue()
+    ready_queue = asyncio.PriorityQueue()
+    generation_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    signature_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    graph = DependencyGraph()
+    index = get_symbol_index(globals.targetdir)
+    dependents = defaultdict(set)
+    source_hashes = {}
+    seen = {sourceentry}
+    released = set()
+    stale = set()
+    target_files = {}
+    # longest chain of discovered dependents waiting on each file, forgotten whenever a file is discovered
+    chain_lengths = {}
+    # files queued or being worked on in any stage; when none are left, the pipeline has drained
+    outstanding = 0
+    finished = asyncio.Event()
+
+    def enqueue(queue, sourcefile):
+        nonlocal outstanding
+        outstanding += 1
+        queue.put_nowait(sourcefile)
+
+    def chain_length(sourcefile):
+        # iterative depth-first search over dependents; a dependent met again on an import cycle counts as 0
+        visiting = set()
+        stack = [(sourcefile, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                visiting.discard(node)
+                chain_lengths[node] = 1 + max((chain_lengths.get(parent, 0) for parent in dependents[node]), default=0)
+            elif node not in chain_lengths and node not in visiting:
+                visiting.add(node)
+                stack.append((node, True))
+                stack.extend((parent, False) for parent in dependents[node])
+        return chain_lengths[sourcefile]
+
+    def release(group):
+        changed = any(
+            manifest is None or not manifest.is_current(sourcefile, source_hashes[sourcefile]) for sourcefile in group
+        )
+        changed_deps = any(dep in stale for sourcefile in group for dep in graph.deps[sourcefile] if dep not in group)
+        for sourcefile in group:
+            released.add(sourcefile)
+            if changed or changed_deps:
+                stale.add(sourcefile)
+            enqueue(ready_queue, (-chain_length(sourcefile), len(released), sourcefile))
+
+    def try_release(sourcefile):
+        if sourcefile in released or sourcefile not in graph.deps:
+            return
+        if all(dep in target_files for dep in graph.deps[sourcefile]):
+            release([sourcefile])
+
+    def release_cycles():
+        # nothing is in flight, so every file still waiting depends on another waiting file
+        waiting = [sourcefile for sourcefile in graph.deps if sourcefile not in released]
+        subgraph = DependencyGraph()
+        for sourcefile in waiting:
+            subgraph.add_file(sourcefile, [dep for dep in graph.deps[sourcefile] if dep not in target_files], [])
+        for group in subgraph.strongly_connected_components():
+            if all(dep in target_files or dep in group for sourcefile in group for dep in graph.deps[sourcefile]):
+                release(group)
+                if len(group) > 1 and group[0] in stale:
+                    _echo_import_cycle(group)
+
+    def settle():
+        nonlocal outstanding
+        outstanding -= 1
+        if outstanding == 0:
+            if len(released) < len(graph.deps):
+                release_cycles()
+            else:
+                finished.set()
+
+    async def discover(sourcefile):
+        source_hashes[sourcefile] = file_hash(os.path.join(globals.sourcedir, sourcefile))
+        # parsing may also have to build the file's grammar, which must not hold up the requests in flight
+        await asyncio.to_thread(index.update_file, SOURCE, globals.sourcedir, sourcefile)
+        internal_deps_list, external_deps_list = await discover_dependencies(
+            sourcefile, source_hashes[sourcefile], globals, manifest
+        )
+        graph.add_file(sourcefile, internal_deps_list, external_deps_list)
+        chain_lengths.clear()
+        for dep in graph.deps[sourcefile]:
+            dependents[dep].add(sourcefile)
+            if dep not in seen:
+                seen.add(dep)
+                enqueue(discovery_queue, dep)
+        try_release(sourcefile)
+        settle()
+
+    async def generate(item):
+        *_, sourcefile = item
+        target_deps = [target_files[dep] for dep in graph.deps[sourcefile] if dep in target_files]
+        target = await amigrate_source_file(
+            sourcefile, graph, target_deps, source_hashes[sourcefile], sourcefile in stale, globals, manifest
+        )
+        return sourcefile, target
+
+    async def extract(item):
+        sourcefile, target = item
+        if os.path.isfile(os.path.join(globals.targetdir, target)):
+            # indexed now, the signatures are ready by the time a dependent's prompt needs them
+            await aget_function_signatures([target], globals)
+        target_files[sourcefile] = target
+        for dependent in dependents[sourcefile]:
+            try_release(dependent)
+        settle()
+
+    started = time.monotonic()
+    # which files will be migrated isn't known until discovery finds them, so parse every large one
+    sourcefiles = sorted(get_source_index(globals.sourcedir).files)
+    stop_prefetch = threading.Event()
+    prefetch = asyncio.ensure_future(asyncio.to_thread(_prefetch_outlines, sourcefiles, globals, stop_prefetch))
+    enqueue(discovery_queue, sourceentry)
+    tasks = [asyncio.ensure_future(forward(ready_queue, generation_queue))]
+    tasks += [asyncio.ensure_future(stage_worker(discovery, discovery_queue, discover)) for _ in range(workers)]
+    tasks += [
+        asyncio.ensure_future(stage_worker(generation, generation_queue, generate, signature_queue))
+        for _ in range(workers)
+    ]
+    tasks += [
+        asyncio.ensure_future(stage_worker(signatures, signature_queue, extract)) for _ in range(SIGNATURE_WORKERS)
+    ]
+    try:
+        await run_until(finished, tasks)
+    finally:
+        stop_prefetch.set()
+        await prefetch
+    elapsed = time.monotonic() - started
+
+    if manifest is not None:
+        manifest.prune(graph.deps)
+        typer.echo(
+            typer.style(
+                f"{len(stale)} of {len(graph.deps)} files changed since the last migration or depend on a changed file.",
+                fg=typer.colors.BLUE,
+            )
+        )
+    typer.echo(typer.style(f"Migration pipeline finished in {elapsed:.0f}s:", fg=typer.colors.BLUE))
+    for stage in [discovery, generation, signatures]:
+        typer.echo(typer.style(f"  {stage.summary(elapsed)}", dim=True))
+    return graph
+
 
 def add_env_files(globals):
     """Copy all files recursively with included extensions from the source directory to the target directory in the same relative structure"""
@@ -171,7 +727,7 @@ def add_env_files(globals):
     with open(os.path.join(globals.targetdir, "Dockerfile")) as file:
         dockerfile_content = file.read()
 
-    external_deps = read_from_memory("external_dependencies")
+    external_deps = ",".join(globals.external_deps)
 
     prompt = add_docker_requirements_template.format(
         dockerfile_content=dockerfile_content,
@@ -21,6 +21,3 @@ def create_environment(globals):
         success_message=f"Created Docker environment for {globals.targetlang} project in directory '{globals.targetdir}'.",
         globals=globals,
     )
-
-    with open("memory/external_dependencies", "w") as file:
-        file.write("")
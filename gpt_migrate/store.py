@@ -0,0 +1,155 @@
+"""Transactional SQLite store of what a run remembers between steps, such as the dependencies found so far."""
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+MEMORY_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory", "memory.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    namespace TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    item TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (namespace, collection, item)
+);
+CREATE TABLE IF NOT EXISTS documents (
+    namespace TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, name)
+);
+"""
+
+# Namespace of the run the current thread or task works for; every read and write is confined to it
+memory_namespace = ContextVar("memory_namespace", default="default")
+# Namespace of what every run shares, such as the package equivalents looked up so far
+SHARED_NAMESPACE = "shared"
+
+
+@contextmanager
+def use_namespace(namespace):
+    """Confine the memory of the enclosed code, including tasks and threads it starts, to namespace"""
+    token = memory_namespace.set(namespace)
+    try:
+        yield
+    finally:
+        memory_namespace.reset(token)
+
+
+class MemoryStore:
+    """Named collections of distinct strings, and named JSON documents, kept per namespace.
+
+    Adding an item a collection already holds changes nothing, and items are returned in the order
+    they were first added. Every write is a single BEGIN IMMEDIATE transaction in WAL mode, so any
+    number of threads and processes can write at once without losing or duplicating items.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self.connection.execute("PRAGMA journal_mode=wal")
+            self.connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def add(self, collection, items):
+        """Add the items collection does not hold yet. Returns how many were new."""
+        namespace = memory_namespace.get()
+        with self._transaction():
+            row = self.connection.execute(
+                "SELECT MAX(position) FROM items WHERE namespace = ? AND collection = ?", (namespace, collection)
+            ).fetchone()
+            position = row[0] + 1 if row[0] is not None else 0
+            added = 0
+            for item in items:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO items (namespace, collection, item, position) VALUES (?, ?, ?, ?)",
+                    (namespace, collection, item, position + added),
+                )
+                added += cursor.rowcount
+        return added
+
+    def items(self, collection):
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT item FROM items WHERE namespace = ? AND collection = ? ORDER BY position",
+                (memory_namespace.get(), collection),
+            ).fetchall()
+        return [item for (item,) in rows]
+
+    def clear(self, collection):
+        with self._transaction():
+            self.connection.execute(
+                "DELETE FROM items WHERE namespace = ? AND collection = ?", (memory_namespace.get(), collection)
+            )
+
+    def put(self, name, value):
+        with self._transaction():
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (namespace, name, value) VALUES (?, ?, ?)",
+                (memory_namespace.get(), name, json.dumps(value)),
+            )
+
+    def update(self, name, values):
+        """Merge the dict values into the JSON object stored as document name, creating it if needed"""
+        namespace = memory_namespace.get()
+        with self._transaction():
+            row = self.connection.execute(
+                "SELECT value FROM documents WHERE namespace = ? AND name = ?", (namespace, name)
+            ).fetchone()
+            document = json.loads(row[0]) if row is not None else {}
+            document.update(values)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (namespace, name, value) VALUES (?, ?, ?)",
+                (namespace, name, json.dumps(document)),
+            )
+
+    def get(self, name, default=None):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value FROM documents WHERE namespace = ? AND name = ?", (memory_namespace.get(), name)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def exists(self, name):
+        """True if a document or a non-empty collection of that name is stored"""
+        namespace = memory_namespace.get()
+        with self._lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM documents WHERE namespace = ? AND name = ?"
+                    " UNION ALL SELECT 1 FROM items WHERE namespace = ? AND collection = ? LIMIT 1",
+                    (namespace, name, namespace, name),
+                ).fetchone()
+                is not None
+            )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_memory_store():
+    """The store of this process, opened on first use"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MemoryStore(MEMORY_STORE_PATH)
+        return _store
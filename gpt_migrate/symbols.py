@@ -0,0 +1,189 @@
+"""SQLite index of the symbols defined by the source and target files of a migration."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+from signatures import SIGNATURE_EXTRACTOR_VERSION, extract_signatures
+
+SYMBOL_INDEX_PATH = "gpt_migrate/symbols.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    known INTEGER NOT NULL,
+    described INTEGER NOT NULL,
+    PRIMARY KEY (root, path)
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT,
+    kind TEXT,
+    line INTEGER,
+    signature TEXT NOT NULL,
+    description TEXT NOT NULL,
+    PRIMARY KEY (root, path, position)
+);
+CREATE INDEX IF NOT EXISTS symbols_by_name ON symbols (name);
+"""
+
+SOURCE = "source"
+TARGET = "target"
+
+
+def _content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SymbolIndex:
+    """Functions, classes and methods of every indexed file, with their signature, description and line.
+
+    Files are indexed per root (SOURCE or TARGET) by their path relative to that root's directory. A
+    file's symbols are served from the index as long as its size and modification time, or failing that
+    its content hash, are unchanged; otherwise they are extracted again. Files without a tree-sitter grammar
+    are recorded with unknown symbols until the LLM reads them. A connection is shared by all threads of
+    the process under a lock.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # other processes working on the same target directory may hold the write lock for a moment
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            version = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if version is None or version[0] != str(SIGNATURE_EXTRACTOR_VERSION):
+                # symbols extracted by another version of the extractor are not reused
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute("DELETE FROM symbols")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                    (str(SIGNATURE_EXTRACTOR_VERSION),),
+                )
+
+    def _fresh_row(self, root, directory, relative_path):
+        """The files row of a file if its indexed symbols are still current, and the file's stat and hash"""
+        full_path = os.path.join(directory, relative_path)
+        stat = os.stat(full_path)
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, hash, known, described FROM files WHERE root = ? AND path = ?",
+                (root, relative_path),
+            ).fetchone()
+        if row is not None and (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns):
+            return row, stat, row[2]
+        content_hash = _content_hash(full_path)
+        if row is not None and row[2] == content_hash:
+            with self._lock, self.connection:
+                self.connection.execute(
+                    "UPDATE files SET size = ?, mtime_ns = ? WHERE root = ? AND path = ?",
+                    (stat.st_size, stat.st_mtime_ns, root, relative_path),
+                )
+            return row, stat, content_hash
+        return None, stat, content_hash
+
+    def signatures(self, root, directory, relative_path, described=False):
+        """Indexed signatures of a file, or None if they are unknown or it changed since it was indexed.
+
+        With described, signatures that were indexed before their descriptions were filled in count as
+        changed too.
+        """
+        row, _, _ = self._fresh_row(root, directory, relative_path)
+        if row is None or not row[3] or (described and not row[4]):
+            return None
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT signature, description, name, kind, line FROM symbols"
+                " WHERE root = ? AND path = ? ORDER BY position",
+                (root, relative_path),
+            ).fetchall()
+        return [
+            {"signature": signature, "description": description, "name": name, "kind": kind, "line": line}
+            for signature, description, name, kind, line in rows
+        ]
+
+    def update_file(self, root, directory, relative_path):
+        """Index a file again if it changed. Returns its signatures, or None if they are unknown."""
+        row, stat, content_hash = self._fresh_row(root, directory, relative_path)
+        if row is not None:
+            return self.signatures(root, directory, relative_path)
+        sigs = extract_signatures(os.path.join(directory, relative_path))
+        self._store(root, relative_path, stat, content_hash, sigs, described=False)
+        return sigs
+
+    def set_signatures(self, root, directory, relative_path, sigs, described=False):
+        """Record signatures obtained another way, e.g. from the LLM, for the current content of a file"""
+        _, stat, content_hash = self._fresh_row(root, directory, relative_path)
+        self._store(root, relative_path, stat, content_hash, sigs, described)
+
+    def _store(self, root, relative_path, stat, content_hash, sigs, described):
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM symbols WHERE root = ? AND path = ?", (root, relative_path))
+            self.connection.executemany(
+                "INSERT INTO symbols (root, path, position, name, kind, line, signature, description)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        root,
+                        relative_path,
+                        position,
+                        sig.get("name"),
+                        sig.get("kind"),
+                        sig.get("line"),
+                        sig["signature"],
+                        sig.get("description", ""),
+                    )
+                    for position, sig in enumerate(sigs or [])
+                ],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (root, path, size, mtime_ns, hash, known, described)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (root, relative_path, stat.st_size, stat.st_mtime_ns, content_hash, sigs is not None, described),
+            )
+
+    def find(self, names, root=None):
+        """Definitions of the given names as (root, path, line, name, signature) rows, target files first"""
+        names = list(dict.fromkeys(names))
+        definitions = []
+        with self._lock:
+            # stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(names), 500):
+                batch = names[start : start + 500]
+                query = (
+                    "SELECT root, path, line, name, signature FROM symbols"
+                    f" WHERE name IN ({','.join('?' * len(batch))})"
+                )
+                parameters = list(batch)
+                if root is not None:
+                    query += " AND root = ?"
+                    parameters.append(root)
+                definitions.extend(self.connection.execute(query, parameters).fetchall())
+        return sorted(definitions, key=lambda row: (row[0] != TARGET, row[3], row[1], row[2] or 0))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_symbol_index(targetdir):
+    """The symbol index of the migration writing to targetdir, opened once per process"""
+    path = os.path.join(os.path.abspath(targetdir), SYMBOL_INDEX_PATH)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = SymbolIndex(path)
+        return _indexes[path]
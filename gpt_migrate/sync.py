@@ -0,0 +1,183 @@
+"""Incremental, parallel copying of a directory tree's files into another tree, sharing blocks where possible."""
+
+import errno
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SYNC_HARDLINKS, SYNC_WORKERS
+from ignore import IgnoreMatcher
+from incremental import file_hash
+
+SYNC_MANIFEST_PATH = "gpt_migrate/synced_files.json"
+
+# ioctl request of Linux's FICLONE: make the destination share the source's blocks, copy-on-write
+FICLONE = 0x40049409
+
+# (source device, target device) pairs on which cloning, or copy_file_range, turned out to be unsupported
+_no_reflink = set()
+_no_copy_file_range = set()
+_unsupported_lock = threading.Lock()
+
+
+def _reflink(source_fd, target_fd):
+    import fcntl
+
+    fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+def _copy_file_range(source_fd, target_fd, size):
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(source_fd, target_fd, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+
+
+def copy_file(source, target):
+    """Copy source to target atomically, keeping its permissions. Returns the method used.
+
+    A hardlink when SYNC_HARDLINKS is set, else a reflink where the filesystem can share blocks
+    (Btrfs, XFS, APFS-like), else copy_file_range, which copies inside the kernel, else a plain copy.
+    Methods found unsupported between two devices are not tried again.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if SYNC_HARDLINKS:
+        try:
+            os.link(source, tmp_path)
+            os.replace(tmp_path, target)
+            return "hardlink"
+        except OSError:
+            pass
+    source_stat = os.stat(source)
+    devices = (source_stat.st_dev, os.stat(os.path.dirname(target)).st_dev)
+    method = "copy"
+    try:
+        with open(source, "rb") as source_file, open(tmp_path, "wb") as target_file:
+            if devices not in _no_reflink:
+                try:
+                    _reflink(source_file.fileno(), target_file.fileno())
+                    method = "reflink"
+                except (OSError, ImportError):
+                    with _unsupported_lock:
+                        _no_reflink.add(devices)
+            if method == "copy" and devices not in _no_copy_file_range and hasattr(os, "copy_file_range"):
+                try:
+                    _copy_file_range(source_file.fileno(), target_file.fileno(), source_stat.st_size)
+                    method = "copy_file_range"
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    with _unsupported_lock:
+                        _no_copy_file_range.add(devices)
+                    source_file.seek(0)
+                    target_file.seek(0)
+                    target_file.truncate()
+            if method == "copy":
+                shutil.copyfileobj(source_file, target_file, 1 << 20)
+        shutil.copymode(source, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return method
+
+
+class SyncManifest:
+    """What the last sync from sourcedir copied into the target tree, to copy only what changed since.
+
+    Every copied file is recorded with the size and modification time of its source and of its copy.
+    A file whose source and copy both still match is skipped without being read. A source that was
+    only touched is hashed and skipped if its content is unchanged.
+    """
+
+    def __init__(self, targetdir, sourcedir):
+        self.path = os.path.join(os.path.abspath(targetdir), SYNC_MANIFEST_PATH)
+        self.sourcedir = os.path.abspath(sourcedir)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                data = json.load(file)
+            # files copied from another source directory are not ours to skip or remove
+            if data.get("sourcedir") == self.sourcedir:
+                self.files = data["files"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"sourcedir": self.sourcedir, "files": self.files}, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def sync_files(sourcedir, targetdir, include, excluded_patterns=(), workers=SYNC_WORKERS):
+    """Copy the files of sourcedir for which include(name) holds into targetdir, at the same paths.
+
+    Directories ignored by .gitignore files or excluded_patterns are never entered. Only files that
+    changed since the last sync are copied, by a pool of workers. Copies of files that were removed
+    from sourcedir, or are now ignored, are removed from targetdir unless they were modified there.
+    Returns counts of the files copied, unchanged and removed, and of the bytes copied.
+    """
+    manifest = SyncManifest(targetdir, sourcedir)
+    matcher = IgnoreMatcher(sourcedir, [".gitignore", *excluded_patterns])
+    previous = manifest.files
+    files = {}
+    to_copy = []
+    for relative_dir, _, entries in matcher.walk():
+        for entry in entries:
+            if not include(entry.name):
+                continue
+            relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            stat = entry.stat()
+            source_stat = [stat.st_size, stat.st_mtime_ns]
+            recorded = previous.get(relative_path)
+            target = os.path.join(targetdir, relative_path)
+            if recorded is not None and _stat(target) == recorded["target"]:
+                if recorded["source"] == source_stat:
+                    files[relative_path] = recorded
+                    continue
+                # touched, or checked out again, but not necessarily changed
+                if recorded["source"][0] == source_stat[0] and file_hash(entry.path) == recorded["hash"]:
+                    files[relative_path] = {**recorded, "source": source_stat}
+                    continue
+            to_copy.append((relative_path, entry.path, target, source_stat))
+
+    def copy(item):
+        relative_path, source, target, source_stat = item
+        copy_file(source, target)
+        return relative_path, {"source": source_stat, "target": _stat(target), "hash": file_hash(source)}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for relative_path, entry in executor.map(copy, to_copy):
+            files[relative_path] = entry
+
+    removed = 0
+    for relative_path, recorded in previous.items():
+        if relative_path in files:
+            continue
+        target = os.path.join(targetdir, relative_path)
+        if _stat(target) == recorded["target"]:
+            os.remove(target)
+            removed += 1
+
+    manifest.files = files
+    manifest.save()
+    return {
+        "copied": len(to_copy),
+        "unchanged": len(files) - len(to_copy),
+        "removed": removed,
+        "bytes": sum(source_stat[0] for _, _, _, source_stat in to_copy),
+    }
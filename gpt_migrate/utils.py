@@ -1,46 +1,83 @@
-import fnmatch
-import glob
+import asyncio
 import os
 import re
-import shutil
+import threading
 from collections import Counter
-from pathlib import Path
 
 import typer
 from config import (
     EXCLUDED_EXTENSIONS_SOURCE,
     EXTENSION_TO_LANGUAGE,
     INCLUDED_EXTENSIONS,
+    INTERPRETER_TO_LANGUAGE,
+    LANGUAGE_DETECTION_CONFIDENCE,
+    LANGUAGE_DETECTION_MAX_FILE_BYTES,
+    LANGUAGE_DETECTION_MIN_FILES,
 )
+from ignore import IgnoreMatcher
+from snapshot import directory_changed, file_written, get_directory_snapshot
+from symbols import TARGET, get_symbol_index
+from sync import sync_files
 from yaspin import yaspin
 
 
-def detect_language(source_directory):
-    file_extensions = []
-
-    # シンボリックリンクをたどるためにglobを使っています。
-    for file in glob.glob(source_directory + "/**/*", recursive=True):
-        if os.path.isfile(file):
-            # ファイルの拡張子を取得します。
-            ext = os.path.splitext(file)[1]
-
-            if ext in EXCLUDED_EXTENSIONS_SOURCE:
-                print(
-                    f"""Excluded file: {0}
-                    by EXCLUDED_EXTENSIONS_SOURCE={1}""".format(file, EXCLUDED_EXTENSIONS_SOURCE)
-                )
+def _sniff_language(path):
+    """Language of an extensionless file, from its shebang line or its opening tag"""
+    try:
+        with open(path, "rb") as file:
+            head = file.read(256)
+    except OSError:
+        return None
+    if head.startswith(b"#!"):
+        command = head[2:].split(b"\n", 1)[0].decode("utf-8", "replace").split()
+        if command and os.path.basename(command[0]) == "env":
+            command = [word for word in command[1:] if not word.startswith("-")]
+        if command:
+            interpreter = os.path.basename(command[0]).rstrip("0123456789.")
+            return INTERPRETER_TO_LANGUAGE.get(interpreter)
+    if head.lstrip().startswith(b"<?php"):
+        return "PHP"
+    return None
+
+
+def detect_languages(source_directory):
+    """Languages of the source files, by their share of the source bytes, largest first.
+
+    The tree is walked breadth first without descending into ignored directories, and the walk stops
+    as soon as enough files were seen for one language to hold a clear majority. Returns [] if no
+    source file was found.
+    """
+    weights = Counter()
+    files_seen = 0
+    for _, _, files in IgnoreMatcher(source_directory, [".gitignore"]).walk(breadth_first=True):
+        for entry in files:
+            extension = os.path.splitext(entry.name)[1]
+            if extension in EXCLUDED_EXTENSIONS_SOURCE:
                 continue
-            # ファイルの拡張子をリストに追加します。
-            file_extensions.append(ext.replace(".", ""))
-
-    extension_counts = Counter(file_extensions)
-    print("ext most_common=", extension_counts.most_common(1))
-    most_common_extension, _ = extension_counts.most_common(1)[0]
+            if extension:
+                language = EXTENSION_TO_LANGUAGE.get(extension[1:])
+            else:
+                language = _sniff_language(entry.path)
+            if language is None:
+                continue
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                continue
+            # empty files (e.g. __init__.py) still count a little
+            weights[language] += min(size, LANGUAGE_DETECTION_MAX_FILE_BYTES) + 1
+            files_seen += 1
+        if files_seen >= LANGUAGE_DETECTION_MIN_FILES:
+            if weights.most_common(1)[0][1] >= LANGUAGE_DETECTION_CONFIDENCE * sum(weights.values()):
+                break
+    total = sum(weights.values())
+    return [(language, weight / total) for language, weight in weights.most_common()]
 
-    # Determine the language based on the most common file extension
-    language = EXTENSION_TO_LANGUAGE.get(most_common_extension, None)
 
-    return language
+def detect_language(source_directory):
+    """The main language of the source files, or None if there are none"""
+    languages = detect_languages(source_directory)
+    return languages[0][0] if languages else None
 
 
 def prompt_constructor(*args):
@@ -70,19 +107,24 @@ def llm_write_file(prompt, target_path, waiting_message, success_message, global
         file_name, language, file_content = globals.ai.write_code(prompt)[0]
         spinner.ok("✅ ")
 
-    if file_name == "INSTRUCTIONS:":
-        return "INSTRUCTIONS:", "", file_content
+    return _write_llm_file(file_name, language, file_content, target_path, success_message, globals)
 
+
+def llm_write_files(prompt, target_path, waiting_message, success_message, globals):
+    file_content = ""
+    with yaspin(text=waiting_message, spinner="dots") as spinner:
+        results = globals.ai.write_code(prompt)
+        spinner.ok("✅ ")
+
+    return _write_llm_files(results, target_path, success_message, globals)
+
+
+def _write_llm_file(file_name, language, file_content, target_path, success_message, globals):
     if file_name == "INSTRUCTIONS:":
         return "INSTRUCTIONS:", "", file_content
 
     targetdir = globals.targetdir
-    if target_path:
-        with open(os.path.join(targetdir, target_path), "w") as file:
-            file.write(file_content)
-    else:
-        with open(os.path.join(targetdir, file_name), "w") as file:
-            file.write(file_content)
+    write_target_file(targetdir, target_path or file_name, file_content)
 
     if success_message:
         success_text = typer.style(success_message, fg=typer.colors.GREEN)
@@ -94,21 +136,11 @@ def llm_write_file(prompt, target_path, waiting_message, success_message, global
     return file_name, language, file_content
 
 
-def llm_write_files(prompt, target_path, waiting_message, success_message, globals):
-    file_content = ""
-    with yaspin(text=waiting_message, spinner="dots") as spinner:
-        results = globals.ai.write_code(prompt)
-        spinner.ok("✅ ")
-
+def _write_llm_files(results, target_path, success_message, globals):
     for result in results:
         file_name, language, file_content = result
 
-        if target_path:
-            with open(os.path.join(globals.targetdir, target_path), "w") as file:
-                file.write(file_content)
-        else:
-            with open(os.path.join(globals.targetdir, file_name), "w") as file:
-                file.write(file_content)
+        write_target_file(globals.targetdir, target_path or file_name, file_content)
 
         if not success_message:
             success_text = typer.style(f"Created {file_name} at {globals.targetdir}", fg=typer.colors.GREEN)
@@ -120,6 +152,47 @@ def llm_write_files(prompt, target_path, waiting_message, success_message, globa
     return results
 
 
+def write_target_file(targetdir, relative_path, file_content):
+    path = os.path.join(targetdir, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written aside and moved into place, so a reader, or a worker redoing the same job, never sees half a file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(file_content)
+    os.replace(tmp_path, path)
+    file_written(path)
+    # keep the symbol index in step with every file the LLM writes
+    get_symbol_index(targetdir).update_file(TARGET, targetdir, os.path.relpath(path, targetdir))
+
+
+async def allm_run(prompt, waiting_message, success_message, globals):
+    typer.echo(typer.style(waiting_message, dim=True))
+    output = await globals.ai.arun(prompt)
+
+    if success_message:
+        success_text = typer.style(success_message, fg=typer.colors.GREEN)
+        typer.echo(success_text)
+
+    return output
+
+
+async def allm_write_file(prompt, target_path, waiting_message, success_message, globals):
+    typer.echo(typer.style(waiting_message, dim=True))
+    file_name, language, file_content = (await globals.ai.awrite_code(prompt))[0]
+
+    # writing indexes the file's symbols, which parses it and writes SQLite, so it is kept off the event loop
+    return await asyncio.to_thread(
+        _write_llm_file, file_name, language, file_content, target_path, success_message, globals
+    )
+
+
+async def allm_write_files(prompt, target_path, waiting_message, success_message, globals):
+    typer.echo(typer.style(waiting_message, dim=True))
+    results = await globals.ai.awrite_code(prompt)
+
+    return await asyncio.to_thread(_write_llm_files, results, target_path, success_message, globals)
+
+
 def load_templates_from_directory(directory_path):
     templates = {}
     for filename in os.listdir(directory_path):
@@ -145,84 +218,34 @@ def parse_code_string(code_string):
     return code_triples
 
 
-def read_gitignore(path):
-    gitignore_path = os.path.join(path, ".gitignore")
-    patterns = []
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path) as file:
-            for line in file:
-                line = line.strip()
-                if line and not line.startswith("#"):
-                    patterns.append(line)
-    return patterns
-
-
-def is_ignored(entry_path, gitignore_patterns):
-    return any(fnmatch.fnmatch(entry_path, pattern) for pattern in gitignore_patterns)
-
-
-def build_directory_structure(
-    path=".",
-    indent="",
-    is_last=True,
-    parent_prefix="",
-    is_root=True,
-    ignore_patterns=None,
-):
-    if ignore_patterns is None:
-        ignore_patterns = []
-    gitignore_patterns = read_gitignore(path) + [".gitignore", "*gpt_migrate/*"] if indent == "" else ["*gpt_migrate/*"]
-    ignore_patterns = list(set(ignore_patterns + gitignore_patterns))
-    base_name = os.path.basename(path)
-
-    if not base_name:
-        base_name = "."
-
-    if indent == "":
-        prefix = "|-- " if not is_root else ""
-    elif is_last:
-        prefix = parent_prefix + "└── "
-    else:
-        prefix = parent_prefix + "├── "
-
-    if os.path.isdir(path):
-        result = indent + prefix + base_name + "/\n" if not is_root else ""
-    else:
-        result = indent + prefix + base_name + "\n"
-
-    if os.path.isdir(path):
-        entries = os.listdir(path)
-        for index, entry in enumerate(entries):
-            entry_path = os.path.join(path, entry)
-            new_parent_prefix = "    " if is_last else "│   "
-            if not is_ignored(entry_path, gitignore_patterns):
-                result += build_directory_structure(
-                    entry_path,
-                    indent + "    ",
-                    index == len(entries) - 1,
-                    parent_prefix + new_parent_prefix,
-                    is_root=False,
-                )
+def build_directory_structure(path=".", near=None, related=(), words=frozenset(), max_tokens=None):
+    """The tree under path as indented text, from a snapshot kept current across calls.
 
-    return result
+    With near and max_tokens, a tree larger than max_tokens is detailed around the file near and
+    summarized further away; see DirectorySnapshot.render_near.
+    """
+    if not os.path.isdir(path):
+        return os.path.basename(path) + "\n"
+    if near is not None and max_tokens is not None:
+        return get_directory_snapshot(path).render_near(near, max_tokens, related, words)
+    return get_directory_snapshot(path).render()
 
 
 def copy_files(sourcedir, targetdir, excluded_files=[]):
-    gitignore_patterns = read_gitignore(sourcedir) + [".gitignore"]
-    for item in os.listdir(sourcedir):
-        if os.path.isfile(os.path.join(sourcedir, item)):
-            if item.endswith(INCLUDED_EXTENSIONS) and item not in excluded_files:
-                if not is_ignored(item, gitignore_patterns):
-                    os.makedirs(targetdir, exist_ok=True)
-                    shutil.copy(os.path.join(sourcedir, item), targetdir)
-                    # typer.echo(
-                    #     typer.style(
-                    #         f"Copied {item} from {sourcedir} to {targetdir}",
-                    #         fg=typer.colors.GREEN,
-                    #     )
-                    # )
-        else:
-            copy_files(os.path.join(sourcedir, item), os.path.join(targetdir, item))
+    """Copy the files with included extensions that are neither ignored nor excluded, keeping their paths.
+
+    Only files that changed since the last copy into targetdir are copied.
+    """
+    synced = sync_files(sourcedir, targetdir, lambda name: name.endswith(INCLUDED_EXTENSIONS), excluded_files)
+    if synced["copied"] or synced["removed"]:
+        directory_changed(targetdir)
+        typer.echo(
+            typer.style(
+                f"Copied {synced['copied']} files ({synced['bytes'] / 1e6:.1f} MB) from {sourcedir}, "
+                f"{synced['unchanged']} unchanged, {synced['removed']} removed.",
+                dim=True,
+            )
+        )
 
 
 def construct_relevant_files(files):
@@ -234,11 +257,6 @@ def construct_relevant_files(files):
     return ret
 
 
-def file_exists_in_memory(filename):
-    file = Path("memory/" + filename)
-    return file.exists()
-
-
 def convert_sigs_to_string(sigs):
     sig_string = ""
     for sig in sigs:
@@ -246,20 +264,6 @@ def convert_sigs_to_string(sigs):
     return sig_string
 
 
-def write_to_memory(filename, content):
-    with open("memory/" + filename, "a+") as file:
-        for item in content:
-            if item not in file.read().split("\n"):
-                file.write(item + "\n")
-
-
-def read_from_memory(filename):
-    content = ""
-    with open("memory/" + filename) as file:
-        content = file.read()
-    return content
-
-
 def find_and_replace_file(filepath, find, replace):
     with open(filepath) as file:
         testfile_content = file.read()
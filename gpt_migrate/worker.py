@@ -0,0 +1,96 @@
+import asyncio
+import os
+
+import typer
+from ai import AsyncAI, ConcurrencyLimiter, RateLimiter
+from cache import ResponseCache
+from config import DEFAULT_CACHE_DIR, JOB_POLL_SECONDS, MAX_CONCURRENT_REQUESTS
+from jobqueue import get_job_queue
+from main import Globals
+from steps.distribute import RUN_META_KEY, work, worker_id
+
+app = typer.Typer()
+
+
+def globals_from_run(run, ai, signature_ai=None):
+    globals = Globals(
+        run["sourcedir"],
+        run["targetdir"],
+        run["sourcelang"],
+        run["targetlang"],
+        run["sourceentry"],
+        run["source_directory_structure"],
+        run["operating_system"],
+        run["testfiles"],
+        run["sourceport"],
+        run["targetport"],
+        run["guidelines"],
+        ai,
+    )
+    globals.signature_ai = signature_ai
+    return globals
+
+
+@app.command()
+def worker(
+    targetdir: str = typer.Argument(..., help="Target directory of a migration started with main.py --distribute."),
+    concurrency: int = typer.Option(
+        MAX_CONCURRENT_REQUESTS, help="Maximum number of jobs, and of LLM requests, this worker runs at the same time."
+    ),
+    rate_limit: int = typer.Option(None, help="(Optional) maximum number of LLM requests started per minute."),
+    cache: bool = typer.Option(True, help="Reuse cached LLM responses for identical prompts."),
+    cachedir: str = typer.Option(DEFAULT_CACHE_DIR, help="Directory where LLM responses are cached."),
+    wait: bool = typer.Option(
+        False, help="Keep waiting for new jobs once the queue is empty, instead of exiting. Stop with Ctrl-C."
+    ),
+):
+    """Take migration jobs from the queue of a target directory until none are left."""
+    targetdir = os.path.abspath(targetdir)
+    queue = get_job_queue(targetdir)
+    run = queue.get_meta(RUN_META_KEY)
+    while run is None and wait:
+        asyncio.run(asyncio.sleep(JOB_POLL_SECONDS))
+        run = queue.get_meta(RUN_META_KEY)
+    if run is None:
+        typer.echo(typer.style(f"No migration has been queued in {targetdir} yet.", fg=typer.colors.RED))
+        raise typer.Exit(code=1)
+
+    # the model settings come from the queued run, so every worker sends exactly the same prompts
+    ai = AsyncAI(
+        model=run["model"],
+        temperature=run["temperature"],
+        max_tokens=run["max_tokens"],
+        cache=ResponseCache(cache_dir=cachedir, bypass=not cache),
+        limiter=ConcurrencyLimiter(max_concurrency=concurrency),
+        rate_limiter=RateLimiter(rate_limit) if rate_limit else None,
+    )
+    signature_ai = None
+    if run["signature_model"]:
+        signature_ai = AsyncAI(
+            model=run["signature_model"],
+            temperature=0,
+            cache=ai.cache,
+            limiter=ai.limiter,
+            rate_limiter=ai.rate_limiter,
+        )
+    globals = globals_from_run(run, ai, signature_ai)
+
+    typer.echo(
+        typer.style(
+            f"Worker {worker_id()} taking {run['sourcelang']} to {run['targetlang']} jobs from {queue.path}.",
+            fg=typer.colors.BLUE,
+        )
+    )
+    completed = asyncio.run(work(queue, globals, slots=concurrency, wait=wait))
+    counts = queue.counts()
+    typer.echo(
+        typer.style(
+            f"Completed {completed} jobs. Queue: {counts['done']} done, {counts['failed']} failed, "
+            f"{counts['pending'] + counts['leased']} left.",
+            fg=typer.colors.GREEN if not counts["failed"] else typer.colors.YELLOW,
+        )
+    )
+
+
+if __name__ == "__main__":
+    app()